@@ -2,9 +2,18 @@
 """The script aggregates benchmark data."""
 import argparse
 from collections import defaultdict, namedtuple
+import json
+import math
+import os
 import statistics
 import sys
 
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None  # stats will be computed one benchmark at a time instead
+from histogram import LatencyHistogram
+from results_store import ResultsStore, is_store_filename
 
 Benchmark = namedtuple('Benchmark', ('service', 'version', 'test'))
 Stats = namedtuple('Stats', ('avg', 'sdev', 'sz'))
@@ -12,13 +21,20 @@ AggregateResult = namedtuple('AggregateResult', (
     'test', 'service', 'version', 'rps_avg', 'rps_sd', 'l50_avg', 'l50_sd',
     'non2xx_avg', 'non2xx_sd', 'pct_err_avg', 'pct_err_sd', 'conn_err_avg',
     'conn_err_sd', 'kBps_avg', 'kBps_sd', 'lmin_avg', 'lmin_sd', 'l99_avg',
-    'l99_sd', 'num_samples'))
+    'l99_sd', 'num_samples', 'l99_merged', 'l999_merged', 'l9999_merged'))
+# percentiles computed from the latency histograms merged across runs
+MERGED_PERCENTILES = (99, 99.9, 99.99)
 StartupInfo = namedtuple('StartupInfo', (
-    'platform', 'startup_millis_avg', 'startup_millis_sd', 'samples'))
+    'platform', 'startup_millis_avg', 'startup_millis_sd', 'num_samples'))
 METRICS = (
     'rps', 'l50', 'non2xx', 'pct_err', 'conn_err', 'kBps', 'lmin', 'l99')
 DeployCategory = namedtuple('DeployCategory', (
     'platform', 'startup_millis_avg', 'startup_millis_sd', 'samples'))
+RunResult = namedtuple('RunResult', (
+    'benchmark', 'metrics', 'startup_millis', 'histogram'))
+# phases of a cold start (see the cold_starts table in results_store.py);
+# provision is the time before the process started (incl. network latency)
+COLD_START_PHASES = ('ttfb', 'provision', 'boot', 'import', 'ready')
 
 
 def get_deployment_category(service, version):
@@ -93,7 +109,7 @@ def compute_stats(a, check_for_outliers=False):
         assert new_a  # should never remove every result
         num_bad = len(a) - len(new_a)
         if num_bad:
-            NUM_SAMPLES['bad'] += len(pct_from_mean)
+            NUM_SAMPLES['bad'] += num_bad
             print (f'excluded={excluded} mean={statistics.mean(new_a)} a={a}'
                    f' new_a({len(new_a)})={new_a} nd={num_bad}',
                    file=sys.stderr)
@@ -106,11 +122,91 @@ def compute_stats(a, check_for_outliers=False):
                  len(a))
 
 
-def aggregate_files_and_print(filenames):
-    startup_stats, benchmark_stats = aggregate_files(filenames)
+def compute_all_stats(samples_by_benchmark, metrics=METRICS):
+    """Computes Stats for each of metrics of every benchmark.
+
+    samples_by_benchmark maps each benchmark to a dict of metric -> samples.
+    Returns a dict mapping each benchmark to a dict of metric -> Stats. The
+    results are the same as calling compute_stats() (and checking rps for
+    outliers) on each list of samples, but NumPy does the work for all
+    benchmarks at once.
+    """
+    if np is None:
+        return dict(
+            (benchmark, dict((k, compute_stats(samples[k], k == 'rps'))
+                             for k in metrics))
+            for benchmark, samples in samples_by_benchmark.items())
+
+    benchmarks = list(samples_by_benchmark.keys())
+    out = dict((benchmark, {}) for benchmark in benchmarks)
+    if not benchmarks:
+        return out
+    for k in metrics:
+        # one row per benchmark; rows are padded with NaN
+        rows = [samples_by_benchmark[b][k] for b in benchmarks]
+        sizes = np.array([len(row) for row in rows])
+        assert sizes.min() > 0
+        a = np.full((len(rows), sizes.max()), np.nan)
+        for i, row in enumerate(rows):
+            a[i, :len(row)] = row
+        valid = ~np.isnan(a)
+        mean = np.nanmean(a, axis=1)
+        keep = valid
+        if k == 'rps':
+            NUM_SAMPLES['total'] += int(sizes[sizes > 1].sum())
+            if not mean[sizes > 1].all():
+                raise Exception('mean is unexpectedly zero')
+            # how many times bigger (or smaller) each sample is than the mean
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = a / mean[:, np.newaxis]
+                pct_from_mean = np.where(ratio > 1, ratio, 1 / ratio)
+            keep = valid & (pct_from_mean < THRESHOLD)
+            # if every sample is an outlier, keep the one closest to the mean
+            none_kept = (keep.sum(axis=1) == 0) & (sizes > 1)
+            if none_kept.any():
+                closest = np.nanargmin(
+                    np.where(valid, pct_from_mean, np.inf), axis=1)
+                keep[none_kept, closest[none_kept]] = True
+            keep[sizes == 1] = valid[sizes == 1]
+        kept_sizes = keep.sum(axis=1)
+        kept = np.where(keep, a, np.nan)
+        kept_mean = np.nanmean(kept, axis=1)
+        with np.errstate(invalid='ignore'):
+            kept_sdev = np.nanstd(kept, axis=1, ddof=1)
+        kept_sdev[kept_sizes < 2] = 0
+        for i, benchmark in enumerate(benchmarks):
+            if sizes[i] == 1:
+                x = rows[i][0]
+                out[benchmark][k] = Stats(x, x, 1)
+                continue
+            num_bad = sizes[i] - kept_sizes[i]
+            if num_bad:
+                NUM_SAMPLES['bad'] += int(num_bad)
+                excluded = a[i][valid[i] & ~keep[i]].tolist()
+                print(f'excluded={excluded} mean={kept_mean[i]} a={rows[i]}'
+                      f' nd={num_bad}', file=sys.stderr)
+            out[benchmark][k] = Stats(float(kept_mean[i]),
+                                      float(kept_sdev[i]),
+                                      int(kept_sizes[i]))
+    return out
+
+
+def aggregate_files_and_print(filenames, checkpoint_fn=None):
+    startup_stats, benchmark_stats = aggregate_files(filenames, checkpoint_fn)
     print_startup_stats(startup_stats)
+    cold_starts = read_cold_starts(filenames)
+    if cold_starts:
+        print('\n')
+        print_cold_start_stats(aggregate_cold_starts(cold_starts))
     print('\n')
     print_benchmark_stats(benchmark_stats)
+    if any(split_variant(x.test)[1] for x in benchmark_stats):
+        print('\n')
+        print_variant_stats(benchmark_stats)
+    compress_stats = read_compress_stats(filenames)
+    if compress_stats:
+        print('\n')
+        print_compress_stats(compress_stats)
 
 
 def print_benchmark_stats(benchmark_stats):
@@ -119,6 +215,7 @@ def print_benchmark_stats(benchmark_stats):
         headers.append('%s-avg' % key)
         headers.append('%s-sd' % key)
     headers.append('# Samples')
+    headers.extend('l%s-merged' % x for x in MERGED_PERCENTILES)
     print('\t'.join(headers))
     for row in benchmark_stats:
         categories = list(get_deployment_category(row.service, row.version))
@@ -126,6 +223,113 @@ def print_benchmark_stats(benchmark_stats):
                         for x in [row.test] + categories + list(row[3:])))
 
 
+def split_variant(test):
+    """Returns (test, codec, compressor) for a test like dbjson.orjson.zlib6.
+
+    Tests which name a response compression (like bigjson.br.4) are split the
+    same way: (test, encoding, level). The other two pieces are '' if the test
+    doesn't name a variant.
+    """
+    pieces = test.split('.')
+    if len(pieces) == 3:
+        return tuple(pieces)
+    return test, '', ''
+
+
+def print_variant_stats(benchmark_stats):
+    """Prints the results of tests which named a format or compression."""
+    headers = ['Test', 'Codec/Encoding', 'Compressor/Level', 'Platform',
+               'Machine', 'Runtime', 'Framework', 'rps-avg', 'l50-avg',
+               'l99-avg', '# Samples']
+    print('\t'.join(headers))
+    rows = [(split_variant(row.test), row) for row in benchmark_stats]
+    rows = sorted((x for x in rows if x[0][1]),
+                  key=lambda x: (x[0], -x[1].rps_avg))
+    for variant, row in rows:
+        categories = list(get_deployment_category(row.service, row.version))
+        print('\t'.join(str(x) for x in list(variant) + categories + [
+            row.rps_avg, row.l50_avg, row.l99_avg, row.num_samples]))
+
+
+def read_cold_starts(filenames):
+    """Returns the true cold starts recorded in any of the results stores."""
+    cold_starts = []
+    for fn in filenames:
+        if is_store_filename(fn):
+            store = ResultsStore(fn)
+            cold_starts.extend(x for x in store.cold_starts()
+                               if x.first_request)
+            store.close()
+    return cold_starts
+
+
+def aggregate_cold_starts(cold_starts):
+    """Returns the samples of each cold start phase for each deployment.
+
+    Deployments are keyed by (deployment category, server runtime).
+    """
+    out = {}
+    for x in cold_starts:
+        deploy_cat = get_deployment_category(
+            *get_deployment_id(x.service, x.version, x.test))
+        phases = out.setdefault((deploy_cat, x.runtime or ''), {})
+        provision = None
+        if x.uptime_millis is not None:
+            provision = max(0, x.ttfb_millis - x.uptime_millis)
+        for phase, millis in zip(COLD_START_PHASES, (
+                x.ttfb_millis, provision, x.boot_millis, x.import_millis,
+                x.ready_millis)):
+            if millis is not None:
+                phases.setdefault(phase, []).append(millis)
+    return out
+
+
+def print_cold_start_stats(cold_start_stats):
+    """Prints the median of each phase of cold starts (slowest first)."""
+    headers = ['Platform', 'Machine', 'Runtime', 'Framework',
+               'Server Runtime', '# Samples']
+    headers.extend('median %s millis' % x for x in COLD_START_PHASES)
+    print('\t'.join(headers))
+    for (deploy_cat, runtime), phases in sorted(
+            cold_start_stats.items(),
+            key=lambda item: -statistics.median(item[1]['ttfb'])):
+        row = list(deploy_cat) + [runtime, len(phases['ttfb'])]
+        for phase in COLD_START_PHASES:
+            samples = phases.get(phase)
+            row.append('%d' % statistics.median(samples) if samples else '')
+        print('\t'.join(str(x) for x in row))
+
+
+def read_compress_stats(filenames):
+    """Returns the latest compression stats for each benchmark.
+
+    The server's stats are running totals, so only the last ones fetched
+    for each (service, version, test) are kept.
+    """
+    latest = {}
+    for fn in filenames:
+        if is_store_filename(fn):
+            store = ResultsStore(fn)
+            for x in store.compress_stats():
+                latest[(x.service, x.version, x.test)] = x
+            store.close()
+    return [latest[k] for k in sorted(latest)]
+
+
+def print_compress_stats(compress_stats):
+    """Prints how well and how cheaply each deployment compressed."""
+    print('\t'.join(['Test', 'Platform', 'Machine', 'Runtime', 'Framework',
+                     'Encoding', 'Level', '# Responses', 'Ratio',
+                     'CPU Millis per Response', 'CPU Millis per MB']))
+    for x in compress_stats:
+        categories = list(get_deployment_category(
+            *get_deployment_id(x.service, x.version, x.test)))
+        ratio = round(x.bytes_in / x.bytes_out, 2) if x.bytes_out else ''
+        print('\t'.join(str(v) for v in [x.test] + categories + [
+            x.encoding, x.level, x.responses, ratio,
+            x.cpu_millis_per_response, x.cpu_millis_per_mb or '']))
+
+
 def print_startup_stats(startup_stats):
     print('\t'.join(['Platform', 'Machine', 'Runtime', 'Framework',
                      'Avg Startup Millis', 'StDev SM', '# Samples']))
@@ -134,75 +338,287 @@ def print_startup_stats(startup_stats):
             key=lambda item: item[1].startup_millis_avg):
         print('%s\t%s\t%s\t%s\t%d\t%f\t%d' % (
             *deploy_cat, stats.startup_millis_avg,
-            stats.startup_millis_sd, len(stats.samples)))
+            stats.startup_millis_sd, stats.num_samples))
+
+
+def get_deployment_id(service, ver, test):
+    """Returns the (service, version) a result is aggregated under."""
+    if ver == 'n/a':
+        # Cloud Run requires a different naming scheme; construct platform,
+        # service and version such that the mirror the setup for GAE
+        pieces = service.rsplit('-', 3)
+        service = '-'.join(['cr', pieces[0]])
+        ver = '-'.join(pieces[1:])
+    else:
+        service = 'gae-' + service
+    test = split_variant(test)[0]
+    if ver.endswith('-' + test):
+        ver = ver[:-len(test) - 1]
+    elif ver.endswith('-dbjson'):
+        ver = ver[:-7]
+    elif test in ('txtaskasync', 'ndbtxtaskasync', 'adbindir',
+                  'memcachepipe', 'cachedread', 'dataprealloc', 'datastream',
+                  'bigjson'):
+        ver = ver.rsplit('-', 1)[0]  # shares another test's version
+    return service, ver
+
+
+def parse_line(line):
+    """Parses one line of results. Returns None if it should be ignored."""
+    if not line.strip():
+        return None
+    columns = line.rstrip('\n').split('\t')
+    utc_str, service, ver, test, req_per_sec, kBps, lmin, l50 = columns[:8]
+    l90, l99, non2xx, secs, pct_err, conn_err, startup_millis = columns[8:15]
+    # older results don't have a latency histogram
+    histogram = columns[15] if len(columns) > 15 else None
+    service, ver = get_deployment_id(service, ver, test)
+    # compare ndb tests with the non-ndb version of the test (want to
+    # compare them head to head)
+    if test.startswith('ndb'):
+        test = test[1:]
+        if test.startswith('dbtxtask'):
+            test = test[2:]
+        ver = 'ndb-' + ver
+    rps = float(req_per_sec)
+    if rps == 0:
+        return None
+    metrics = dict(
+        rps=rps,
+        kBps=float(kBps),
+        lmin=float(lmin),
+        l50=float(l50),
+        l99=float(l99),
+        non2xx=int(non2xx),
+        pct_err=float(pct_err),
+        conn_err=int(conn_err),
+    )
+    if histogram:
+        histogram = LatencyHistogram.decode(histogram)
+    return RunResult(Benchmark(service, ver, test), metrics,
+                     int(startup_millis), histogram)
 
 
-def aggregate_files(filenames):
-    raw_startup_stats = defaultdict(list)
-    core_stats = defaultdict(dict)
-    lines = []
+def read_lines(fn, offset=0):
+    """Yields (offset, line) for each results line in a file after offset.
+
+    For TSV results files, offset is a byte offset (only complete lines are
+    read). For results stores, it is a row ID. Each line's offset is the
+    offset to resume reading from after that line.
+    """
+    if is_store_filename(fn):
+        store = ResultsStore(fn)
+        try:
+            yield from store.lines(after_id=offset)
+        finally:
+            store.close()
+    else:
+        with open(fn, 'rb') as fin:
+            fin.seek(offset)
+            for line in fin:
+                if not line.endswith(b'\n'):
+                    break  # still being written; read it next time
+                offset += len(line)
+                yield offset, line.decode('utf-8')
+
+
+def read_results(filenames):
+    """Yields a RunResult for each (non-ignored) result in the files."""
     for fn in filenames:
-        with open(fn, 'r') as fin:
-            lines.extend(fin.readlines())
-    for line in lines:
-        if not line:
-            continue
-        columns = line.split('\t')
-        utc_str, service, ver, test, req_per_sec, kBps, lmin, l50 = columns[:8]
-        l90, l99, non2xx, secs, pct_err, conn_err, startup_millis = columns[8:]
-        if ver == 'n/a':
-            # Cloud Run requires a different naming scheme; construct platform,
-            # service and version such that the mirror the setup for GAE
-            pieces = service.rsplit('-', 3)
-            service = '-'.join(['cr', pieces[0]])
-            ver = '-'.join(pieces[1:])
-        else:
-            framework, part2 = ver.split('-', 1)
-            service = 'gae-' + service
-        if ver.endswith('-' + test):
-            ver = ver[:-len(test) - 1]
-        elif ver.endswith('-dbjson'):
-            ver = ver[:-7]
-        # compare ndb tests with the non-ndb version of the test (want to
-        # compare them head to head)
-        if test.startswith('ndb'):
-            test = test[1:]
-            if test == 'dbtxtask':
-                test = test[2:]
-            ver = 'ndb-' + ver
-        rps = float(req_per_sec)
-        if rps == 0:
-            continue
-        core_id = Benchmark(service, ver, test)
-        my_core_stats = core_stats[core_id]
-        my_core_stats.setdefault('rps', []).append(rps)
-        my_core_stats.setdefault('kBps', []).append(float(kBps))
-        my_core_stats.setdefault('lmin', []).append(float(lmin))
-        my_core_stats.setdefault('l50', []).append(float(l50))
-        my_core_stats.setdefault('l99', []).append(float(l99))
-        my_core_stats.setdefault('non2xx', []).append(int(non2xx))
-        my_core_stats.setdefault('pct_err', []).append(float(pct_err))
-        my_core_stats.setdefault('conn_err', []).append(int(conn_err))
-        deploy_cat = get_deployment_category(service, ver)
-        raw_startup_stats[deploy_cat].append(int(startup_millis))
+        for ignore, line in read_lines(fn):
+            result = parse_line(line)
+            if result:
+                yield result
 
-    startup_stats = {}
-    for deploy_cat, stats in raw_startup_stats.items():
-        if deploy_cat.platform.startswith('CR'):
+
+class RunningStats(object):
+    """The count, mean and sum of squared deviations of a series of samples.
+
+    Samples are added one at a time (with Welford's method), so the samples
+    themselves needn't be kept.
+    """
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def get_stats(self):
+        """Returns the same Stats as compute_stats() would."""
+        assert self.n
+        if self.n == 1:
+            return Stats(self.mean, self.mean, 1)
+        return Stats(self.mean, math.sqrt(self.m2 / (self.n - 1)), self.n)
+
+
+class AggregateState(object):
+    """Running stats for every benchmark, and how much of each file they cover.
+
+    The state can be saved to a checkpoint file so that later aggregations
+    only need to read results added since the checkpoint was saved, and only
+    recompute the stats of the benchmarks which got new results. Each metric
+    is summarized by RunningStats, except rps: outlier removal compares each
+    rps sample with the mean of them all, so those samples are kept (along
+    with the Stats computed from them).
+    """
+    VERSION = 2
+
+    def __init__(self):
+        self.startup = {}  # deploy cat -> RunningStats of startup millis
+        self.running = defaultdict(dict)  # benchmark -> metric -> RunningStats
+        self.rps_samples = defaultdict(list)  # benchmark -> rps samples
+        self.rps_stats = {}  # benchmark -> Stats (outliers removed)
+        self.histograms = {}  # benchmark -> LatencyHistogram
+        self.offsets = {}  # filename -> offset to resume reading from
+        self.changed = set()  # benchmarks whose rps_stats are out of date
+
+    def add(self, result):
+        core_id = result.benchmark
+        for k, v in result.metrics.items():
+            if k == 'rps':
+                self.rps_samples[core_id].append(v)
+            else:
+                self.running[core_id].setdefault(k, RunningStats()).add(v)
+        self.changed.add(core_id)
+        if result.histogram:
+            self.histograms.setdefault(core_id, LatencyHistogram()).merge(
+                result.histogram)
+        deploy_cat = get_deployment_category(core_id.service, core_id.version)
+        if (deploy_cat.platform.startswith('CR') and
+                result.startup_millis <= 2000):
             # hacky filtering out of junk results from when service must've
             # already been running
-            stats = [x for x in stats if x > 2000]
-            if not stats:
-                continue
-        x = compute_stats(stats)
-        startup_stats[deploy_cat] = StartupInfo(deploy_cat, x[0], x[1], stats)
+            return
+        self.startup.setdefault(deploy_cat, RunningStats()).add(
+            result.startup_millis)
+
+    def update(self, filenames):
+        """Adds results which were not yet read from each file."""
+        num_new = 0
+        for fn in filenames:
+            offset = self.offsets.get(fn, 0)
+            for offset, line in read_lines(fn, offset):
+                result = parse_line(line)
+                if result:
+                    self.add(result)
+                    num_new += 1
+            self.offsets[fn] = offset
+        return num_new
+
+    def update_stats(self):
+        """Recomputes rps_stats for the benchmarks with new results."""
+        if self.changed:
+            self.rps_stats.update(
+                (benchmark, stats['rps'])
+                for benchmark, stats in compute_all_stats(
+                    dict((b, dict(rps=self.rps_samples[b]))
+                         for b in self.changed), ('rps',)).items())
+        for benchmark, stats in self.rps_stats.items():
+            if benchmark in self.changed:
+                continue  # compute_all_stats() already counted its samples
+            num_samples = len(self.rps_samples[benchmark])
+            if num_samples > 1:
+                NUM_SAMPLES['total'] += num_samples
+                NUM_SAMPLES['bad'] += num_samples - stats.sz
+        self.changed = set()
+
+    def get_stats(self, benchmark):
+        """Returns a dict of metric -> Stats for benchmark."""
+        stats = dict((k, v.get_stats())
+                     for k, v in self.running[benchmark].items())
+        stats['rps'] = self.rps_stats[benchmark]
+        return stats
+
+    def can_resume(self, filenames):
+        """Returns True if this state only covers data still in filenames."""
+        for fn, offset in self.offsets.items():
+            if fn not in filenames or not os.path.exists(fn):
+                return False
+            if not is_store_filename(fn) and os.path.getsize(fn) < offset:
+                return False  # file was truncated or replaced
+        return True
+
+    def save(self, checkpoint_fn):
+        assert not self.changed, 'call update_stats() first'
+        data = dict(
+            version=self.VERSION,
+            offsets=self.offsets,
+            running=[[list(k), dict((m, [x.n, x.mean, x.m2])
+                                    for m, x in v.items())]
+                     for k, v in self.running.items()],
+            rps=[[list(k), v, list(self.rps_stats[k])]
+                 for k, v in self.rps_samples.items()],
+            startup=[[list(k), [v.n, v.mean, v.m2]]
+                     for k, v in self.startup.items()],
+            histograms=[[list(k), v.encode()]
+                        for k, v in self.histograms.items()],
+        )
+        tmp_fn = checkpoint_fn + '.tmp'
+        with open(tmp_fn, 'w') as fout:
+            json.dump(data, fout)
+        os.replace(tmp_fn, checkpoint_fn)
+
+    @classmethod
+    def load(cls, checkpoint_fn):
+        """Returns the state saved in checkpoint_fn (None if unusable)."""
+        try:
+            with open(checkpoint_fn, 'r') as fin:
+                data = json.load(fin)
+        except (IOError, ValueError):
+            return None
+        if data.get('version') != cls.VERSION:
+            return None
+        state = cls()
+        state.offsets = data['offsets']
+        for k, v in data['running']:
+            state.running[Benchmark(*k)] = dict(
+                (m, RunningStats(*x)) for m, x in v.items())
+        for k, samples, stats in data['rps']:
+            state.rps_samples[Benchmark(*k)] = samples
+            state.rps_stats[Benchmark(*k)] = Stats(*stats)
+        for k, v in data['startup']:
+            state.startup[DeployCategory(*k)] = RunningStats(*v)
+        for k, v in data['histograms']:
+            state.histograms[Benchmark(*k)] = LatencyHistogram.decode(v)
+        return state
+
+
+def aggregate_files(filenames, checkpoint_fn=None):
+    """Aggregates results from the files.
+
+    If checkpoint_fn is provided, then only results added since the last
+    aggregation which used that checkpoint are read.
+    """
+    state = None
+    if checkpoint_fn:
+        state = AggregateState.load(checkpoint_fn)
+        if state and not state.can_resume(filenames):
+            print('checkpoint does not match the input files; starting over',
+                  file=sys.stderr)
+            state = None
+    state = state or AggregateState()
+    num_new = state.update(filenames)
+    state.update_stats()
+    if checkpoint_fn:
+        state.save(checkpoint_fn)
+        print(f'read {num_new} new results', file=sys.stderr)
+    histograms = state.histograms
+
+    startup_stats = {}
+    for deploy_cat, running in state.startup.items():
+        x = running.get_stats()
+        startup_stats[deploy_cat] = StartupInfo(deploy_cat, x.avg, x.sdev,
+                                                x.sz)
 
     need_more = []
+    core_stats = dict((benchmark, state.get_stats(benchmark))
+                      for benchmark in state.rps_stats)
     for benchmark, stats in core_stats.items():
-        import copy
-        tmp = copy.deepcopy(stats)
-        for k in METRICS:
-            stats[k] = compute_stats(stats[k], k == 'rps')
         rps_stats = stats['rps']
         pct = abs(rps_stats.sdev / rps_stats.avg)
         # warn if fewer than three benchmark results
@@ -213,7 +629,7 @@ def aggregate_files(filenames):
         elif pct > 0.3:
             need_more.append('-'.join(x for x in benchmark))
             print (f'pct={pct} mean={rps_stats.avg} sdev={rps_stats.sdev}',
-                   f'rps={tmp["rps"]} ... {benchmark}',
+                   f'rps={state.rps_samples[benchmark]} ... {benchmark}',
                    file=sys.stderr)
 
     # some really hacvky code to print the benchmark runner commands we need;
@@ -242,14 +658,14 @@ def aggregate_files(filenames):
             if cr:
                 print(f'need more data for {len(cr)} CR on Anthos:\n  '
                       f'./run.py {project} -n5 --test {test} --secs 180 '
-                      '--continue more-data.tsv --sequential ',
+                      '--continue more-data.db --sequential ',
                       " ".join(f"--filter '{x}$'" for x in cr), '\n',
                       file=sys.stderr)
             non_cr = [x for x in nm if 'highcpu' not in x]
             if non_cr:
                 print(f'need more data for {len(non_cr)} others:\n  '
                       f'./run.py {project} -n5 --test {test} --secs 180 '
-                      '--continue more-data2.tsv ',
+                      '--continue more-data2.db ',
                       " ".join(f"--filter '{x}$'" for x in non_cr), '\n',
                       file=sys.stderr)
     print(f'{NUM_SAMPLES["total"] - NUM_SAMPLES["bad"]} benchmarks '
@@ -262,6 +678,9 @@ def aggregate_files(filenames):
         for k in METRICS:
             values.extend(stats[k][:2])
         values.append(stats['rps'].sz)
+        histogram = histograms.get(benchmark)
+        for pct in MERGED_PERCENTILES:
+            values.append(histogram.percentile(pct) if histogram else '')
         benchmark_stats.append(AggregateResult(*values))
 
         key = (benchmark.service, benchmark.version)
@@ -292,6 +711,7 @@ def aggregate_files(filenames):
             values.append(-1)
         if values:
             values.append(sum([x['rps'].sz for x in v.values()]) / 2)
+            values.extend([''] * len(MERGED_PERCENTILES))
             benchmark_stats.append(AggregateResult(*values))
 
     return startup_stats, benchmark_stats
@@ -304,13 +724,45 @@ def cmp_core(item):
             -val['rps'].avg)  # highest RPS first
 
 
+def merge_histograms(filenames):
+    """Returns the latency histogram for each benchmark (across all runs)."""
+    histograms = {}
+    for result in read_results(filenames):
+        if result.histogram:
+            histograms.setdefault(result.benchmark, LatencyHistogram()).merge(
+                result.histogram)
+    return histograms
+
+
+def write_latency_cdfs(filenames, out_fn):
+    """Writes the latency CDF of each benchmark to out_fn."""
+    with open(out_fn, 'w') as fout:
+        print('\t'.join(['Test', 'Platform', 'Machine', 'Runtime',
+                         'Framework', 'Latency (ms)', 'Fraction <=']),
+              file=fout)
+        for benchmark, histogram in sorted(merge_histograms(filenames).items()):
+            categories = list(get_deployment_category(benchmark.service,
+                                                      benchmark.version))
+            for millis, fraction in histogram.cdf():
+                print('\t'.join(str(x) for x in [benchmark.test] + categories +
+                                 ['%.3f' % millis, '%.6f' % fraction]),
+                      file=fout)
+
+
 def main(f=aggregate_files_and_print):
     """Aggregate the specified filename."""
     parser = argparse.ArgumentParser()
     parser.add_argument('FILENAME', nargs='*',
                         help='filename(s) to aggregate')
+    parser.add_argument('--cdf', metavar='OUTPUT_FILENAME',
+                        help='also write each latency CDF to this file')
+    parser.add_argument('--checkpoint', metavar='CHECKPOINT_FILENAME',
+                        help='only read results added since this checkpoint '
+                        '(it is created if needed and updated afterward)')
     args = parser.parse_args()
-    return f(args.FILENAME)
+    if args.cdf:
+        write_latency_cdfs(args.FILENAME, args.cdf)
+    return f(args.FILENAME, args.checkpoint)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,31 @@
 #!/usr/bin/env node
 const autocannon = require('autocannon');
 
-async function benchmark(projectName, noSSL, hostname, service, version,
-                         testName, numConnections, durationSecs, numRequests,
-                         isSummaryDesired, isAWS) {
+// latencies are counted in logarithmic buckets (each 1% wider than the last)
+// so that histograms from many runs can be merged exactly; histogram.py uses
+// the same encoding
+const HISTOGRAM_LOG_GROWTH = Math.log(1.01);
+
+class LatencyHistogram {
+    constructor() {
+        this.counts = new Map();  // bucket index -> count
+    }
+
+    record(millis) {
+        const micros = Math.max(1, Math.round(millis * 1000));
+        const idx = Math.floor(Math.log(micros) / HISTOGRAM_LOG_GROWTH);
+        this.counts.set(idx, (this.counts.get(idx) || 0) + 1);
+    }
+
+    encode() {
+        const indices = Array.from(this.counts.keys()).sort((a, b) => a - b);
+        return 'h1:' + indices.map(
+            idx => `${idx}:${this.counts.get(idx)}`).join(',');
+    }
+}
+
+// returns the base URL and headers for requests to a service's version
+function getTarget(projectName, noSSL, hostname, service, version, isAWS) {
     const scheme = noSSL ? 'http://' : 'https://';
     var headers;
     if (!hostname) {
@@ -20,21 +42,60 @@ async function benchmark(projectName, noSSL, hostname, service, version,
             };
         }
     }
-    var path;
+    return {baseUrl: scheme + hostname, headers: headers, version: version};
+}
+
+function isJsonTest(testName) {
+    return testName === 'json' || testName === 'dbjson';
+}
+
+// returns the headers a test's requests need: a test like bigjson.gzip.6 asks
+// for its responses to be compressed with gzip (level 6)
+function getHeaders(testName) {
+    const pieces = testName.split('.');
+    if (pieces.length === 3 && !isJsonTest(pieces[0])) {
+        return {'accept-encoding': pieces[1], 'x-compress-level': pieces[2]};
+    }
+    return {};
+}
+
+function getPath(testName) {
+    // a json test may name the format to store the data in, like
+    // dbjson.orjson.zlib6 (the codec, then the compressor); other tests may
+    // name a compression (see getHeaders)
+    const pieces = testName.split('.');
+    if (pieces.length === 3 && !isJsonTest(pieces[0])) {
+        return getPath(pieces[0]);
+    }
+    if (pieces.length === 3) {
+        const path = getPath(pieces[0]);
+        return path + (path.includes('?') ? '&' : '?') +
+            'codec=' + pieces[1] + '&compress=' + pieces[2];
+    }
     if (testName === 'json') {
-        path = '/test/dbjson?b=1';
+        return '/test/dbjson?b=1';
     }
-    else if (testName === 'ndbtxtask') {
-        path = '/test/txtask';
+    if (testName === 'dataprealloc' || testName === 'datastream') {
+        return '/test/data?mode=' + testName.substring(4);
     }
-    else if (testName.substring(0, 3) === 'ndb') {
-        // same url path as db (test URL differs only in version, not path)
-        path = '/test/db' + testName.substring(3);
+    if (testName.substring(0, 9) === 'ndbtxtask') {
+        return '/test/' + testName.substring(3); // txtask or txtaskasync
     }
-    else {
-        path = '/test/' + testName;
+    if (testName.substring(0, 3) === 'ndb') {
+        // same url path as db (test URL differs only in version, not path)
+        return '/test/db' + testName.substring(3);
     }
-    const url = [scheme, hostname, path].join('');
+    return '/test/' + testName;
+}
+
+async function benchmark(projectName, noSSL, hostname, service, version,
+                         testName, numConnections, durationSecs, numRequests,
+                         isSummaryDesired, isAWS) {
+    const target = getTarget(projectName, noSSL, hostname, service, version,
+                             isAWS);
+    const headers = Object.assign({}, target.headers, getHeaders(testName));
+    version = target.version;
+    const url = target.baseUrl + getPath(testName);
     console.log(`url=${url} headers=${headers}`);
     const cfg = {
         amount: numRequests,
@@ -47,7 +108,16 @@ async function benchmark(projectName, noSSL, hostname, service, version,
     if (durationSecs) {
         cfg.duration = durationSecs;
     }
-    var out = await autocannon(cfg);
+    const histogram = new LatencyHistogram();
+    const instance = autocannon(cfg);
+    instance.on('response', (client, statusCode, resBytes, responseTime) => {
+        // like the latency stats, only successful requests are included
+        if (statusCode >= 200 && statusCode < 300) {
+            histogram.record(responseTime);
+        }
+    });
+    var out = await instance;
+    out.histogram = histogram;
     out.service = service;
     out.version = version;
     out.testName = testName;
@@ -58,6 +128,50 @@ async function benchmark(projectName, noSSL, hostname, service, version,
     return out;
 }
 
+function millisSince(start) {
+    const elapsed = process.hrtime(start);
+    return elapsed[0] * 1000 + elapsed[1] / 1e6;
+}
+
+// makes one request to /test/startup (the first request to a newly started
+// server measures its cold start); returns a tab-separated line with the time
+// to first byte, the total latency, the HTTP status and the server's report
+// of how long each phase of its startup took (testName may instead name
+// another test whose response is a report, like compressstats)
+function measureStartup(projectName, noSSL, hostname, service, version,
+                        isAWS, testName = 'startup') {
+    const target = getTarget(projectName, noSSL, hostname, service, version,
+                             isAWS);
+    const url = target.baseUrl + getPath(testName);
+    const client = require(noSSL ? 'http' : 'https');
+    return new Promise((resolve, reject) => {
+        const start = process.hrtime();
+        const req = client.get(url, {headers: target.headers}, res => {
+            const ttfbMillis = millisSince(start);
+            var body = '';
+            res.setEncoding('utf8');
+            res.on('data', chunk => {
+                body += chunk;
+            });
+            res.on('end', () => {
+                resolve([
+                    new Date().toUTCString(),
+                    service,
+                    target.version,
+                    Math.round(ttfbMillis),
+                    Math.round(millisSince(start)),
+                    res.statusCode,
+                    body.replace(/\s+/g, ' '),
+                ].join('\t'));
+            });
+            res.on('error', reject);
+        });
+        req.on('error', reject);
+        // a cold start can take much longer than a normal request
+        req.setTimeout(60000, () => req.abort());
+    });
+}
+
 // convert result dict to a tab-separated string (for copy/pasting into a
 // spreadsheet)
 function summarize(result) {
@@ -76,6 +190,7 @@ function summarize(result) {
         result.duration,
         result.non2xx / result.requests.total,
         result.errors,
+        result.histogram.encode(),
     ].join('\t');
 };
 
@@ -96,7 +211,7 @@ async function main(projectName, service, version, testName, duration,
                  'Latency (best, ms)',
                  'Latency p50', 'Latency p90', 'Latency p99',
                  '# Errors', 'Test Duration (s)', '% Errors',
-                 'Timeouts'].join('\t'));
+                 'Timeouts', 'Latency Histogram'].join('\t'));
     console.log(summarize(out));
 }
 
@@ -104,3 +219,4 @@ if (require.main === module) {
     main.apply(null, process.argv.slice(process.argv.length - 5));
 }
 exports.benchmark = benchmark;
+exports.measureStartup = measureStartup;
@@ -0,0 +1,56 @@
+"""Confidence intervals used to decide when a benchmark has enough runs."""
+import random
+
+
+def bootstrap_ci(samples, confidence=0.95, num_resamples=2000, seed=0):
+    """Returns a bootstrap (percentile) confidence interval for the mean."""
+    assert samples
+    n = len(samples)
+    rng = random.Random(seed)  # deterministic so decisions are repeatable
+    means = []
+    for ignore in range(num_resamples):
+        means.append(sum(samples[rng.randrange(n)] for ignore in range(n)) /
+                     float(n))
+    means.sort()
+    tail = (1 - confidence) / 2.0
+    lo_idx = int(tail * (num_resamples - 1))
+    hi_idx = int((1 - tail) * (num_resamples - 1))
+    return means[lo_idx], means[hi_idx]
+
+
+def relative_ci_half_width(samples, confidence=0.95):
+    """Returns the CI's half-width as a fraction of the samples' mean."""
+    mean = sum(samples) / float(len(samples))
+    if not mean:
+        return float('inf')
+    lo, hi = bootstrap_ci(samples, confidence)
+    return (hi - lo) / 2.0 / abs(mean)
+
+
+class SampleSizePolicy(object):
+    """Decides whether a benchmark needs more runs.
+
+    A benchmark needs more runs until the confidence interval of the mean of
+    each of its metrics is narrower than max_rel_half_width (relative to the
+    mean). At least min_runs are always required.
+    """
+    def __init__(self, max_rel_half_width, min_runs=3, confidence=0.95):
+        assert max_rel_half_width > 0
+        assert min_runs >= 2
+        self.max_rel_half_width = max_rel_half_width
+        self.min_runs = min_runs
+        self.confidence = confidence
+
+    def widest(self, samples_by_metric):
+        """Returns (metric, relative half-width) for the least certain metric."""
+        return max(
+            ((metric, relative_ci_half_width(samples, self.confidence))
+             for metric, samples in samples_by_metric.items()),
+            key=lambda x: x[1])
+
+    def wants_more(self, samples_by_metric):
+        """samples_by_metric maps each metric to a list of its samples."""
+        for samples in samples_by_metric.values():
+            if len(samples) < self.min_runs:
+                return True
+        return self.widest(samples_by_metric)[1] > self.max_rel_half_width
@@ -0,0 +1,81 @@
+"""Mergeable latency histograms.
+
+Latencies are counted in logarithmic buckets (each 1% wider than the last) so
+that histograms from many runs can be merged exactly and percentiles read from
+the merged result are accurate to within 1%. benchmark.js encodes histograms
+in the same format.
+"""
+import math
+
+
+GROWTH = 1.01  # ratio between the lower bounds of consecutive buckets
+LOG_GROWTH = math.log(GROWTH)
+ENCODING_PREFIX = 'h1:'
+
+
+class LatencyHistogram(object):
+    """Counts latencies (in milliseconds) by bucket."""
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})  # bucket index -> count
+
+    @staticmethod
+    def bucket_for(millis):
+        micros = max(1, int(round(millis * 1000)))
+        return int(math.floor(math.log(micros) / LOG_GROWTH))
+
+    @staticmethod
+    def bucket_value(idx):
+        """Returns the latency (in milliseconds) at the middle of a bucket."""
+        return GROWTH ** (idx + 0.5) / 1000
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def record(self, millis, count=1):
+        idx = self.bucket_for(millis)
+        self.counts[idx] = self.counts.get(idx, 0) + count
+
+    def merge(self, other):
+        for idx, count in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+        return self
+
+    def percentile(self, pct):
+        """Returns the latency at the specified percentile (e.g., 99.9)."""
+        total = self.total
+        if not total:
+            return 0
+        rank = max(1, int(math.ceil(pct / 100.0 * total)))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return self.bucket_value(idx)
+        return self.bucket_value(max(self.counts))
+
+    def cdf(self):
+        """Returns a list of (latency millis, fraction of requests <= it)."""
+        total = float(self.total)
+        out = []
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            out.append((self.bucket_value(idx), seen / total))
+        return out
+
+    def encode(self):
+        return ENCODING_PREFIX + ','.join(
+            '%d:%d' % (idx, self.counts[idx]) for idx in sorted(self.counts))
+
+    @classmethod
+    def decode(cls, encoded):
+        encoded = encoded.strip()
+        if not encoded.startswith(ENCODING_PREFIX):
+            raise ValueError('not an encoded histogram: %r' % encoded[:16])
+        counts = {}
+        for pair in encoded[len(ENCODING_PREFIX):].split(','):
+            if pair:
+                idx, count = pair.split(':')
+                counts[int(idx)] = counts.get(int(idx), 0) + int(count)
+        return cls(counts)
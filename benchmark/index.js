@@ -1,4 +1,4 @@
-const benchmark = require('./benchmark').benchmark;
+const {benchmark, measureStartup} = require('./benchmark');
 
 exports.handler = async (event) => {
     const project = event.project;
@@ -17,6 +17,10 @@ exports.handler = async (event) => {
         error.code = 400;
         throw error;
     }
+    if (test === 'startup' || test === 'compressstats') {
+        return await measureStartup(project, nossl, hostname, service, ver,
+                                    event.isAWS, test);
+    }
     return await benchmark(project, nossl, hostname, service, ver, test,
                            numConns, secs, numRequests, true,
                            event.isAWS);
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""The script generates HTTP load from this machine.
+
+It is a stand-in for the runBenchmark cloud function (benchmark.js) so that
+benchmarks can be run against locally started servers. Its summary line has
+the same format as summarize() in benchmark.js.
+"""
+import argparse
+import asyncio
+import datetime
+import http.client
+import ssl
+import time
+import urllib.parse
+from collections import namedtuple
+
+from histogram import LatencyHistogram
+
+
+REQUEST_TIMEOUT_SECS = 10  # same as autocannon's default
+STARTUP_TIMEOUT_SECS = 60  # a cold start can take much longer
+LoadResult = namedtuple('LoadResult', (
+    'finish', 'service', 'version', 'test', 'conns', 'duration',
+    'num_2xx', 'num_non2xx', 'num_errors', 'num_bytes', 'latencies'))
+
+
+class BadResponse(Exception):
+    """Raised when the server sends a response we cannot parse."""
+
+
+def get_path(test):
+    """Returns the URL path for a test (mirrors benchmark.js)."""
+    # a json test may name its format, like dbjson.orjson.zlib6 (the codec,
+    # then the compressor); other tests may name a compression (get_headers)
+    pieces = test.split('.')
+    if len(pieces) == 3 and pieces[0] not in ('json', 'dbjson'):
+        return get_path(pieces[0])
+    if len(pieces) == 3:
+        path = get_path(pieces[0])
+        query = urllib.parse.urlencode(dict(codec=pieces[1],
+                                            compress=pieces[2]))
+        return path + ('&' if '?' in path else '?') + query
+    if test == 'json':
+        return '/test/dbjson?b=1'
+    if test in ('dataprealloc', 'datastream'):
+        return '/test/data?mode=' + test[4:]
+    if test.startswith('ndbtxtask'):
+        return '/test/' + test[3:]  # txtask or txtaskasync
+    if test.startswith('ndb'):
+        # same url path as db (test URL differs only in version, not path)
+        return '/test/db' + test[3:]
+    return '/test/' + test
+
+
+def get_headers(test):
+    """Returns the headers a test's requests need (mirrors benchmark.js).
+
+    A test like bigjson.gzip.6 asks for its responses to be compressed with
+    gzip (level 6).
+    """
+    pieces = test.split('.')
+    if len(pieces) == 3 and pieces[0] not in ('json', 'dbjson'):
+        return {'Accept-Encoding': pieces[1], 'X-Compress-Level': pieces[2]}
+    return {}
+
+
+async def _read_response(reader):
+    """Reads one HTTP/1.1 response. Returns (status, num bytes, keep-alive)."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    pieces = lines[0].split(' ', 2)
+    if len(pieces) < 2 or not pieces[0].startswith('HTTP/'):
+        raise BadResponse('bad status line: %r' % lines[0])
+    status = int(pieces[1])
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+    num_bytes = len(head)
+    keep_alive = headers.get('connection', '').lower() != 'close'
+    if 'chunk' in headers.get('transfer-encoding', ''):
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            size = int(size_line.split(b';', 1)[0], 16)
+            chunk = await reader.readexactly(size + 2)  # plus trailing CRLF
+            num_bytes += len(size_line) + len(chunk)
+            if not size:
+                break
+    elif 'content-length' in headers:
+        body_sz = int(headers['content-length'])
+        await reader.readexactly(body_sz)
+        num_bytes += body_sz
+    elif status not in (204, 304):
+        num_bytes += len(await reader.read())  # body is delimited by EOF
+        keep_alive = False
+    return status, num_bytes, keep_alive
+
+
+class LoadGenerator:
+    """Keeps `conns` keep-alive connections busy until the test is over."""
+    def __init__(self, url, conns, secs=None, num_requests=None,
+                 headers=None):
+        assert secs or num_requests, 'need a duration or # of requests'
+        parts = urllib.parse.urlsplit(url)
+        self.is_ssl = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.is_ssl else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        all_headers = {'Host': parts.netloc, 'Connection': 'keep-alive'}
+        all_headers.update(headers or {})
+        self.request = ''.join(
+            ['GET %s HTTP/1.1\r\n' % path] +
+            ['%s: %s\r\n' % kv for kv in all_headers.items()] +
+            ['\r\n']).encode('latin-1')
+        self.conns = conns
+        self.secs = secs
+        self.requests_left = num_requests
+        self.deadline = None
+        self.num_2xx = self.num_non2xx = self.num_errors = self.num_bytes = 0
+        self.latencies = []  # millis (successful requests only)
+
+    def _is_done(self):
+        if self.requests_left is not None and self.requests_left <= 0:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    async def _connect(self):
+        ctx = ssl.create_default_context() if self.is_ssl else None
+        return await asyncio.open_connection(self.host, self.port, ssl=ctx)
+
+    async def _run_connection(self):
+        reader = writer = None
+        try:
+            while not self._is_done():
+                if self.requests_left is not None:
+                    self.requests_left -= 1
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.wait_for(
+                            self._connect(), REQUEST_TIMEOUT_SECS)
+                    start = time.monotonic()
+                    writer.write(self.request)
+                    status, num_bytes, keep_alive = await asyncio.wait_for(
+                        _read_response(reader), REQUEST_TIMEOUT_SECS)
+                    latency_millis = (time.monotonic() - start) * 1000
+                except (OSError, EOFError, asyncio.TimeoutError, BadResponse,
+                        asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ValueError):
+                    self.num_errors += 1
+                    keep_alive = False
+                else:
+                    self.num_bytes += num_bytes
+                    if 200 <= status < 300:
+                        self.num_2xx += 1
+                        self.latencies.append(latency_millis)
+                    else:
+                        self.num_non2xx += 1
+                if not keep_alive and writer is not None:
+                    writer.close()
+                    reader = writer = None
+        except asyncio.CancelledError:
+            pass  # the test is over
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def run(self):
+        """Generates load. Returns the test's duration in seconds."""
+        start = time.monotonic()
+        if self.secs:
+            self.deadline = start + self.secs
+        tasks = [asyncio.ensure_future(self._run_connection())
+                 for ignore in range(self.conns)]
+        pending = (await asyncio.wait(tasks, timeout=self.secs))[1]
+        # like autocannon, requests still in flight at the end are ignored
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        return time.monotonic() - start
+
+
+async def benchmark(base_url, service, version, test, num_conns,
+                    duration_secs=None, num_requests=None, headers=None):
+    """Benchmarks a test on the server at base_url."""
+    url = base_url.rstrip('/') + get_path(test)
+    headers = dict(get_headers(test), **(headers or {}))
+    gen = LoadGenerator(url, num_conns, duration_secs, num_requests, headers)
+    duration = await gen.run()
+    return LoadResult(
+        datetime.datetime.now(datetime.timezone.utc), service, version, test,
+        num_conns, duration, gen.num_2xx, gen.num_non2xx, gen.num_errors,
+        gen.num_bytes, sorted(gen.latencies))
+
+
+def measure_startup(base_url, service, version, headers=None,
+                    test='startup'):
+    """Requests /test/startup once (mirrors measureStartup in benchmark.js).
+
+    Returns a tab-separated line with the time to first byte, the total
+    latency, the HTTP status and the server's startup timings (or the
+    response to test, if it names another report like compressstats).
+    """
+    parts = urllib.parse.urlsplit(base_url.rstrip('/') + get_path(test))
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    if parts.scheme == 'https':
+        conn = http.client.HTTPSConnection(parts.netloc,
+                                           timeout=STARTUP_TIMEOUT_SECS)
+    else:
+        conn = http.client.HTTPConnection(parts.netloc,
+                                          timeout=STARTUP_TIMEOUT_SECS)
+    try:
+        start = time.monotonic()
+        conn.request('GET', path, headers=headers or {})
+        resp = conn.getresponse()  # returns once the headers are read
+        ttfb_millis = (time.monotonic() - start) * 1000
+        body = resp.read().decode('utf-8', 'replace')
+        total_millis = (time.monotonic() - start) * 1000
+    finally:
+        conn.close()
+    return '\t'.join(str(x) for x in [
+        datetime.datetime.now(datetime.timezone.utc).strftime(
+            '%a, %d %b %Y %H:%M:%S GMT'),
+        service,
+        version,
+        int(round(ttfb_millis)),
+        int(round(total_millis)),
+        resp.status,
+        ' '.join(body.split()),
+    ])
+
+
+def percentile(sorted_values, pct):
+    """Returns the value at the specified percentile (nearest rank)."""
+    if not sorted_values:
+        return 0
+    idx = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+def summarize(result):
+    """Converts a LoadResult to the tab-separated line from benchmark.js."""
+    # autocannon reports whole seconds and integer latencies
+    duration = max(1, int(round(result.duration)))
+    latencies = [int(round(x)) for x in result.latencies]
+    num_total = result.num_2xx + result.num_non2xx
+    histogram = LatencyHistogram()
+    for millis in result.latencies:
+        histogram.record(millis)
+    return '\t'.join(str(x) for x in [
+        result.finish.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+        result.service,
+        result.version,
+        result.test,
+        result.num_2xx / duration,
+        result.num_bytes / result.duration / 1000,
+        latencies[0] if latencies else 0,
+        percentile(latencies, 50),
+        percentile(latencies, 90),
+        percentile(latencies, 99),
+        result.num_non2xx,
+        duration,
+        (result.num_non2xx / num_total) if num_total else 0,
+        result.num_errors,
+        histogram.encode(),
+    ])
+
+
+def main():
+    """Benchmarks a local server and prints the summary line."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('URL', help='base URL of the server to benchmark')
+    parser.add_argument('--service', default='local',
+                        help='service name to report')
+    parser.add_argument('--version', default='n/a',
+                        help='version name to report')
+    parser.add_argument('--test', default='noop', help='test to run')
+    parser.add_argument('-c', type=int, default=64, dest='conns',
+                        help='# of concurrent connections')
+    parser.add_argument('--secs', type=int, help='how long to run test')
+    parser.add_argument('-n', type=int, dest='num_requests',
+                        help='# of requests to make (instead of --secs)')
+    parser.add_argument('-H', action='append', dest='headers', default=[],
+                        help='extra header like "Name: value"')
+    args = parser.parse_args()
+    if not args.secs and not args.num_requests:
+        parser.error('--secs or -n is required')
+    assert args.conns > 0
+    headers = dict(x.split(':', 1) for x in args.headers)
+    headers = dict((k.strip(), v.strip()) for k, v in headers.items())
+    if args.test in ('startup', 'compressstats'):
+        print(measure_startup(args.URL, args.service, args.version, headers,
+                              args.test))
+        return
+    result = asyncio.run(benchmark(
+        args.URL, args.service, args.version, args.test, args.conns,
+        args.secs, args.num_requests, headers))
+    print(summarize(result))
+
+
+if __name__ == '__main__':
+    main()
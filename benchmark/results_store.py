@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Indexed, append-only store for benchmark results (backed by SQLite).
+
+Each row holds one results line (as written by run.py). Rows are indexed by
+(service, version, test, run timestamp) so resuming a run, aggregating and
+querying historical runs do not need to re-scan every result.
+"""
+import argparse
+import calendar
+from collections import namedtuple
+import datetime
+import email.utils
+import json
+import sqlite3
+import threading
+
+
+COLUMNS = (
+    'utc_str', 'service', 'version', 'test', 'rps', 'kBps', 'lmin', 'l50',
+    'l90', 'l99', 'non2xx', 'secs', 'pct_err', 'conn_err', 'startup_millis',
+    'histogram')
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_ts TEXT NOT NULL,  -- ISO 8601 (UTC) so that it sorts correctly
+    utc_str TEXT NOT NULL,  -- timestamp as reported by the benchmarker
+    service TEXT NOT NULL,
+    version TEXT NOT NULL,
+    test TEXT NOT NULL,
+    rps REAL NOT NULL,
+    kBps REAL NOT NULL,
+    lmin REAL NOT NULL,
+    l50 REAL NOT NULL,
+    l90 REAL NOT NULL,
+    l99 REAL NOT NULL,
+    non2xx INTEGER NOT NULL,
+    secs INTEGER NOT NULL,
+    pct_err REAL NOT NULL,
+    conn_err INTEGER NOT NULL,
+    startup_millis INTEGER NOT NULL,
+    histogram TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_benchmark
+    ON runs (service, version, test, run_ts);
+CREATE INDEX IF NOT EXISTS runs_by_ts ON runs (run_ts);
+CREATE TABLE IF NOT EXISTS cold_starts (
+    id INTEGER PRIMARY KEY,
+    run_ts TEXT NOT NULL,
+    utc_str TEXT NOT NULL,
+    service TEXT NOT NULL,
+    version TEXT NOT NULL,
+    test TEXT NOT NULL,
+    ttfb_millis INTEGER NOT NULL,  -- from the request until its first byte
+    total_millis INTEGER NOT NULL,
+    first_request INTEGER NOT NULL,  -- 0 if the request hit a warm process
+    runtime TEXT,
+    -- the rest are reported by the server (NULL if it could not tell):
+    boot_millis INTEGER,  -- from process start until imports began
+    import_millis INTEGER,  -- from the first import until the last
+    ready_millis INTEGER,  -- from imports done until the request arrived
+    uptime_millis INTEGER  -- from process start until the request arrived
+);
+CREATE INDEX IF NOT EXISTS cold_starts_by_deployment
+    ON cold_starts (service, version, run_ts);
+CREATE TABLE IF NOT EXISTS compress_stats (
+    id INTEGER PRIMARY KEY,
+    run_ts TEXT NOT NULL,
+    utc_str TEXT NOT NULL,
+    service TEXT NOT NULL,
+    version TEXT NOT NULL,
+    test TEXT NOT NULL,  -- the compression run these were fetched after
+    encoding TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    -- the rest are totals since the server process started (see
+    -- /test/compressstats), not just for the run:
+    responses INTEGER NOT NULL,
+    bytes_in INTEGER NOT NULL,
+    bytes_out INTEGER NOT NULL,
+    cpu_millis_per_response REAL NOT NULL,
+    cpu_millis_per_mb REAL
+);
+CREATE INDEX IF NOT EXISTS compress_stats_by_benchmark
+    ON compress_stats (service, version, test, run_ts);
+'''
+COLD_START_COLUMNS = (
+    'utc_str', 'service', 'version', 'test', 'ttfb_millis', 'total_millis',
+    'first_request', 'runtime', 'boot_millis', 'import_millis',
+    'ready_millis', 'uptime_millis')
+ColdStart = namedtuple('ColdStart', COLD_START_COLUMNS)
+# timings reported by the server (see /test/startup)
+SERVER_TIMINGS = ('first_request', 'runtime', 'boot_millis', 'import_millis',
+                  'ready_millis', 'uptime_millis')
+COMPRESS_STATS_COLUMNS = (
+    'utc_str', 'service', 'version', 'test', 'encoding', 'level',
+    'responses', 'bytes_in', 'bytes_out', 'cpu_millis_per_response',
+    'cpu_millis_per_mb')
+CompressStats = namedtuple('CompressStats', COMPRESS_STATS_COLUMNS)
+
+
+def parse_cold_start(line, test):
+    """Parses the line returned by a startup measurement into a ColdStart.
+
+    The line is tab-separated: timestamp, service, version, time to first
+    byte, total latency, HTTP status and the server's JSON startup timings.
+    """
+    pieces = line.rstrip('\n').split('\t')
+    utc_str, service, version, ttfb, total, status, body = pieces
+    if status != '200':
+        raise ValueError('got HTTP %s error: %s' % (status, body))
+    timings = json.loads(body)
+    timings['first_request'] = bool(timings.get('first_request'))
+    return ColdStart(utc_str, service, version, test, int(ttfb), int(total),
+                     *[timings.get(x) for x in SERVER_TIMINGS])
+
+
+def parse_compress_stats(line, test):
+    """Parses the line returned by a request to /test/compressstats.
+
+    The line is formatted like a startup measurement's (the body is the
+    server's JSON compression stats). Returns a CompressStats for each
+    encoding and level the server has compressed responses with.
+    """
+    pieces = line.rstrip('\n').split('\t')
+    utc_str, service, version, ttfb, total, status, body = pieces
+    if status != '200':
+        raise ValueError('got HTTP %s error: %s' % (status, body))
+    return [CompressStats(utc_str, service, version, test, *[
+        x[column] for column in COMPRESS_STATS_COLUMNS[4:]])
+            for x in json.loads(body)['formats']]
+
+
+def is_store_filename(filename):
+    """Returns True if results in filename should be kept in a ResultsStore."""
+    return filename.endswith(('.db', '.sqlite'))
+
+
+def to_iso_timestamp(utc_str):
+    """Converts a timestamp like 'Tue, 26 May 2020 18:37:19 GMT' to ISO."""
+    parsed = email.utils.parsedate(utc_str)
+    if not parsed:
+        raise ValueError('unexpected timestamp: %r' % utc_str)
+    secs = calendar.timegm(parsed)
+    return datetime.datetime.utcfromtimestamp(secs).isoformat()
+
+
+class ResultsStore(object):
+    """An append-only store of results lines.
+
+    It is safe to add results from multiple threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def add_line(self, line):
+        """Adds one results line (tab-separated; see run.py)."""
+        self.add_lines([line])
+
+    def add_lines(self, lines):
+        rows = []
+        for line in lines:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) < len(COLUMNS) - 1:
+                continue  # blank or truncated line
+            columns = columns[:len(COLUMNS)]
+            if len(columns) < len(COLUMNS):
+                columns.append(None)  # older results have no histogram
+            rows.append([to_iso_timestamp(columns[0])] + columns)
+        if not rows:
+            return
+        sql = 'INSERT INTO runs (run_ts, %s) VALUES (%s)' % (
+            ', '.join(COLUMNS), ', '.join(['?'] * (len(COLUMNS) + 1)))
+        with self.lock:
+            with self.conn:  # commits (or rolls back) the transaction
+                self.conn.executemany(sql, rows)
+
+    def add_cold_start(self, cold_start):
+        """Adds one ColdStart."""
+        sql = 'INSERT INTO cold_starts (run_ts, %s) VALUES (%s)' % (
+            ', '.join(COLD_START_COLUMNS),
+            ', '.join(['?'] * (len(COLD_START_COLUMNS) + 1)))
+        row = [to_iso_timestamp(cold_start.utc_str)] + list(cold_start)
+        with self.lock:
+            with self.conn:
+                self.conn.execute(sql, row)
+
+    def add_compress_stats(self, compress_stats):
+        """Adds CompressStats (from parse_compress_stats())."""
+        sql = 'INSERT INTO compress_stats (run_ts, %s) VALUES (%s)' % (
+            ', '.join(COMPRESS_STATS_COLUMNS),
+            ', '.join(['?'] * (len(COMPRESS_STATS_COLUMNS) + 1)))
+        rows = [[to_iso_timestamp(x.utc_str)] + list(x)
+                for x in compress_stats]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(sql, rows)
+
+    def compress_stats(self, since=None):
+        """Returns every CompressStats (fetched at or after since, if any)."""
+        sql = 'SELECT %s FROM compress_stats' % ', '.join(
+            COMPRESS_STATS_COLUMNS)
+        params = []
+        if since:
+            sql += ' WHERE run_ts >= ?'
+            params.append(since)
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY id', params).fetchall()
+        return [CompressStats(*row) for row in rows]
+
+    def cold_start_counts(self):
+        """Returns the # of true cold starts for each (service, version, test)."""
+        with self.lock:
+            cursor = self.conn.execute(
+                'SELECT service, version, test, COUNT(*) FROM cold_starts '
+                'WHERE first_request GROUP BY service, version, test')
+            return dict(((service, version, test), count)
+                        for service, version, test, count in cursor)
+
+    def cold_starts(self, since=None):
+        """Returns every ColdStart (run at or after since, if given)."""
+        sql = 'SELECT %s FROM cold_starts' % ', '.join(COLD_START_COLUMNS)
+        params = []
+        if since:
+            sql += ' WHERE run_ts >= ?'
+            params.append(since)
+        with self.lock:
+            rows = self.conn.execute(sql + ' ORDER BY id', params).fetchall()
+        return [ColdStart(*row) for row in rows]
+
+    def completed_counts(self):
+        """Returns the # of results for each (service, version, test)."""
+        with self.lock:
+            cursor = self.conn.execute(
+                'SELECT service, version, test, COUNT(*) FROM runs '
+                'GROUP BY service, version, test')
+            return dict(((service, version, test), count)
+                        for service, version, test, count in cursor)
+
+    def samples(self, columns):
+        """Returns the values of columns for each (service, version, test).
+
+        The values from each run are a tuple (in the order of columns).
+        """
+        for column in columns:
+            assert column in COLUMNS, 'unknown column: %s' % column
+        out = {}
+        with self.lock:
+            cursor = self.conn.execute(
+                'SELECT service, version, test, %s FROM runs ORDER BY id' % (
+                    ', '.join(columns)))
+            for row in cursor:
+                out.setdefault(tuple(row[:3]), []).append(tuple(row[3:]))
+        return out
+
+    def lines(self, after_id=0, since=None):
+        """Yields (row ID, results line) for results in the order added.
+
+        after_id: only results added after the row with this ID are returned
+        since: only results run at or after this ISO timestamp are returned
+        """
+        sql = 'SELECT id, %s FROM runs WHERE id > ?' % ', '.join(COLUMNS)
+        params = [after_id]
+        if since:
+            sql += ' AND run_ts >= ?'
+            params.append(since)
+        sql += ' ORDER BY id'
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        for row in rows:
+            values = ['' if x is None else str(x) for x in row[1:]]
+            if not values[-1]:
+                values.pop()  # no histogram
+            yield row[0], '\t'.join(values)
+
+    def import_tsv(self, filename):
+        """Adds every results line in a TSV file. Returns the # of lines."""
+        with open(filename, 'r') as fin:
+            lines = [x for x in fin if x.strip()]
+        self.add_lines(lines)
+        return len(lines)
+
+
+def main():
+    """Imports TSV results files into a results store."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('STORE', help='results store filename (e.g., data.db)')
+    parser.add_argument('TSV', nargs='+', help='TSV results file(s) to import')
+    args = parser.parse_args()
+    store = ResultsStore(args.STORE)
+    for fn in args.TSV:
+        print('imported %d results from %s' % (store.import_tsv(fn), fn))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,48 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """The script runs orchestrates the running of benchmarks in parallel."""
 import argparse
+import asyncio
 from collections import defaultdict, namedtuple
+import contextlib
 import datetime
 import json
 import os
 import re
+import signal
 import subprocess
+import sys
 import threading
 import time
-import urlparse
+import traceback
+import urllib.parse
 
-import requests
+import aiohttp
+
+from confidence import SampleSizePolicy
+from results_store import (ResultsStore, is_store_filename, parse_cold_start,
+                           parse_compress_stats)
 
 TESTS = set([
     'noop', 'sleep', 'data', 'memcache', 'dbtx', 'txtask',
     'dbindir', 'dbindirb', 'dbjson', 'json',
 ])
-PY3TESTS = TESTS | set(['ndbtx', 'ndbtxtask', 'ndbindir', 'ndbindirb'])
+PY3TESTS = TESTS | set(['ndbtx', 'ndbtxtask', 'ndbindir', 'ndbindirb',
+                        'txtaskasync', 'ndbtxtaskasync', 'adbindir',
+                        'memcachepipe', 'cachedread', 'dataprealloc',
+                        'datastream', 'bigjson'])
+# tests which are served by another test's version (see tt())
+SHARED_VERSION_TESTS = dict(
+    json='dbjson',
+    txtaskasync='txtask',
+    ndbtxtaskasync='ndbtxtask',
+    adbindir='dbindir',
+    memcachepipe='memcache',
+    cachedread='memcache',
+    dataprealloc='data',
+    datastream='data',
+    bigjson='data',
+)
+ASGI_ONLY_TESTS = set(['adbindir'])
 CLOUD_RUN_MACHINE_TYPES = ('managed',
                            'n1-highcpu-2', 'n2-highcpu-2', 'c2-standard-4')
 ICLASSES = ('f1', 'f2', 'f4')
@@ -28,11 +53,15 @@ PendingRequest = namedtuple('PendingRequest', ('url', 'future'))
 Benchmark = namedtuple('Benchmark', ('service', 'version', 'test'))
 CloudRunBenchmark = namedtuple('CloudRunBenchmark', (
     'service', 'base_url', 'test'))
-DEVNULL = open(os.devnull, 'w')
-FILE_LOCK = threading.Lock()
-PRINT_LOCK = threading.Lock()
-SHUTDOWN_LOCK = threading.Lock()
 KILL_FLAG = False
+RESULTS_STORE = None  # set if results are saved to a ResultsStore
+# metrics whose confidence intervals decide if more runs are needed
+CI_METRICS = ('rps', 'l50')
+SAMPLE_SIZE_POLICY = None  # set if the # of runs is adapted to the noise
+PRIOR_SAMPLES = {}  # results key -> metric -> samples from previous runs
+# max # of benchmarks to run at once on each platform (see QuotaScheduler);
+# a small GKE cluster can only handle one benchmark at a time
+DEFAULT_QUOTAS = dict(gke=1)
 
 FargateBenchmark = namedtuple('FargateBenchmark', (
     'service', 'host', 'test'))
@@ -40,6 +69,24 @@ FARGATE_HOST = 'aws-benchmark.pocketgems.com'
 LAMBDA_TEST_URL = ('https://ldvy1p0dy6.execute-api.us-west-2.amazonaws.com'
                    '/prod/RunBenchmark')
 
+# when set, load is generated from this machine by loadgen.py (instead of by a
+# cloud function) against servers at this URL; it may contain {service},
+# {version} and {test} placeholders
+LOCAL_URL_FMT = None
+# like LOCAL_URL_FMT, but for the ndb tests (which need their own server)
+LOCAL_NDB_URL_FMT = None
+# formats (like orjson.zlib6) to run the json tests with on py3 deployments; a
+# test's format is appended to its name (e.g., dbjson.orjson.zlib6)
+JSON_FORMATS = []
+# response compressions (like gzip.6) to run the COMPRESSIBLE_TESTS with on py3
+# deployments; like formats, they're appended to the test's name (e.g.,
+# bigjson.br.4) and "none" runs the test without compression
+COMPRESSIONS = []
+COMPRESSIBLE_TESTS = ('data', 'dataprealloc', 'bigjson')
+LOADGEN_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                            'loadgen.py')
+INSTANCE_INVENTORY = None  # see get_instance_inventory()
+
 
 
 PY3_ENTRY_TYPES_FOR_WSGI = (
@@ -74,11 +121,28 @@ def is_version_ignored(limit_to_versions, version):
 def tt(test):
     """Transform test name to name used in the version.
 
-    dbjson and json share a version. Don't run them at the same time.
+    Some tests share a version with another test (e.g., dbjson and json).
+    Don't run them at the same time (see get_deployment_key()).
     """
-    if test == 'json':
-        return 'dbjson'
-    return test
+    test = test.split('.', 1)[0]  # no variant (see with_variants())
+    return SHARED_VERSION_TESTS.get(test, test)
+
+
+def with_variants(test):
+    """Returns the tests to run for test on a py3 deployment.
+
+    The json tests are run once for each of JSON_FORMATS and the
+    COMPRESSIBLE_TESTS once for each of COMPRESSIONS (if there are any).
+    """
+    if test in ('json', 'dbjson'):
+        variants = JSON_FORMATS
+    elif test in COMPRESSIBLE_TESTS:
+        variants = COMPRESSIONS
+    else:
+        variants = None
+    if not variants:
+        return [test]
+    return [test if x == 'none' else '%s.%s' % (test, x) for x in variants]
 
 
 CR_URLS = None
@@ -92,7 +156,7 @@ def get_managed_cloud_run_url(service):
             'gcloud', 'beta', 'run', 'services', 'list',
             '--platform', 'managed',
             '--format', 'csv(metadata.name,status.address.url)'])
-        for line in ret.split('\n')[1:]:
+        for line in ret.decode().split('\n')[1:]:
             if not line:
                 continue
             service_id, url = line.split(',')
@@ -111,7 +175,9 @@ def get_benchmarks(tests, limit_to_versions):
             greenlit.append(FargateBenchmark(service, FARGATE_HOST, test))
 
     for machine_type in CLOUD_RUN_MACHINE_TYPES:
-        if machine_type != 'managed':
+        if LOCAL_URL_FMT:
+            cluster_ip = None  # local servers stand in for every cluster
+        elif machine_type != 'managed':
             ip_fn = os.path.join(
                 os.path.abspath(os.path.dirname(__file__)), '../',
                 'platforms/cloud_run/clusterip_%s.txt' % machine_type)
@@ -136,7 +202,12 @@ def get_benchmarks(tests, limit_to_versions):
                         if test == 'memcache':
                             # can't use memcache from CR managed yet
                             continue
-                        base_url = get_managed_cloud_run_url(service)
+                        if LOCAL_URL_FMT:
+                            base_url = LOCAL_URL_FMT
+                        else:
+                            base_url = get_managed_cloud_run_url(service)
+                    elif LOCAL_URL_FMT:
+                        base_url = LOCAL_URL_FMT
                     else:
                         base_url = 'http://' + cluster_ip
                     if base_url and not is_version_ignored(limit_to_versions, service):
@@ -161,18 +232,24 @@ def get_benchmarks(tests, limit_to_versions):
     to_try.extend(PY3_ENTRY_TYPES_FOR_ASGI)
     for test in tests & PY3TESTS:
         for framework_and_entrypoint in to_try:
-            if 'flask' in framework_and_entrypoint and test not in TESTS:
-                continue  # only standard tests for flask
+            if ('flask' in framework_and_entrypoint and
+                    test.startswith('ndb')):
+                continue  # no ndb tests for flask
+            if (test in ASGI_ONLY_TESTS and
+                    framework_and_entrypoint not in PY3_ENTRY_TYPES_FOR_ASGI):
+                continue
             version = '%s-%s' % (framework_and_entrypoint, tt(test))
             if not is_version_ignored(limit_to_versions,
                                       service + '-' + version):
-                greenlit.append(Benchmark(service, version, test))
+                greenlit.extend(Benchmark(service, version, x)
+                                for x in with_variants(test))
     service = 'py38'
-    for test in tests & PY3TESTS:
-        version = 'falcon-gunicorn-gevent1w-%s' % test
+    for test in (tests & PY3TESTS) - ASGI_ONLY_TESTS:
+        version = 'falcon-gunicorn-gevent1w-%s' % tt(test)
         if not is_version_ignored(limit_to_versions,
                                   service + '-' + version):
-            greenlit.append(Benchmark(service, version, test))
+            greenlit.extend(Benchmark(service, version, x)
+                            for x in with_variants(test))
     for test in tests & TESTS:
         for framework in ('express', 'fastify',):
             if framework == 'fastify':
@@ -187,65 +264,269 @@ def get_benchmarks(tests, limit_to_versions):
     return greenlit
 
 
-def run_benchmarks_parallel(results_fn, project, secs, left_by_benchmark):
+def get_results_key(benchmark):
+    """Returns the (service, version, test) recorded in a benchmark's results."""
+    if isinstance(benchmark, CloudRunBenchmark):
+        return Benchmark(benchmark.service, 'n/a', benchmark.test)
+    return benchmark
+
+
+def get_platform_key(benchmark):
+    """Returns the platform (and cluster, if any) a benchmark runs on."""
+    if isinstance(benchmark, FargateBenchmark):
+        return 'fargate'
+    if isinstance(benchmark, CloudRunBenchmark):
+        for machine_type in CLOUD_RUN_MACHINE_TYPES:
+            if benchmark.service.startswith(machine_type + '-'):
+                if machine_type == 'managed':
+                    return 'cr-managed'
+                return 'gke-' + machine_type  # one cluster per machine type
+        raise ValueError('unknown Cloud Run service: ' + benchmark.service)
+    return 'gae'
+
+
+def get_deployment_key(benchmark):
+    """Returns what identifies the deployment which serves a benchmark.
+
+    Tests which share a version (see tt()) and the variants of a test are
+    served by the same deployment.
+    """
+    service = benchmark.service
+    if benchmark.test.split('.', 1)[0] == 'json':
+        service = service.replace('-json', '-dbjson')  # see run_benchmark()
+    return (service, benchmark[1], tt(benchmark.test))
+
+
+class QuotaScheduler(object):
+    """Limits how many benchmarks run at once.
+
+    A quota limits how many benchmarks may run on a platform at once. Quotas
+    are keyed by platform key (e.g., "gke-n1-highcpu-2") or by the platform
+    family before its first dash (e.g., "gke" applies to every GKE cluster).
+    Platforms without a quota are unlimited. max_parallel (if any) limits the
+    total across all platforms.
+    """
+    def __init__(self, quotas, max_parallel=None):
+        self.quotas = quotas
+        self.semaphores = {}  # platform key -> semaphore (if limited)
+        self.overall = asyncio.Semaphore(max_parallel) if max_parallel else None
+
+    def get_quota(self, platform_key):
+        if platform_key in self.quotas:
+            return self.quotas[platform_key]
+        return self.quotas.get(platform_key.split('-', 1)[0])
+
+    def _get_semaphore(self, platform_key):
+        if platform_key not in self.semaphores:
+            quota = self.get_quota(platform_key)
+            self.semaphores[platform_key] = (
+                asyncio.Semaphore(quota) if quota else None)
+        return self.semaphores[platform_key]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, benchmark):
+        """Waits until the benchmark may run (and holds its slot until done)."""
+        # the platform's slot is acquired first so benchmarks waiting on a
+        # busy platform don't hold up the overall limit
+        async with contextlib.AsyncExitStack() as stack:
+            for semaphore in (self._get_semaphore(get_platform_key(benchmark)),
+                              self.overall):
+                if semaphore:
+                    await stack.enter_async_context(semaphore)
+            yield
+
+
+async def run_benchmarks_parallel(results_fn, project, secs, left_by_benchmark,
+                                  quotas=None, max_parallel=None,
+                                  runner=None):
     """Runs each benchmark the specified number of times.
 
+    Benchmarks are run concurrently (up to max_parallel at once, if given),
+    subject to the per-platform quotas (see QuotaScheduler). Ctrl-C cancels
+    all in-flight work.
+
     Results will be saved to results_fn (if provided). Otherwise results
     will be printed to stdout.
+
+    runner runs a benchmark (run_benchmark by default).
     """
-    global KILL_FLAG  # pylint: disable=global-statement
-    threads = [
-        threading.Thread(target=run_benchmark, kwargs=dict(
-            benchmark=benchmark,
-            secs=secs,
-            project=project,
-            num_left=num_left,
-            results_fn=results_fn))
-        for benchmark, num_left in left_by_benchmark.iteritems()]
-    start_needed = True
-    threads_left = []
-    prev_num_left = None
-    while start_needed or threads_left:
-        try:
-            if start_needed:
-                start_needed = False
-                for thread in threads:
-                    threads_left.append(thread)
-                    thread.start()
-            else:
-                for thread in threads_left[:]:
-                    thread.join(timeout=0)
-                    if not thread.is_alive():
-                        threads_left.remove(thread)
-            if threads_left:
-                if KILL_FLAG:
-                    if len(threads_left) != prev_num_left:
-                        prev_num_left = len(threads_left)
-                        log('    still waiting on %d threads ...',
-                            prev_num_left)
-                time.sleep(3)
-        except (KeyboardInterrupt, SystemExit):
-            if not KILL_FLAG:
-                KILL_FLAG = True
-                prev_num_left = len(threads_left)
-                log('\nShutting down: %d threads left ...', prev_num_left)
-
-
-def run_benchmarks_sequential(results_fn, project, secs, left_by_benchmark):
-    """Single-threaded sequential version of run_benchmarks_parallel."""
-    items = sorted(left_by_benchmark.iteritems())
-    for i, (benchmark, num_left) in enumerate(items):
-        print 'running benchmark %d of %d' % (i + 1, len(left_by_benchmark))
-        run_benchmark(benchmark=benchmark,
-                      secs=secs,
-                      project=project,
-                      num_left=num_left,
-                      results_fn=results_fn,
-                      exceptions_left=20)
-
-
-def run_benchmark(benchmark, secs, project, num_left, results_fn,
-                  exceptions_left=5):
+    scheduler = QuotaScheduler(quotas or {}, max_parallel)
+    runner = runner or run_benchmark
+    # benchmarks served by the same deployment (e.g., json and dbjson, or a
+    # json test in each of JSON_FORMATS) take turns so that they don't skew
+    # each other's results; other benchmarks aren't held up
+    deployment_locks = defaultdict(asyncio.Lock)
+
+    async def run_when_scheduled(benchmark, num_left):
+        async with deployment_locks[get_deployment_key(benchmark)]:
+            async with scheduler.slot(benchmark):
+                await runner(benchmark=benchmark,
+                             secs=secs,
+                             project=project,
+                             num_left=num_left,
+                             results_fn=results_fn)
+
+    tasks = [asyncio.ensure_future(run_when_scheduled(benchmark, num_left))
+             for benchmark, num_left in sorted(left_by_benchmark.items())
+             if num_left > 0]
+    await run_until_done_or_killed(tasks)
+
+
+async def run_benchmarks_sequential(results_fn, project, secs,
+                                    left_by_benchmark, runner=None):
+    """Sequential version of run_benchmarks_parallel."""
+    runner = runner or run_benchmark
+
+    async def run_all():
+        items = sorted(left_by_benchmark.items())
+        for i, (benchmark, num_left) in enumerate(items):
+            print('running benchmark %d of %d' % (i + 1,
+                                                  len(left_by_benchmark)))
+            await runner(benchmark=benchmark,
+                         secs=secs,
+                         project=project,
+                         num_left=num_left,
+                         results_fn=results_fn,
+                         exceptions_left=20)
+    await run_until_done_or_killed([asyncio.ensure_future(run_all())])
+
+
+async def run_until_done_or_killed(tasks):
+    """Waits for tasks to finish. On Ctrl-C, cancels them immediately."""
+    def kill():
+        global KILL_FLAG  # pylint: disable=global-statement
+        if KILL_FLAG:
+            return
+        KILL_FLAG = True
+        num_left = sum(1 for task in tasks if not task.done())
+        log('\nShutting down: cancelling %d benchmarks ...', num_left)
+        for task in tasks:
+            task.cancel()
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGINT, kill)
+    loop.add_signal_handler(signal.SIGTERM, kill)
+    try:
+        async with http_session():
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+        loop.remove_signal_handler(signal.SIGTERM)
+    # a task which failed (rather than being cancelled) must not go unnoticed
+    for result in results:
+        if (isinstance(result, BaseException) and
+                not isinstance(result, asyncio.CancelledError)):
+            log('task failed: %s', ''.join(traceback.format_exception(
+                type(result), result, result.__traceback__)).rstrip())
+
+
+async def check_output(cmd):
+    """Runs cmd and returns its output. The process is killed if cancelled."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        out = (await proc.communicate())[0]
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out.decode()
+
+
+class InstanceInventory(object):
+    """Tracks which GAE instances are running and shuts them down.
+
+    Every instance in the project is listed with one gcloud call, and the
+    listing is shared by all benchmarks until it is more than max_age_secs
+    old. Instances are shut down concurrently (up to max_concurrent_deletes
+    at once across all benchmarks).
+    """
+    def __init__(self, max_age_secs=15, max_concurrent_deletes=16):
+        self.max_age_secs = max_age_secs
+        self.instances = {}  # (service, version) -> instance IDs
+        self.refreshed_at = None
+        self.refresh_lock = asyncio.Lock()
+        self.delete_semaphore = asyncio.Semaphore(max_concurrent_deletes)
+        # instances being (or recently) shut down may still be listed for a
+        # little while; they are omitted so they aren't deleted twice
+        self.deleted = set()
+
+    def _is_stale(self, listed_after=None):
+        if self.refreshed_at is None:
+            return True
+        if listed_after and self.refreshed_at < listed_after:
+            return True
+        return time.time() - self.refreshed_at > self.max_age_secs
+
+    async def refresh(self, listed_after=None):
+        """Lists every instance (unless the listing is still fresh)."""
+        async with self.refresh_lock:
+            if not self._is_stale(listed_after):
+                return  # another benchmark just refreshed it
+            started_at = time.time()
+            out = await check_output([
+                'gcloud', 'app', 'instances', 'list',
+                '--format', 'csv[no-heading](service,version,id)'])
+            instances = {}
+            for line in out.split('\n'):
+                if not line:
+                    continue
+                service, version, iid = line.split(',')
+                if (service, version, iid) not in self.deleted:
+                    instances.setdefault((service, version), []).append(iid)
+            self.instances = instances
+            self.refreshed_at = started_at
+
+    async def get_instances(self, service, version, listed_after=None):
+        """Returns the IDs of a version's running instances.
+
+        listed_after: if given, the instances must have been listed after this
+        time (e.g., so that an instance started then is included)
+        """
+        if self._is_stale(listed_after):
+            await self.refresh(listed_after)
+        return list(self.instances.get((service, version), []))
+
+    async def _delete(self, service, version, iid):
+        async with self.delete_semaphore:
+            await check_output([
+                'gcloud', 'app', 'instances', 'delete', iid,
+                '--service', service, '--version', version, '--quiet'])
+
+    async def reset(self, versions, listed_after=None):
+        """Shuts down every instance of each (service, version) in versions.
+
+        Returns the IDs of the instances which were shut down.
+        """
+        to_delete = []
+        for service, version in versions:
+            for iid in await self.get_instances(service, version,
+                                                listed_after):
+                to_delete.append((service, version, iid))
+        self.deleted.update(to_delete)
+        for service, version in versions:
+            self.instances.pop((service, version), None)
+        results = await asyncio.gather(
+            *[self._delete(*x) for x in to_delete], return_exceptions=True)
+        for x, result in zip(to_delete, results):
+            if isinstance(result, BaseException):
+                self.deleted.discard(x)  # it may still be running
+                raise result
+        return [iid for ignore, ignore, iid in to_delete]
+
+
+def get_instance_inventory():
+    """Returns the InstanceInventory shared by every benchmark."""
+    global INSTANCE_INVENTORY  # pylint: disable=global-statement
+    if INSTANCE_INVENTORY is None:
+        INSTANCE_INVENTORY = InstanceInventory()
+    return INSTANCE_INVENTORY
+
+
+async def run_benchmark(benchmark, secs, project, num_left, results_fn,
+                        exceptions_left=5):
     """Runs a single benchmark the specified number of times."""
     orig_exceptions_left = exceptions_left
     service = benchmark.service
@@ -254,6 +535,8 @@ def run_benchmark(benchmark, secs, project, num_left, results_fn,
         service = service.replace('-json', '-dbjson')
     version = getattr(benchmark, 'version', '')  # only present for GAE bmarks
     is_gae = bool(version)
+    # json and dbjson (and their formats) but not, e.g., bigjson
+    is_json_test = tt(test) == 'dbjson'
 
     one_request_benchmarker_url = BENCHMARKER_URL_FMT % (
         project, project, 60, 'noop', service, version, 1) + '&n=1'
@@ -261,14 +544,17 @@ def run_benchmark(benchmark, secs, project, num_left, results_fn,
         project, project, secs, test, service, version,
         # dbjson is a memory (and cpu) hog, so we can max it out and not blow
         # up memory by limiting connections
-        88 if 'json' not in test else (2 if is_gae else 5))
+        88 if not is_json_test else (2 if is_gae else 5))
+    # how much CPU compressing took is only known by the server
+    compression = get_compression(test)
+    compress_stats_url = BENCHMARKER_URL_FMT % (
+        project, project, 60, 'compressstats', service, version, 1) + '&n=1'
 
-    if is_gae:
-        cmd = 'gcloud app instances %%s --service %s --version %s' % (
-            service, version)
-        list_cmd = (cmd % 'list').split()
-        delete_cmd = ((cmd % 'delete') + ' --quiet').split()
-    else:
+    if is_gae and LOCAL_URL_FMT:
+        is_gae = False  # no GAE instances to shut down
+    elif is_gae:
+        inventory = get_instance_inventory()
+    if not is_gae:
         base_url = getattr(benchmark, 'base_url', 'https://fargatePlaceholder')
         scheme, hostname = base_url.split('://', 1)
         extra_qs = '&hostname=' + hostname
@@ -276,34 +562,28 @@ def run_benchmark(benchmark, secs, project, num_left, results_fn,
             extra_qs += '&nossl=1'
         one_request_benchmarker_url += extra_qs
         full_test_benchmarker_url += extra_qs
+        compress_stats_url += extra_qs
 
-    context = 'service=%-6s version=%-36s test=%-7s    ' % (
-        service, version, test)
-    pad_sz = max(0, 76 - len(context))
-    if pad_sz:
-        context += (' ' * pad_sz)
+    context = get_log_context(service, version, test)
     my_log = lambda s, *args: log(context + s, *args)
+    samples = dict((k, list(v)) for k, v in PRIOR_SAMPLES.get(
+        get_results_key(benchmark), {}).items())
+    last_request_at = None  # when this benchmark last sent a request
     while num_left > 0 and not KILL_FLAG:
         try:
             if is_gae:
-                # shut down the current instance, if any
-                my_log('listing instances')
-                out = subprocess.check_output(list_cmd, stderr=DEVNULL)
-                if out:
-                    rows = out.split('\n')
-                    iid_idx = rows[0].split().index('ID')
-                    iid = rows[1].split()[iid_idx]
-                    my_log('shutting down %s', iid)
-                    with SHUTDOWN_LOCK:
-                        subprocess.check_call(delete_cmd + [iid],
-                                              stderr=DEVNULL, stdout=DEVNULL)
-                    my_log('shuttdown down %s', iid)
+                # shut down the current instance(s), if any
+                iids = await inventory.reset([(service, version)],
+                                             last_request_at)
+                if iids:
+                    my_log('shut down %s', ', '.join(iids))
 
             # measure time for a single request to be served (startup latency)
             # note: this request is for the no-op url (not measuring processing
             #       time here, just startup time)
             my_log('warming up')
-            resp = make_request(benchmark, one_request_benchmarker_url)
+            resp = await make_request(benchmark, one_request_benchmarker_url)
+            last_request_at = time.time()
             if resp.status_code != 200:
                 raise Exception('got HTTP %d error' % resp.status_code)
             x = resp.content.split('\t')
@@ -314,77 +594,292 @@ def run_benchmark(benchmark, secs, project, num_left, results_fn,
 
             # dbjson test requires a special request to first load the JSON
             # data from disk
-            if 'json' in test:
+            if is_json_test:
                 dbjson_url = one_request_benchmarker_url.replace(
                     '/test/noop', '/test/dbjson')
-                make_request(benchmark, dbjson_url)  # ignore response
-                resp = make_request(benchmark, dbjson_url)  # ignore response
+                await make_request(benchmark, dbjson_url)  # ignore response
+                resp = await make_request(benchmark, dbjson_url)
                 if resp.status_code != 200:
                     raise Exception(
                         'got HTTP %d error while preparing %s' % (
                             resp.status_code, test))
 
             # run the benchmark
-            resp = make_request(benchmark, full_test_benchmarker_url)
+            resp = await make_request(benchmark, full_test_benchmarker_url)
+            last_request_at = time.time()
             if resp.status_code != 200:
                 raise Exception('got HTTP %d error' % resp.status_code)
-            results_line = resp.content + '\t' + startup_millis
-            my_log('%d left; output: %s', num_left - 1, results_line)
+            # the startup latency goes after the summary (and before the
+            # latency histogram, if any)
+            x = resp.content.split('\t')
+            results_line = '\t'.join(x[:14] + [startup_millis] + x[14:])
+            my_log('%d left; output: %s', num_left - 1,
+                   '\t'.join(x[:14] + [startup_millis]))
 
             # record the results
-            if results_fn:
-                with FILE_LOCK:
-                    with open(results_fn, 'a', buffering=0) as fout:
-                        print >> fout, results_line
+            if RESULTS_STORE:
+                RESULTS_STORE.add_line(results_line)
+            elif results_fn:
+                with open(results_fn, 'a') as fout:
+                    print(results_line, file=fout)
             num_left -= 1
             exceptions_left = orig_exceptions_left  # refill on success
-        except Exception, e:  # pylint: disable=broad-except
-            log('EXCEPTION in thread (%s): %s', context, e)
+            if compression:
+                await record_compress_stats(benchmark, compress_stats_url,
+                                            test, compression, my_log)
+            samples.setdefault('rps', []).append(float(x[4]))
+            samples.setdefault('l50', []).append(float(x[7]))
+            if (num_left and SAMPLE_SIZE_POLICY and
+                    not SAMPLE_SIZE_POLICY.wants_more(samples)):
+                my_log('stopping early: confidence intervals are narrow')
+                break
+        except asyncio.CancelledError:
+            raise  # a subclass of Exception before python 3.8
+        except Exception as e:  # pylint: disable=broad-except
+            log('EXCEPTION in task (%s): %s', context, e)
             exceptions_left -= 1
             if exceptions_left <= 0:
                 log('giving up on %s', context)
                 break
-            time.sleep(30)
+            await asyncio.sleep(30)
+
+
+def get_compression(test):
+    """Returns (encoding, level) if test is run with compression, else None.
+
+    For example, bigjson.br.4 is compressed with brotli at level 4.
+    """
+    pieces = test.split('.')
+    if len(pieces) != 3 or pieces[0] not in COMPRESSIBLE_TESTS:
+        return None
+    return pieces[1], int(pieces[2])
+
+
+async def record_compress_stats(benchmark, url, test, compression, my_log):
+    """Records how much CPU the server spent compressing test's responses.
+
+    The server's stats are totals since its process started (and a request
+    may be served by a different instance than the benchmark's), so they
+    are a snapshot rather than the cost of the run alone. Failing to get
+    them is logged but doesn't fail the benchmark.
+    """
+    try:
+        resp = await make_request(benchmark, url)
+        if resp.status_code != 200:
+            raise Exception('got HTTP %d error' % resp.status_code)
+        rows = [x for x in parse_compress_stats(resp.content, test)
+                if (x.encoding, x.level) == compression]
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:  # pylint: disable=broad-except
+        my_log('failed to get compression stats: %s', e)
+        return
+    if not rows:
+        my_log('no compression stats for %s.%d '
+               '(is COMPRESS_ENCODINGS set?)', *compression)
+    elif RESULTS_STORE:
+        RESULTS_STORE.add_compress_stats(rows)
+    for row in rows:
+        my_log('compression: %d responses, %.3f cpu millis each',
+               row.responses, row.cpu_millis_per_response)
+
+
+def can_force_cold_start(benchmark):
+    """Returns True if the benchmark's instances can be shut down on demand.
+
+    Only GAE instances can be (Cloud Run and Fargate scale to zero on their
+    own schedule). The py27 runtime doesn't report its startup timings.
+    Locally, there are no instances to shut down (restarting the servers is
+    up to you), but cold starts are still only recorded for GAE benchmarks
+    (the others have no version to record them under).
+    """
+    if not isinstance(benchmark, Benchmark):
+        return False
+    return bool(LOCAL_URL_FMT) or benchmark.service != 'py27'
+
+
+async def run_cold_starts(benchmark, secs, project, num_left, results_fn,
+                          exceptions_left=5):
+    """Forces a deployment to cold start the specified number of times.
+
+    Each time, the deployment's instances are shut down and then a request
+    to /test/startup starts a new one. The time until its first byte and the
+    time each phase of its startup took (as reported by the server) are
+    recorded.
+    """
+    del secs  # cold starts are measured with a single request
+    orig_exceptions_left = exceptions_left
+    service, version, test = benchmark
+    startup_benchmarker_url = BENCHMARKER_URL_FMT % (
+        project, project, 60, 'startup', service, version, 1) + '&n=1'
+    inventory = None if LOCAL_URL_FMT else get_instance_inventory()
+    context = get_log_context(service, version, test)
+    my_log = lambda s, *args: log(context + s, *args)
+    last_request_at = None
+    while num_left > 0 and not KILL_FLAG:
+        try:
+            if inventory:
+                iids = await inventory.reset([(service, version)],
+                                             last_request_at)
+                if iids:
+                    my_log('shut down %s', ', '.join(iids))
+            resp = await make_request(benchmark, startup_benchmarker_url)
+            last_request_at = time.time()
+            if resp.status_code != 200:
+                raise Exception('got HTTP %d error' % resp.status_code)
+            cold_start = parse_cold_start(resp.content, test)
+            if RESULTS_STORE:
+                RESULTS_STORE.add_cold_start(cold_start)
+            else:
+                print('\t'.join(str(x) for x in cold_start))
+            if not cold_start.first_request:
+                if not LOCAL_URL_FMT:
+                    raise Exception('request was served by a warm instance')
+                # local servers are only restarted if you restart them
+                my_log('request was served by a warm process')
+            num_left -= 1
+            exceptions_left = orig_exceptions_left  # refill on success
+            my_log('%d left; first byte after %dms (%s boot=%s import=%s '
+                   'ready=%s)', num_left, cold_start.ttfb_millis,
+                   cold_start.runtime, cold_start.boot_millis,
+                   cold_start.import_millis, cold_start.ready_millis)
+        except asyncio.CancelledError:
+            raise  # a subclass of Exception before python 3.8
+        except Exception as e:  # pylint: disable=broad-except
+            log('EXCEPTION in task (%s): %s', context, e)
+            exceptions_left -= 1
+            if exceptions_left <= 0:
+                log('giving up on %s', context)
+                break
+            await asyncio.sleep(30)
+
+
+def get_log_context(service, version, test):
+    """Returns the prefix for log messages about a benchmark."""
+    context = 'service=%-6s version=%-36s test=%-7s    ' % (
+        service, version, test)
+    pad_sz = max(0, 76 - len(context))
+    if pad_sz:
+        context += (' ' * pad_sz)
+    return context
 
 
 FakeResp = namedtuple('FakeResp', ('content', 'status_code'))
+# benchmarks can run for up to 5 minutes (longer than aiohttp's default
+# timeout), so only give up if the connection goes quiet for too long
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=600)
+# requests to the benchmarker share one pool of keep-alive connections (see
+# http_session) so each request doesn't pay for a new TLS handshake
+HTTP_SESSION = None
+HTTP_KEEPALIVE_SECS = 300  # must outlast the 30sec pause after errors
+LAMBDA_CLIENT = None
+LAMBDA_CLIENT_LOCK = threading.Lock()
+
+
+@contextlib.asynccontextmanager
+async def http_session():
+    """Opens the connection pool used by make_request (for this event loop)."""
+    global HTTP_SESSION  # pylint: disable=global-statement
+    # every benchmark may have a request in flight at once; limit=0 means no
+    # limit (aiohttp's default would queue requests beyond 100)
+    connector = aiohttp.TCPConnector(limit=0,
+                                     keepalive_timeout=HTTP_KEEPALIVE_SECS)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=HTTP_TIMEOUT) as session:
+        HTTP_SESSION = session
+        try:
+            yield session
+        finally:
+            HTTP_SESSION = None
 
 
-def make_request(benchmark, url):
+async def make_request(benchmark, url):
     """Makes a request to the appropriate benchmarking cloud function."""
+    if LOCAL_URL_FMT:
+        return await make_local_request(url)
     if not isinstance(benchmark, FargateBenchmark):
         # url defaults to GCP
-        return requests.get(url)
+        async with HTTP_SESSION.get(url) as resp:
+            return FakeResp(await resp.text(), resp.status)
     # need to make a different request to benchmark with Lambda
     qparams = url[url.index('?') + 1:]
-    d = dict((k, v[0]) for k, v in urlparse.parse_qs(qparams).iteritems())
+    d = dict((k, v[0]) for k, v in urllib.parse.parse_qs(qparams).items())
     d['isAWS'] = True
     d['hostname'] = benchmark.host
     if d['test'] == 'sleep':
         d['c'] = 250
     # use the SDK to invoke the lambda function because the AWS Gateway for
-    # invoking Lambda via HTTP has a 30sec timeout (too short for our tests)
-    import boto3
-    from botocore.client import Config
-    config = Config(read_timeout=600, retries=dict(max_attempts=0))
-    client = boto3.client('lambda', config=config)
-    resp = client.invoke(
+    # invoking Lambda via HTTP has a 30sec timeout (too short for our tests);
+    # the SDK is synchronous, so it is run on a thread
+    return await asyncio.get_event_loop().run_in_executor(
+        None, invoke_lambda, d)
+
+
+def get_lambda_client():
+    """Returns the (shared) client used to invoke Lambda functions.
+
+    boto3 clients are thread-safe, so every executor thread shares one client
+    (and its pool of keep-alive connections).
+    """
+    global LAMBDA_CLIENT  # pylint: disable=global-statement
+    with LAMBDA_CLIENT_LOCK:
+        if LAMBDA_CLIENT is None:
+            import boto3
+            from botocore.client import Config
+            config = Config(read_timeout=600, retries=dict(max_attempts=0),
+                            max_pool_connections=100)
+            LAMBDA_CLIENT = boto3.client('lambda', config=config)
+        return LAMBDA_CLIENT
+
+
+def invoke_lambda(payload):
+    """Invokes the Lambda function which runs benchmarks on AWS."""
+    resp = get_lambda_client().invoke(
         FunctionName='run-benchmark',
         LogType='None',
-        Payload=json.dumps(d),
+        Payload=json.dumps(payload),
     )
     if resp['StatusCode'] != 200:
         return FakeResp(json.dumps(resp), resp['StatusCode'])
     return FakeResp(json.loads(resp['Payload'].read()), resp['StatusCode'])
 
 
+async def make_local_request(url):
+    """Generates load locally with loadgen.py (instead of a cloud function).
+
+    url is the cloud function URL which would otherwise have been requested;
+    its query parameters describe the benchmark to run.
+    """
+    qparams = url[url.index('?') + 1:]
+    d = dict((k, v[0]) for k, v in urllib.parse.parse_qs(qparams).items())
+    url_fmt = LOCAL_URL_FMT
+    if LOCAL_NDB_URL_FMT and d['test'].startswith('ndb'):
+        url_fmt = LOCAL_NDB_URL_FMT
+    base_url = url_fmt.format(service=d['service'],
+                              version=d.get('version', ''),
+                              test=d['test'])
+    cmd = [sys.executable, LOADGEN_PATH, base_url,
+           '--service', d['service'],
+           '--version', d.get('version') or 'n/a',
+           '--test', d['test'],
+           '-c', d['c']]
+    if 'n' in d:
+        cmd.extend(['-n', d['n']])
+    else:
+        cmd.extend(['--secs', d['secs']])
+    try:
+        out = await check_output(cmd)
+    except subprocess.CalledProcessError:
+        return FakeResp('loadgen.py failed', 500)
+    return FakeResp(out.strip(), 200)
+
+
 def log(s, *args):
-    """Prints to standard out. A lock synchronizes thread output."""
+    """Prints to standard out."""
     if args:
         s = s % args
     now = datetime.datetime.now().strftime('%H:%M:%S')
-    with PRINT_LOCK:
-        print now, s
+    print(now, s, flush=True)
 
 
 def main():
@@ -393,66 +888,147 @@ def main():
     parser.add_argument('PROJECT', help='GCP project ID')
     parser.add_argument('--filter', action='append', dest='filters',
                         help='regex of services to include')
-    parser.add_argument('-n', type=int, help='# of times to run each test',
+    parser.add_argument('-n', type=int, help='# of times to run each test '
+                        '(the most times if --target-ci is passed)',
                         default=1)
+    parser.add_argument('--target-ci', type=float, metavar='FRACTION',
+                        help='stop running a test once the 95%% confidence '
+                        'intervals of its mean rps and p50 latency are '
+                        'narrower than +/- this fraction of their means')
+    parser.add_argument('--min-runs', type=int, default=3,
+                        help='# of runs required before --target-ci can stop '
+                        'a test')
     parser.add_argument('--continue', dest='results_fn',
-                        help='file to save results & pick up from if resuming')
+                        help='file to save results & pick up from if resuming '
+                        '(a results store if it ends with .db, else TSV)')
     parser.add_argument('--secs', type=int, help='how long to run test',
                         default=60)
     parser.add_argument('--dry-run', action='store_true',
                         help='if passed, benchmarks will be printed, not run')
     parser.add_argument('--sequential', action='store_true',
                         help='run benchmarks sequentially (not in parallel)')
+    parser.add_argument('--max-parallel', type=int, metavar='N',
+                        help='max # of benchmarks to run at once (default: '
+                        'no limit other than the platform quotas)')
+    parser.add_argument('--quota', action='append', dest='quotas',
+                        default=[], metavar='PLATFORM=N',
+                        help='max # of benchmarks to run at once on a '
+                        'platform; PLATFORM is gae, cr-managed, fargate, gke '
+                        '(each GKE cluster) or gke-MACHINE_TYPE (default: '
+                        '%s)' % ' '.join('%s=%d' % x
+                                         for x in DEFAULT_QUOTAS.items()))
     parser.add_argument('--test', action='append', dest='tests',
                         choices=PY3TESTS | set(['all']),
                         help='which tests to run; omit to run all except data')
+    parser.add_argument('--json-format', action='append',
+                        dest='json_formats', default=[],
+                        metavar='CODEC.COMPRESSOR',
+                        help='run the json tests on py3 deployments with this '
+                        'format (e.g., orjson.zlib6 or msgpack.none; see '
+                        'jsoncodecs.py) instead of their default format')
+    parser.add_argument('--compress', action='append', dest='compressions',
+                        default=[], metavar='ENCODING.LEVEL',
+                        help='run the %s tests on py3 deployments with '
+                        'their responses compressed like this (e.g., gzip.6, '
+                        'br.4 or zstd.3; "none" for uncompressed; the apps '
+                        'must be deployed with COMPRESS_ENCODINGS set)' % (
+                            '/'.join(COMPRESSIBLE_TESTS)))
+    parser.add_argument('--cold-start', type=int, metavar='N',
+                        help='instead of running tests, force N cold starts '
+                        'of each (GAE) deployment and record how long each '
+                        'phase of startup took (requires a .db results '
+                        'store if --continue is passed)')
+    parser.add_argument('--local', metavar='URL',
+                        help='generate load from this machine against the '
+                        'server(s) at URL (may contain {service}, {version} '
+                        'and {test} placeholders)')
+    parser.add_argument('--local-ndb', metavar='URL',
+                        help='like --local, but for the ndb tests (default: '
+                        'the --local URL; see platforms/local/start.sh)')
     args = parser.parse_args()
+    # pylint: disable=global-statement
+    global COMPRESSIONS, JSON_FORMATS, LOCAL_NDB_URL_FMT, LOCAL_URL_FMT
+    global RESULTS_STORE, SAMPLE_SIZE_POLICY
+    if args.local_ndb and not args.local:
+        parser.error('--local-ndb requires --local')
+    LOCAL_URL_FMT = args.local
+    LOCAL_NDB_URL_FMT = args.local_ndb
+    for fmt in args.json_formats:
+        if len(fmt.split('.')) != 2 or not all(fmt.split('.')):
+            parser.error('--json-format must be like CODEC.COMPRESSOR')
+    JSON_FORMATS = args.json_formats
+    for compression in args.compressions:
+        pieces = compression.split('.')
+        if compression != 'none' and (
+                len(pieces) != 2 or not pieces[0] or not pieces[1].isdigit()):
+            parser.error('--compress must be like ENCODING.LEVEL (or none)')
+    COMPRESSIONS = args.compressions
+    if (args.cold_start and args.results_fn and
+            not is_store_filename(args.results_fn)):
+        parser.error('--cold-start results can only be saved to a .db '
+                     'results store')
+    if args.target_ci and not args.cold_start:
+        SAMPLE_SIZE_POLICY = SampleSizePolicy(args.target_ci, args.min_runs)
     limit_to_versions = [
         dict(used=False, regex=re.compile(x))
         for x in args.filters] if args.filters else None
     secs = args.secs
     assert args.secs > 0
-    assert args.secs <= 290  # limited to 5min runtime on cloud functions
+    if not args.local:
+        assert args.secs <= 290  # limited to 5min runtime on cloud functions
     if not args.tests:
-        tests = set(PY3TESTS) - set(['data', 'json'])
+        tests = set(PY3TESTS) - set(['data']) - set(SHARED_VERSION_TESTS)
     elif args.tests[0] == 'all':
         tests = set(PY3TESTS)
     else:
         tests = set(args.tests)
-    if 'json' in tests and 'dbjson' in tests:
-        print 'not running json test at same time as dbjson'
-        tests.remove('json')
-    num_runs = args.n
+    num_runs = args.cold_start or args.n
     assert num_runs >= 1
 
     # figure out which benchmarks this test includes
     benchmarks = get_benchmarks(tests, limit_to_versions)
+    if args.cold_start:
+        benchmarks = [x for x in benchmarks if can_force_cold_start(x)]
     bad_filter = False
     for i, x in enumerate(limit_to_versions or []):
         if not x['used']:
-            print 'regex matched nothing: ', args.filters[i]
+            print('regex matched nothing: ', args.filters[i])
             bad_filter = True
     if bad_filter:
-        import sys
         sys.exit(1)
-    print '%d benchmarks to run (%d times each)' % (
-        len(benchmarks), num_runs)
+    print('%d benchmarks to run (%d times each)' % (
+        len(benchmarks), num_runs))
     if args.dry_run:
         for x in benchmarks:
-            print x
+            print(x)
         return
     elif len(benchmarks):
         time.sleep(3)
+    if not LOCAL_URL_FMT and any(isinstance(x, FargateBenchmark)
+                                 for x in benchmarks):
+        get_lambda_client()  # so its setup isn't part of the first benchmark
 
     # figure out how many runs if each test is needed
     completed_count = defaultdict(int)
-    if args.results_fn:
+    if args.results_fn and is_store_filename(args.results_fn):
+        RESULTS_STORE = ResultsStore(args.results_fn)
+        if args.cold_start:
+            counts = RESULTS_STORE.cold_start_counts()
+        else:
+            counts = RESULTS_STORE.completed_counts()
+        for uid, count in counts.items():
+            completed_count[Benchmark(*uid)] += count
+        if SAMPLE_SIZE_POLICY:
+            for uid, rows in RESULTS_STORE.samples(CI_METRICS).items():
+                PRIOR_SAMPLES[Benchmark(*uid)] = dict(zip(CI_METRICS,
+                                                          zip(*rows)))
+    elif args.results_fn:
         if not os.path.exists(args.results_fn):
             open(args.results_fn, 'w').write('')
         try:
             results = open(args.results_fn, 'r').read().split('\n')
         except:  # pylint: disable=bare-except
-            print 'no results yet'
+            print('no results yet')
             results = []
         for line in results:
             if not line:
@@ -460,24 +1036,40 @@ def main():
             pieces = line.split('\t')
             uid = Benchmark(*pieces[1:4])
             completed_count[uid] += 1
+            prior = PRIOR_SAMPLES.setdefault(uid, {})
+            prior.setdefault('rps', []).append(float(pieces[4]))
+            prior.setdefault('l50', []).append(float(pieces[7]))
     num_left = {}
+    num_stable = 0
     for benchmark in benchmarks:
-        if isinstance(benchmark, CloudRunBenchmark):
-            tmp = CloudRunBenchmark(benchmark.service, 'n/a', benchmark.test)
-            num_done = completed_count[tmp]
-        else:
-            num_done = completed_count[benchmark]
+        uid = get_results_key(benchmark)
+        num_done = completed_count[uid]
         num_left[benchmark] = num_runs - num_done
+        if (num_left[benchmark] > 0 and SAMPLE_SIZE_POLICY and
+                uid in PRIOR_SAMPLES and
+                not SAMPLE_SIZE_POLICY.wants_more(PRIOR_SAMPLES[uid])):
+            num_left[benchmark] = 0  # already has enough data
+            num_stable += 1
+    if num_stable:
+        print('    %d benchmarks already have narrow confidence intervals' % (
+            num_stable))
 
-    tot_left = sum(num_left.itervalues())
+    tot_left = sum(num_left.values())
     num_done = len(benchmarks) * num_runs - tot_left
     if num_done:
-        print '    %d left (%d already done)' % (tot_left, num_done)
+        print('    %d left (%d already done)' % (tot_left, num_done))
+    runner = run_cold_starts if args.cold_start else run_benchmark
     if args.sequential:
-        run_benchmarks_sequential(
-            args.results_fn, args.PROJECT, secs, num_left)
+        asyncio.run(run_benchmarks_sequential(
+            args.results_fn, args.PROJECT, secs, num_left, runner))
     else:
-        run_benchmarks_parallel(args.results_fn, args.PROJECT, secs, num_left)
+        quotas = dict(DEFAULT_QUOTAS)
+        for quota in args.quotas:
+            platform_key, limit = quota.split('=')
+            quotas[platform_key] = int(limit) if int(limit) > 0 else None
+        asyncio.run(run_benchmarks_parallel(
+            args.results_fn, args.PROJECT, secs, num_left, quotas,
+            args.max_parallel, runner))
 
 
 if __name__ == '__main__':
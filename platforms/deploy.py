@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 # pylint: disable=missing-docstring
 import argparse
-from collections import namedtuple
+from collections import deque, namedtuple
+import contextlib
+import functools
+import hashlib
 import json
 import math
 import os
+import random
 import re
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 
 import requests
@@ -19,8 +27,179 @@ MAX_CONCURRENT_REQ = 80  # also in template.ymal (GAE max is 80)
 
 TESTS = ('noop', 'sleep', 'data', 'memcache', 'dbjson',
          'dbtx', 'txtask', 'dbindir', 'dbindirb')
+# the txtaskasync tests don't need versions of their own: the txtask (and
+# ndbtxtask) versions serve /test/txtaskasync too
 PY3TESTS = tuple(list(TESTS) + ['ndbtx', 'ndbtxtask', 'ndbindir', 'ndbindirb'])
 PLATFORMS_DIR = os.path.abspath(os.path.dirname(__file__))
+# environment variables to set on every deployment (e.g., LAZY_IMPORTS=1)
+EXTRA_ENV = {}
+# max # of deploys to run at once on each platform (gae, cr-managed or
+# gke-MACHINE_TYPE; the gke quota applies to each cluster); "build" limits how
+# many Cloud Run images are built at once
+DEFAULT_QUOTAS = {'gae': 10, 'cr-managed': 20, 'gke': 2, 'build': 10}
+# max # of deploys to start per minute on each platform (non-managed CR
+# deploys fail if they're started too close together)
+DEFAULT_RATES = {'gae': 20, 'cr-managed': 60, 'gke': 6}
+# deploys which fail with output like this are retried (after a backoff)
+RETRYABLE_ERRORS = re.compile(
+    r'RESOURCE_EXHAUSTED|[Qq]uota|Too Many Requests|\b429\b|[Rr]ate limit|'
+    r'in progress|Conflict|\b409\b|UNAVAILABLE|[Tt]ry again')
+BACKOFF_SECS = 15
+MAX_BACKOFF_SECS = 300
+READY_TIMEOUT_SECS = 600
+READY_POLL_SECS = 5
+PRINT_LOCK = threading.Lock()
+DEPLOY_LOG_LOCK = threading.Lock()
+
+
+def add_env_variables(cfg, env):
+    """Returns the app.yaml config with env added to its env_variables."""
+    if not env:
+        return cfg
+    lines = ['  %s: "%s"' % kv for kv in sorted(env.items())]
+    if 'env_variables:' in cfg:
+        return cfg.replace('env_variables:',
+                           '\n'.join(['env_variables:'] + lines), 1)
+    return '\n'.join([cfg.rstrip('\n'), 'env_variables:'] + lines) + '\n'
+
+
+def log(s, *args):
+    """Prints a line (without interleaving it with other threads' lines)."""
+    if args:
+        s = s % args
+    with PRINT_LOCK:
+        sys.stdout.write(s + '\n')
+        sys.stdout.flush()
+
+
+class DeployError(Exception):
+    def __init__(self, msg, retryable):
+        Exception.__init__(self, msg)
+        self.retryable = retryable
+
+
+def check_call(cmd, name, cwd=None):
+    """Runs cmd; its output is printed with each line prefixed by name.
+
+    Raises DeployError if it fails (retryable if its output says it hit a
+    quota or a conflicting operation).
+    """
+    proc = subprocess.Popen(cmd, cwd=cwd, stdin=open(os.devnull),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    tail = deque(maxlen=50)
+    for line in iter(proc.stdout.readline, ''):
+        line = line.rstrip('\n')
+        tail.append(line)
+        log('[%s] %s', name, line)
+    if proc.wait() != 0:
+        output = '\n'.join(tail)
+        raise DeployError('%s failed (exit code %d)' % (
+            ' '.join(cmd[:3]), proc.returncode),
+                          bool(RETRYABLE_ERRORS.search(output)))
+
+
+def log_deploy_time(x, secs):
+    with DEPLOY_LOG_LOCK:
+        deploy_time_log_fn = os.path.join(PLATFORMS_DIR, 'deploy_log.tsv')
+        with open(deploy_time_log_fn, 'a') as fout_deploy_log:
+            print >> fout_deploy_log, '%s\t%f\t%s' % (
+                x.deployment_category, secs, x.deployment_uid)
+
+
+DeployJob = namedtuple('DeployJob', ('name', 'platform', 'run'))
+
+
+class DeployExecutor(object):
+    """Runs deploys concurrently, within per-platform limits.
+
+    Each platform runs at most quotas[platform] deploys at once and starts
+    at most rates[platform] per minute (gke-MACHINE_TYPE platforms fall back
+    to gke's limits). A deploy which fails with a retryable error is retried
+    after an exponential backoff, up to max_attempts times in total.
+    """
+    def __init__(self, max_parallel, quotas, rates, max_attempts=5):
+        self.slots = threading.BoundedSemaphore(max_parallel)
+        self.quotas = quotas
+        self.rates = rates
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.platform_slots = {}  # platform -> semaphore
+        self.next_start_at = {}  # platform -> when a deploy may next start
+        self.what = 'deployment'
+        self.num_done = 0
+        self.num_jobs = 0
+
+    @staticmethod
+    def get_limit(limits, platform):
+        if platform in limits:
+            return limits[platform]
+        return limits.get(platform.split('-', 1)[0])
+
+    def _get_platform_slots(self, platform):
+        with self.lock:
+            slots = self.platform_slots.get(platform)
+            if slots is None:
+                quota = self.get_limit(self.quotas, platform)
+                slots = threading.BoundedSemaphore(quota or 1000000)
+                self.platform_slots[platform] = slots
+            return slots
+
+    def _wait_for_turn(self, platform):
+        per_min = self.get_limit(self.rates, platform)
+        if not per_min:
+            return
+        with self.lock:
+            now = time.time()
+            start_at = max(now, self.next_start_at.get(platform, 0))
+            self.next_start_at[platform] = start_at + 60.0 / per_min
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    def run(self, jobs, what='deployment'):
+        """Runs jobs (DeployJobs). Returns the names of those which failed."""
+        failed = []
+        self.what = what
+        self.num_done = 0
+        self.num_jobs = len(jobs)
+        threads = []
+        for job in jobs:
+            thread = threading.Thread(target=self._run_job,
+                                      args=(job, failed))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)  # a timeout so that Ctrl-C isn't ignored
+        return failed
+
+    def _run_job(self, job, failed):
+        with self._get_platform_slots(job.platform), self.slots:
+            ok = False
+            for attempt in xrange(1, self.max_attempts + 1):
+                self._wait_for_turn(job.platform)
+                try:
+                    job.run()
+                    ok = True
+                    break
+                except DeployError as e:
+                    if not e.retryable or attempt == self.max_attempts:
+                        log('[%s] %s (giving up)', job.name, e)
+                        break
+                    delay = min(MAX_BACKOFF_SECS,
+                                BACKOFF_SECS * 2 ** (attempt - 1))
+                    delay *= random.uniform(1, 1.5)  # spread retries out
+                    log('[%s] %s; retrying in %ds', job.name, e, delay)
+                    time.sleep(delay)
+                except Exception as e:  # pylint: disable=broad-except
+                    log('[%s] failed: %r', job.name, e)
+                    break
+        with self.lock:
+            self.num_done += 1
+            if not ok:
+                failed.append(job.name)
+            log('%s #%d of %d completed (%s%s)', self.what, self.num_done,
+                self.num_jobs, job.name, '' if ok else ' FAILED')
 
 
 class AbstractDeployer(object):
@@ -30,9 +209,17 @@ class AbstractDeployer(object):
         self.limit_to_deploy_uids = limit_to_deploy_uids
         self.groups = []
 
-    def deploy_all(self):
-        for group in self.groups:
-            group.deploy_all(self.limit_to_deploy_uids)
+    def deploy_all(self, executor, groups=None):
+        """Deploys every group's deployments at once (via executor)."""
+        jobs = []
+        for group in self.groups if groups is None else groups:
+            for x in group.get_deployments(self.limit_to_deploy_uids):
+                jobs.append(DeployJob(x.deployment_uid, x.platform,
+                                      functools.partial(group.deploy, x)))
+        failed = executor.run(jobs)
+        if failed:
+            raise Exception('%d deployment(s) failed: %s' % (
+                len(failed), ' '.join(sorted(failed))))
 
     def print_stats(self):
         all_categories = set()
@@ -70,27 +257,21 @@ class AbstractDeploymentGroup(object):
                 return False
         return True
 
-    def deploy_all(self, limit_to_deploy_uids):
-        count = 0
-        deployments = [
+    def get_deployments(self, limit_to_deploy_uids):
+        return [
             x for x in self.deployments
             if not self.is_ignored(limit_to_deploy_uids, x.deployment_uid)]
-        deploy_time_log_fn = os.path.join(PLATFORMS_DIR, 'deploy_log.tsv')
-        with open(deploy_time_log_fn, 'a') as fout_deploy_log:
-            for x in deployments:
-                self._pre_deploy(x)
-                start = time.time()
-                subprocess.check_call(x.deploy_cmd)
-                end = time.time()
-                if '--async' not in x.deploy_cmd:
-                    print >> fout_deploy_log, '%s\t%f\t%s' % (
-                        x.deployment_category, end - start, x.deployment_uid)
-                if x.post_deploy:
-                    is_last_deploy = (count == len(deployments))
-                    x.post_deploy(x, is_last_deploy)
-                count += 1
-                print 'deployment #%d of %d completed' % (
-                    count, len(deployments))
+
+    def deploy(self, x):
+        """Deploys x (deploys may run concurrently, each in its own thread)."""
+        with self._staged(x) as cwd:
+            start = time.time()
+            check_call(x.deploy_cmd, x.deployment_uid, cwd=cwd)
+            end = time.time()
+        if '--async' not in x.deploy_cmd:
+            log_deploy_time(x, end - start)
+        if x.post_deploy:
+            x.post_deploy(x)
 
     def print_stats(self, limit_to_deploy_uids):
         all_categories = set([])
@@ -107,17 +288,25 @@ class AbstractDeploymentGroup(object):
             (' (%d ignored)' % len(ignored_duids)) if ignored_duids else '')
         return all_categories, all_deployment_uids, ignored_duids
 
-    def _pre_deploy(self, x):
-        """Called to setup files for deployment."""
-        # no-op by default
+    @contextlib.contextmanager
+    def _staged(self, x):
+        """Sets up the files to deploy x; yields the dir to deploy from."""
+        yield None  # nothing to set up by default
 
 
 class CloudRunDeployConfig(namedtuple('CloudRunDeployConfig', (
-        'image', 'machine_type', 'service', 'deploy_cmd', 'post_deploy'))):
+        'image', 'machine_type', 'service', 'deploy_cmd', 'post_deploy',
+        'platform_args'))):
     @property
     def category(self):
         return self.machine_type
 
+    @property
+    def platform(self):
+        if self.machine_type == 'managed':
+            return 'cr-managed'
+        return 'gke-' + self.machine_type
+
     @property
     def deployment_uid(self):
         return self.service
@@ -141,10 +330,12 @@ class CloudRunImageConfig(namedtuple('CloudRunImageConfig', (
 
 class CloudRunDeployer(AbstractDeployer):
     def __init__(self, project_name, limit_to_deploy_uids,
-                 image_filters, base_domain):
+                 image_filters, base_domain, rebuild_images=False):
         AbstractDeployer.__init__(self, project_name, limit_to_deploy_uids)
         self.image_filters = image_filters
         self.base_domain = base_domain
+        # if False, images whose inputs haven't changed aren't rebuilt
+        self.rebuild_images = rebuild_images
         self.container_images = set()
         self.groups = [
             CloudRunDeploymentGroup(machine_type, None, [])
@@ -173,13 +364,14 @@ class CloudRunDeployer(AbstractDeployer):
                 my_tests = tests
                 group.add_image(self.project_name, my_tests, image_cfg)
 
-    def deploy_all(self):
+    def deploy_all(self, executor):
         # build containers
         images = sorted(self.container_images)
         if self.image_filters == []:
             print 'skipping building all images'
             images = []
-        for i, image in enumerate(images):
+        jobs = []
+        for image in images:
             if self.image_filters is not None:
                 skip = True
                 for regex in self.image_filters:
@@ -188,13 +380,21 @@ class CloudRunDeployer(AbstractDeployer):
                         break
             else:
                 skip = False
-            verb = 'building' if not skip else 'skipping'
-            print '%s image %d of %d' % (verb, i + 1, len(images))
-            if not skip:
-                self.build_image(image)
+            if skip:
+                print 'skipping image %s' % image.name
+            else:
+                jobs.append(DeployJob(image.name, 'build',
+                                      functools.partial(self.build_image,
+                                                        image)))
+        # each image is built in its own build context, so they can be built
+        # concurrently (up to the build quota)
+        failed = executor.run(jobs, 'image build')
+        if failed:
+            raise Exception('%d image build(s) failed: %s' % (
+                len(failed), ' '.join(sorted(failed))))
 
         # deploy services
-        AbstractDeployer.deploy_all(self)
+        AbstractDeployer.deploy_all(self, executor)
 
         # map custom domains
         for group in self.groups:
@@ -206,11 +406,11 @@ class CloudRunDeployer(AbstractDeployer):
         assert len(all_deployment_uids) / len(all_categories) <= 150, (
             "can't have more than 150 services per cluster")
 
-    def build_image(self, image_cfg):
-        os.chdir(PLATFORMS_DIR)
-        # create the Dockerfile for this image
-        template_dockerfile_fn = 'cloud_run/Dockerfile.%s' % (
-            image_cfg.runtime.replace('-managed', ''))
+    def get_dockerfile(self, image_cfg):
+        """Returns the Dockerfile for image_cfg."""
+        template_dockerfile_fn = os.path.join(
+            PLATFORMS_DIR, 'cloud_run/Dockerfile.%s' % (
+                image_cfg.runtime.replace('-managed', '')))
         template_dockerfile_raw = open(template_dockerfile_fn, 'r').read()
         lines = [x for x in template_dockerfile_raw.split('\n') if x]
         if lines[-1].startswith('CMD '):
@@ -218,10 +418,12 @@ class CloudRunDeployer(AbstractDeployer):
         template_dockerfile = '\n'.join(lines)
         env_lines = [
             'ENV GAE_APPLICATION %s' % self.project_name,
-            open('cloud_run/.redis_info', 'r').read(),
+            open(os.path.join(PLATFORMS_DIR, 'cloud_run/.redis_info'),
+                 'r').read(),
         ]
         if 'gevent' in image_cfg.start_cmd:
             env_lines.append('ENV GAE_VERSION gevent')
+        env_lines.extend('ENV %s %s' % kv for kv in sorted(EXTRA_ENV.items()))
         dockerfile = '\n'.join([template_dockerfile,
                                 '\n'.join(env_lines),
                                 image_cfg.start_cmd, ''])
@@ -233,21 +435,39 @@ class CloudRunDeployer(AbstractDeployer):
                 dockerfile = dockerfile.replace('--worker-connections 40',
                                                 '--worker-connections 80')
                 dockerfile = dockerfile.replace('--threads 10', '--threads 20')
-        with open('Dockerfile', 'w') as fout:
-            fout.write(dockerfile)
-        # create the cloud build config file for this image
-        cloud_build_template = open(
-            'cloud_run/cloudbuild-template.yaml', 'r').read()
-        with open('cloudbuild.yaml', 'w') as fout:
-            template = cloud_build_template
-            template = template.replace('IMAGENAME',
-                                        image_cfg.name)
-            template = template.replace('PROJECTNAME',
-                                        self.project_name)
-            fout.write(template)
-        # build the image
-        print 'building image %s' % image_cfg.name
-        subprocess.check_call(['gcloud', 'builds', 'submit'])
+        return dockerfile
+
+    def build_image(self, image_cfg):
+        dockerfile = self.get_dockerfile(image_cfg)
+        # images are tagged with a hash of their inputs: if an image with
+        # that tag exists, it is already up to date
+        image_tag = hash_image_inputs(dockerfile)[:16]
+        image = 'gcr.io/%s/%s' % (self.project_name, image_cfg.name)
+        if not self.rebuild_images and image_exists(image, image_tag):
+            log('image %s is up to date (%s)', image_cfg.name, image_tag)
+            # latest may point to another build (e.g., before a revert)
+            check_call(['gcloud', 'container', 'images', 'add-tag', '--quiet',
+                        '%s:%s' % (image, image_tag), '%s:latest' % image],
+                       image_cfg.name)
+            return
+        with build_context(dockerfile) as context_dir:
+            # create the cloud build config file for this image
+            template_fn = os.path.join(PLATFORMS_DIR,
+                                       'cloud_run/cloudbuild-template.yaml')
+            cloud_build_template = open(template_fn, 'r').read()
+            config_fn = os.path.join(context_dir, 'cloudbuild.yaml')
+            with open(config_fn, 'w') as fout:
+                template = cloud_build_template
+                template = template.replace('IMAGENAME',
+                                            image_cfg.name)
+                template = template.replace('IMAGETAG', image_tag)
+                template = template.replace('PROJECTNAME',
+                                            self.project_name)
+                fout.write(template)
+            # build the image
+            log('building image %s (%s)', image_cfg.name, image_tag)
+            check_call(['gcloud', 'builds', 'submit', '--config', config_fn,
+                        context_dir], image_cfg.name)
 
     def __queue_cloud_run_deployments(self):
         """Prepares the Cloud Run services.
@@ -305,6 +525,74 @@ class CloudRunDeployer(AbstractDeployer):
             self.add_image(TESTS, image)
 
 
+def get_copied_paths(dockerfile):
+    """Returns the paths which dockerfile copies from the build context."""
+    paths = []
+    for line in dockerfile.replace('\\\n', ' ').split('\n'):
+        words = line.split()
+        if not words or words[0].upper() not in ('COPY', 'ADD'):
+            continue
+        if any(x.startswith('--from') for x in words[1:]):
+            continue  # copies from another stage (not from the context)
+        args = [x for x in words[1:] if not x.startswith('--')]
+        paths.extend(args[:-1])  # the last is the destination
+    return paths
+
+
+def hash_image_inputs(dockerfile):
+    """Returns a hash of dockerfile and the files it copies into the image.
+
+    Paths are relative to PLATFORMS_DIR (the build context).
+    """
+    digest = hashlib.sha256(dockerfile)
+    for path in get_copied_paths(dockerfile):
+        full_path = os.path.join(PLATFORMS_DIR, path)
+        if os.path.isdir(full_path):
+            fns = sorted(os.path.join(dir_path, fn)
+                         for dir_path, ignore, fns in os.walk(full_path)
+                         for fn in fns)
+        else:
+            fns = [full_path]
+        for fn in fns:
+            digest.update('\0%s\0' % os.path.relpath(fn, PLATFORMS_DIR))
+            with open(fn, 'rb') as fin:
+                digest.update(hashlib.sha256(fin.read()).digest())
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def build_context(dockerfile):
+    """Yields a temporary dir with dockerfile and the files it copies.
+
+    The files keep their paths relative to PLATFORMS_DIR, so the dir is a
+    build context for dockerfile (and only has what the image needs).
+    """
+    context_dir = tempfile.mkdtemp(prefix='build-')
+    try:
+        for path in get_copied_paths(dockerfile):
+            src = os.path.join(PLATFORMS_DIR, path)
+            dst = os.path.join(context_dir, path)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+                continue
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            shutil.copyfile(src, dst)
+        with open(os.path.join(context_dir, 'Dockerfile'), 'w') as fout:
+            fout.write(dockerfile)
+        yield context_dir
+    finally:
+        shutil.rmtree(context_dir, ignore_errors=True)
+
+
+def image_exists(image, tag):
+    """Returns True if the registry has image:tag."""
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call([
+            'gcloud', 'container', 'images', 'describe',
+            '%s:%s' % (image, tag)], stdout=devnull, stderr=devnull) == 0
+
+
 class CloudRunDeploymentGroup(AbstractDeploymentGroup):
     """A Cloud Run deployment group consists of a single machine type.
 
@@ -342,22 +630,18 @@ class CloudRunDeploymentGroup(AbstractDeploymentGroup):
         if self.machine_type == 'managed':
             service_account = 'forcloudrun@%s.iam.gserviceaccount.com' % (
                 project_name)
-            deploy_cmd_extra = [
-                '--platform', 'managed',
+            platform_args = ['--platform', 'managed',
+                             '--region', 'us-central1']
+            deploy_cmd_extra = platform_args + [
                 '--allow-unauthenticated',
-                '--region', 'us-central1',
                 '--memory', '512Mi',
                 '--service-account', service_account,
             ]
         else:
-            if self.machine_type == 'c2-standard-4':
-                zone = 'us-central1-b'
-            else:
-                zone = 'us-central1-a'
-            deploy_cmd_extra = [
-                '--platform', 'gke',
-                '--cluster', 'cluster-%s' % self.machine_type,
-                '--cluster-location', zone,
+            platform_args = ['--platform', 'gke',
+                             '--cluster', self.cluster_name,
+                             '--cluster-location', self.cluster_location]
+            deploy_cmd_extra = platform_args + [
                 '--timeout', '600',
                 '--cpu', '1.0',
                 '--memory', '512Mi']
@@ -371,12 +655,9 @@ class CloudRunDeploymentGroup(AbstractDeploymentGroup):
                           '--image', image, '--async',
                           '--concurrency', '80',
                           '--max-instances', '1'] + deploy_cmd_extra
-            post_deploy = None
-            if self.machine_type != 'managed':
-                post_deploy = self.post_deploy
             self.deployments.append(CloudRunDeployConfig(
                 image_cfg, self.machine_type, service_name, deploy_cmd,
-                post_deploy))
+                self.post_deploy, platform_args))
 
     def map_custom_domains(self, base_domain):
         if not base_domain or not self.services_that_need_domains:
@@ -397,11 +678,45 @@ class CloudRunDeploymentGroup(AbstractDeploymentGroup):
                     '--cluster-location', self.cluster_location])
                 print 'setup domain %s' % domain
 
-    def post_deploy(self, cr_deploy_cfg, is_last_deploy):
-        self.services_that_need_domains.append(cr_deploy_cfg.service)
-        # non-managed CR deploys need to be spaced out or they fail
-        if not is_last_deploy:
-            time.sleep(60)
+    def post_deploy(self, cr_deploy_cfg):
+        # deploys are async; the next deploy to this cluster waits for a slot
+        # (see DEFAULT_QUOTAS) which this one holds until its service is ready
+        wait_until_ready(cr_deploy_cfg)
+        if self.machine_type != 'managed':
+            self.services_that_need_domains.append(cr_deploy_cfg.service)
+
+
+def wait_until_ready(cr_deploy_cfg, timeout_secs=READY_TIMEOUT_SECS):
+    """Waits until the Cloud Run service's newest revision is serving.
+
+    Raises DeployError if the revision fails or isn't ready in time.
+    """
+    cmd = (['gcloud', 'beta', 'run', 'services', 'describe',
+            cr_deploy_cfg.service, '--format', 'json'] +
+           cr_deploy_cfg.platform_args)
+    deadline = time.time() + timeout_secs
+    while time.time() < deadline:
+        time.sleep(READY_POLL_SECS)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                svc = json.loads(subprocess.check_output(cmd, stderr=devnull))
+        except subprocess.CalledProcessError:
+            continue  # the service may not exist yet
+        status = svc.get('status', {})
+        if status.get('observedGeneration') < svc['metadata']['generation']:
+            continue  # status is still about the previous revision
+        for condition in status.get('conditions', []):
+            if condition.get('type') != 'Ready':
+                continue
+            if condition.get('status') == 'True':
+                return
+            if condition.get('status') == 'False':
+                msg = condition.get('message', '')
+                raise DeployError('%s is not ready: %s' % (
+                    cr_deploy_cfg.service, msg),
+                                  bool(RETRYABLE_ERRORS.search(msg)))
+    raise DeployError('%s was not ready within %ds' % (
+        cr_deploy_cfg.service, timeout_secs), False)
 
 
 Entrypoint = namedtuple('Entrypoint', ('name', 'command'))
@@ -422,11 +737,22 @@ class GAEDeployConfig(namedtuple('GAEDeployConfig', (
     def deployment_category(self):
         return self.service
 
+    @property
+    def platform(self):
+        return 'gae'
+
 
 class GAEDeployer(AbstractDeployer):
     def __init__(self, project_name, limit_to_deploy_uids):
         AbstractDeployer.__init__(self, project_name, limit_to_deploy_uids)
 
+    def deploy_all(self, executor, groups=None):
+        # the default service must exist before any other service is deployed
+        default = [x for x in self.groups if x.name == 'default']
+        AbstractDeployer.deploy_all(self, executor, default)
+        AbstractDeployer.deploy_all(
+            self, executor, [x for x in self.groups if x not in default])
+
     @property
     def runtimes(self):
         # we will deploy the runtimes in the order they are added
@@ -459,6 +785,20 @@ class GAEDeployer(AbstractDeployer):
             "can't have more than 210 versions")
 
 
+def ignore_for_staging(dir_path, fns):
+    """Returns the files in dir_path which aren't staged for a GAE deploy.
+
+    Dangling symlinks (e.g., to a key which setup.sh hasn't created) are
+    skipped; they point to nothing which could be deployed.
+    """
+    ignored = set(shutil.ignore_patterns('*.pyc', '__pycache__')(
+        dir_path, fns))
+    for fn in fns:
+        if not os.path.exists(os.path.join(dir_path, fn)):
+            ignored.add(fn)
+    return ignored
+
+
 class GAEDeploymentGroup(AbstractDeploymentGroup):
     """A GAE deployment group consists of a single runtime (e.g., python 2.7).
 
@@ -510,11 +850,24 @@ class GAEDeploymentGroup(AbstractDeploymentGroup):
             self.deployments.append(GAEDeployConfig(
                 framework, version, service, cfg, cmd, post, runtime_dir))
 
-    def _pre_deploy(self, gae_deploy_cfg):
-        os.chdir(gae_deploy_cfg.path)
-        self.__use_framework(self.runtime, gae_deploy_cfg.path,
-                             gae_deploy_cfg.framework)
-        open('app.yaml', 'w').write(gae_deploy_cfg.cfg)
+    @contextlib.contextmanager
+    def _staged(self, gae_deploy_cfg):
+        # each deploy gets its own copy of the runtime's dir (deploys run
+        # concurrently and each writes its own main and app.yaml)
+        staging_dir = tempfile.mkdtemp(prefix='deploy-%s-' % (
+            gae_deploy_cfg.deployment_uid))
+        try:
+            path = os.path.join(staging_dir, self.runtime)
+            # symlinks (e.g., big.json -> ../py27/big.json) are relative,
+            # so the files they point to are copied instead
+            shutil.copytree(gae_deploy_cfg.path, path, symlinks=False,
+                            ignore=ignore_for_staging)
+            self.__use_framework(self.runtime, path, gae_deploy_cfg.framework)
+            with open(os.path.join(path, 'app.yaml'), 'w') as fout:
+                fout.write(add_env_variables(gae_deploy_cfg.cfg, EXTRA_ENV))
+            yield path
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
     @staticmethod
     def __use_framework(runtime, runtime_dir, framework):
@@ -522,7 +875,7 @@ class GAEDeploymentGroup(AbstractDeploymentGroup):
         main_path = os.path.join(runtime_dir, 'main.%s' % ext)
         framework_path = os.path.join(runtime_dir, '%s_main.%s' % (
             framework, ext))
-        subprocess.check_call(['cp', framework_path, main_path])
+        shutil.copyfile(framework_path, main_path)
 
 
 def queue_gae_standard_python2_deployments(deployer):
@@ -539,7 +892,7 @@ def queue_gae_standard_python2_deployments(deployer):
     for icls in INSTANCE_CLASSES:
         name = icls.lower() + '-solo'
         deployer.add_deploy('py27', 'webapp', Entrypoint(name, None), TESTS,
-                            post=lambda x, ignore: set_scaling_limit(
+                            post=lambda x: set_scaling_limit(
                                 deployer.project_name,
                                 x.service, x.version, 1))
 
@@ -679,6 +1032,10 @@ def set_scaling_limit(project_name, service, version, limit):
             service, version, resp.status_code, resp.text))
 
 
+def format_limits(limits):
+    return ' '.join('%s=%d' % x for x in sorted(limits.items()))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('PROJECT', help='GCP project ID')
@@ -687,14 +1044,52 @@ def main():
     parser.add_argument('--filter-images', action='append',
                         dest='image_filters',
                         help='regex of images to build ("none" to skip all)')
+    parser.add_argument('--rebuild-images', action='store_true',
+                        help='build images even if an image built from the '
+                        'same inputs is already in the registry')
     parser.add_argument('--dry-run', action='store_true',
                         help='if passed, only stats will be printed')
     parser.add_argument('--test', action='append', dest='tests',
                         choices=list(set(TESTS) - set(['data'])),
                         help='which tests to deploy; omit to run all except data')
     parser.add_argument('--domain', help='custom domain for CR services')
+    parser.add_argument('--env', action='append', dest='env', default=[],
+                        metavar='NAME=VALUE',
+                        help='environment variable to set on every '
+                        'deployment (e.g., LAZY_IMPORTS=1 or IMPORT_PROFILE=1 '
+                        'for the python 3 apps)')
+    parser.add_argument('--sequential', action='store_true',
+                        help='deploy one service at a time')
+    parser.add_argument('--max-parallel', type=int, default=32, metavar='N',
+                        help='max # of deploys to run at once')
+    parser.add_argument('--quota', action='append', dest='quotas',
+                        default=[], metavar='PLATFORM=N',
+                        help='max # of deploys to run at once on a platform; '
+                        'PLATFORM is gae, cr-managed, gke (each GKE cluster), '
+                        'gke-MACHINE_TYPE or build (Cloud Run image builds) '
+                        '(default: %s)' % (
+                            format_limits(DEFAULT_QUOTAS)))
+    parser.add_argument('--rate', action='append', dest='rates',
+                        default=[], metavar='PLATFORM=N',
+                        help='max # of deploys to start per minute on a '
+                        'platform (default: %s)' % (
+                            format_limits(DEFAULT_RATES)))
+    parser.add_argument('--max-attempts', type=int, default=5, metavar='N',
+                        help='# of times to try a deploy which fails with a '
+                        'quota (or other retryable) error')
 
     args = parser.parse_args()
+    for x in args.env:
+        name, value = x.split('=', 1)
+        EXTRA_ENV[name] = value
+    quotas = dict(DEFAULT_QUOTAS)
+    rates = dict(DEFAULT_RATES)
+    for limits, values in ((quotas, args.quotas), (rates, args.rates)):
+        for x in values:
+            platform, n = x.split('=', 1)
+            limits[platform] = int(n)
+    executor = DeployExecutor(1 if args.sequential else args.max_parallel,
+                              quotas, rates, args.max_attempts)
     if args.tests:
         filter_suffix = '.*-(%s)$' % '|'.join(args.tests)
     else:
@@ -718,12 +1113,13 @@ def main():
     deployer.print_stats()
 
     cr_deployer = CloudRunDeployer(args.PROJECT, limit_to_deploy_uids,
-                                   image_filters, args.domain)
+                                   image_filters, args.domain,
+                                   args.rebuild_images)
     cr_deployer.print_stats()
 
     if not args.dry_run:
-        deployer.deploy_all()
-        cr_deployer.deploy_all()
+        deployer.deploy_all(executor)
+        cr_deployer.deploy_all(executor)
 
 
 if __name__ == '__main__':
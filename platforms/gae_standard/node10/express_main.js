@@ -1,3 +1,5 @@
+// require startup first: it times how long loading everything else takes
+const startup = require('./startup');
 const express = require('express');
 const asyncHandler = require('express-async-handler');
 const helper = require('./helper');
@@ -9,6 +11,10 @@ app.get('/_ah/warmup', (req, res) => {
     res.end();
 });
 
+app.get('/test/startup', (req, res) => {
+    res.json(startup.getTimings());
+});
+
 app.get('/test/log', (req, res) => {
     console.log(`hello world ${process.pid}`);
     res.end();
@@ -62,6 +68,7 @@ app.get('/test/dbindirb', asyncHandler(async (req, res, next) => {
     res.send(await helper.doDbIndirb(n));
 }));
 
+startup.markImported();
 require('./clusterize').startApp((PORT) => {
     app.listen(PORT, () => {
         console.log(`worker PID ${process.pid} listening on port ${PORT} ...`);
@@ -1,3 +1,5 @@
+// require startup first: it times how long loading everything else takes
+const startup = require('./startup');
 const fastify = require('fastify')({
     logger: process.env.NODE_ENV !== 'production'
 });
@@ -10,6 +12,10 @@ fastify.get('/', async (req, reply) => {
     reply.send();
 });
 
+fastify.get('/test/startup', async (req, reply) => {
+    reply.send(startup.getTimings());
+});
+
 fastify.get('/test/log', async (req, reply) => {
     console.log('hello world');
     reply.send();
@@ -64,6 +70,7 @@ fastify.get('/test/dbindirb', async (req, reply) => {
     reply.send(await helper.doDbIndirb(n));
 });
 
+startup.markImported();
 require('./clusterize').startApp((PORT) => {
     fastify.listen(PORT, '0.0.0.0', (err, addr) => {
         if (err) {
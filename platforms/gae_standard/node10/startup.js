@@ -0,0 +1,39 @@
+// Records how long each phase of this process's startup took. Require this
+// module before any other so that it can time the others being loaded.
+const importStartedAt = Date.now();
+// process.uptime() has sub-millisecond resolution
+const processStartedAt = importStartedAt - process.uptime() * 1000;
+var importedAt;
+var firstRequestAt;
+
+exports.markImported = () => {
+    if (importedAt === undefined) {
+        importedAt = Date.now();
+    }
+};
+
+function millisBetween(start, end) {
+    if (start === undefined || end === undefined) {
+        return null;
+    }
+    return Math.round(end - start);
+}
+
+// firstRequest is true if this is the first time this process has been asked
+// for its timings (i.e., it was started to serve this request)
+exports.getTimings = () => {
+    const now = Date.now();
+    const firstRequest = firstRequestAt === undefined;
+    if (firstRequest) {
+        firstRequestAt = now;
+    }
+    return {
+        pid: process.pid,
+        runtime: 'node' + process.versions.node,
+        first_request: firstRequest,
+        boot_millis: millisBetween(processStartedAt, importStartedAt),
+        import_millis: millisBetween(importStartedAt, importedAt),
+        ready_millis: millisBetween(importedAt, firstRequestAt),
+        uptime_millis: millisBetween(processStartedAt, now),
+    };
+};
@@ -0,0 +1,83 @@
+"""Creates the clients used by the tests on demand (once per process).
+
+Each client is registered with a factory and is only created when it is
+first used. A client created before the process forked (e.g., by gunicorn
+--preload) is not shared with the child; the child creates its own.
+"""
+import os
+import threading
+
+FACTORIES = {}  # client name -> function which creates it
+CLIENTS = {}  # client name -> (pid which created it, client)
+# reentrant because a client's factory may use another client (e.g., a lazily
+# imported module; see helper.import_module)
+LOCK = threading.RLock()
+# which clients each test's version uses (see prewarm()); the txtaskasync
+# tests share the txtask versions
+CLIENTS_BY_TEST = dict(
+    log=('logging',),
+    # memcachepipe and cachedread use the memcache versions too; cachedread's
+    # datastore client and cache are only created when it is first requested
+    memcache=('redis',),
+    dbtx=('datastore',),
+    txtask=('datastore', 'tasks', 'task_executor'),
+    dbjson=('datastore', 'big_json'),
+    dbindir=('datastore',),
+    dbindirb=('datastore',),
+    ndbtx=('ndb', 'ndb_models'),
+    ndbtxtask=('ndb', 'ndb_models', 'tasks', 'task_executor'),
+    ndbindir=('ndb', 'ndb_models'),
+    ndbindirb=('ndb', 'ndb_models'),
+)
+
+
+def register(name, factory):
+    FACTORIES[name] = factory
+
+
+def get(name):
+    """Returns the named client (it is created if needed)."""
+    pid = os.getpid()
+    created = CLIENTS.get(name)
+    if created is None or created[0] != pid:
+        with LOCK:
+            created = CLIENTS.get(name)
+            if created is None or created[0] != pid:
+                created = (pid, FACTORIES[name]())
+                CLIENTS[name] = created
+    return created[1]
+
+
+class LazyClient(object):
+    """Stands in for a registered client (see get())."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(get(self._name), attr)
+
+    def __call__(self, *args, **kwargs):
+        return get(self._name)(*args, **kwargs)
+
+
+def get_test():
+    """Returns the test this deployment serves (or None if it's unknown).
+
+    The test is the last part of the GAE version (or Cloud Run service) name.
+    """
+    name = os.environ.get('GAE_VERSION', '')
+    if name in ('', 'gevent'):  # Cloud Run images set GAE_VERSION=gevent
+        name = os.environ.get('K_SERVICE', '')
+    return name.rsplit('-', 1)[-1] or None
+
+
+def prewarm(test=None):
+    """Creates the clients which test (by default, this deployment's) uses.
+
+    Returns the names of the clients.
+    """
+    names = [x for x in CLIENTS_BY_TEST.get(test or get_test(), ())
+             if x in FACTORIES]
+    for name in names:
+        get(name)
+    return names
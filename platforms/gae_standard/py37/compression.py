@@ -0,0 +1,262 @@
+"""Compresses responses with the best encoding the client accepts.
+
+Compression is off unless COMPRESS_ENCODINGS is set, so that the other
+tests' responses are left alone (the apps only import this module if it is
+set, and only install the middleware if ENABLED). These environment
+variables configure it (set them with deploy.py --env):
+
+  COMPRESS_ENCODINGS: which encodings to use, most preferred first (e.g.,
+      "zstd,br,gzip"; those whose module isn't installed are skipped)
+  COMPRESS_LEVEL: the level to use (default: each encoding's own default)
+  COMPRESS_MIN_BYTES: smaller responses are not compressed (default: 1024)
+
+A request may ask for a different level with the X-Compress-Level header (the
+benchmarks use this to compare levels without redeploying).
+"""
+import importlib.util
+import os
+import threading
+import time
+import zlib
+
+
+def _load_gzip():
+    def compress(data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return compress
+
+
+def _load_br():
+    import brotli
+    return lambda data, level: brotli.compress(data, quality=level)
+
+
+def _load_zstd():
+    import zstandard
+    return lambda data, level: zstandard.ZstdCompressor(
+        level=level).compress(data)
+
+
+# name -> (module it needs, function returning compress(data, level), default
+# level, max level); each encoder's module is only imported when it is first
+# used, so that the apps' startup isn't slowed by encoders they don't use
+ENCODERS = dict(
+    gzip=('zlib', _load_gzip, 6, 9),
+    br=('brotli', _load_br, 4, 11),
+    zstd=('zstandard', _load_zstd, 3, 22),
+)
+COMPRESSORS = {}  # name -> compress(data, level) (once loaded)
+
+# those whose module isn't installed are skipped
+ENCODINGS = [x for x in os.environ.get('COMPRESS_ENCODINGS', '').split(',')
+             if x in ENCODERS and importlib.util.find_spec(ENCODERS[x][0])]
+ENABLED = bool(ENCODINGS)
+LEVEL = os.environ.get('COMPRESS_LEVEL')
+MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+LEVEL_HEADER = 'X-Compress-Level'
+# the CPU time used by this thread (pypy3.6 doesn't have thread_time(); under
+# gevent every greenlet shares a thread, but compressing doesn't yield)
+_get_cpu_secs = getattr(time, 'thread_time', time.process_time)
+
+
+def choose_encoding(accept_encoding):
+    """Returns the encoding to use for a request's Accept-Encoding header.
+
+    The client's most preferred encoding (by q-value) wins; ties go to our
+    preference. Returns None if the client accepts none of ENCODINGS.
+    """
+    if not accept_encoding or not ENCODINGS:
+        return None
+    q_by_encoding = {}
+    for item in accept_encoding.split(','):
+        pieces = item.strip().split(';')
+        q = 1.0
+        for param in pieces[1:]:
+            name, ignore, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        q_by_encoding[pieces[0].strip().lower()] = q
+    best = None
+    best_q = 0.0
+    for encoding in ENCODINGS:
+        q = q_by_encoding.get(encoding, q_by_encoding.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionStats(object):
+    """Counts what was compressed, how well and how much CPU it took."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_skipped = 0  # responses too small to compress
+        self.by_format = {}  # (encoding, level) -> [# responses, bytes in,
+        #                                             bytes out, cpu secs]
+
+    def add(self, encoding, level, num_bytes_in, num_bytes_out, cpu_secs):
+        with self.lock:
+            x = self.by_format.setdefault((encoding, level), [0, 0, 0, 0.0])
+            x[0] += 1
+            x[1] += num_bytes_in
+            x[2] += num_bytes_out
+            x[3] += cpu_secs
+
+    def skipped(self):
+        with self.lock:
+            self.num_skipped += 1
+
+    def get_stats(self):
+        with self.lock:
+            formats = sorted(self.by_format.items())
+            num_skipped = self.num_skipped
+        return dict(
+            encodings=ENCODINGS,
+            min_bytes=MIN_BYTES,
+            skipped=num_skipped,
+            formats=[dict(
+                encoding=encoding,
+                level=level,
+                responses=n,
+                bytes_in=bytes_in,
+                bytes_out=bytes_out,
+                ratio=round(bytes_in / bytes_out, 2) if bytes_out else None,
+                cpu_millis_per_response=round(cpu_secs * 1000 / n, 3),
+                cpu_millis_per_mb=(round(cpu_secs * 1000 / (bytes_in / 2**20),
+                                         3) if bytes_in else None),
+            ) for (encoding, level), (n, bytes_in, bytes_out, cpu_secs)
+                     in formats])
+
+
+STATS = CompressionStats()
+
+
+def get_level(encoding, level_header=None):
+    """Returns the level to compress with (clamped to encoding's range)."""
+    ignore, ignore, default_level, max_level = ENCODERS[encoding]
+    level = level_header or LEVEL
+    try:
+        level = int(level) if level else default_level
+    except ValueError:
+        level = default_level
+    return max(1, min(level, max_level))
+
+
+def compress(body, encoding, level_header=None):
+    """Returns a response body (bytes) compressed with encoding.
+
+    Returns None if the body is too small to be worth compressing. Callers
+    pick the encoding with choose_encoding() first, so that nothing is done
+    to the responses of requests which don't accept one.
+    """
+    if len(body) < MIN_BYTES:
+        STATS.skipped()
+        return None
+    level = get_level(encoding, level_header)
+    compressor = COMPRESSORS.get(encoding)
+    if compressor is None:
+        compressor = COMPRESSORS[encoding] = ENCODERS[encoding][1]()
+    start = _get_cpu_secs()
+    compressed = compressor(body, level)
+    STATS.add(encoding, level, len(body), len(compressed),
+              _get_cpu_secs() - start)
+    return compressed
+
+
+def get_stats():
+    return STATS.get_stats()
+
+
+class FalconMiddleware(object):
+    """Compresses falcon responses (streamed responses are left alone)."""
+    def process_response(self, req, resp, resource, req_succeeded):
+        resp.append_header('Vary', 'Accept-Encoding')
+        encoding = choose_encoding(req.get_header('Accept-Encoding'))
+        if (encoding is None or resp.stream is not None or
+                resp.get_header('Content-Encoding')):
+            return
+        body = resp.data
+        if body is None:
+            if resp.body is None:
+                return
+            body = resp.body.encode('utf-8')
+        body = compress(body, encoding, req.get_header(LEVEL_HEADER))
+        if body is not None:
+            resp.body = None
+            resp.data = body
+            resp.set_header('Content-Encoding', encoding)
+
+
+def compress_flask_response(request, response):
+    """An after_request handler which compresses flask responses."""
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if (encoding is None or response.direct_passthrough or
+            response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    body = compress(response.get_data(), encoding,
+                    request.headers.get(LEVEL_HEADER))
+    if body is not None:
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+class ASGIMiddleware(object):
+    """Compresses ASGI (e.g., FastAPI) responses which aren't streamed.
+
+    A response is streamed if its body is sent in more than one message;
+    those are passed through as they are. So are the responses to requests
+    which don't accept any of ENCODINGS (they aren't buffered).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = dict((k.decode('latin-1').lower(), v.decode('latin-1'))
+                       for k, v in scope.get('headers', ()))
+        encoding = choose_encoding(headers.get('accept-encoding'))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        level_header = headers.get(LEVEL_HEADER.lower())
+        start_message = None
+
+        async def compressing_send(message):
+            nonlocal start_message
+            if message['type'] == 'http.response.start':
+                start_message = message  # sent once we have the body
+                return
+            if start_message is None:  # already sent (streaming)
+                await send(message)
+                return
+            start, start_message = start_message, None
+            is_encoded = any(k.lower() == b'content-encoding'
+                             for k, v in start['headers'])
+            if message.get('more_body') or is_encoded:
+                await send(start)
+                await send(message)
+                return
+            response_headers = [(k, v) for k, v in start['headers']
+                                if k.lower() != b'content-length']
+            body = compress(message.get('body', b''), encoding,
+                            level_header)
+            response_headers.append((b'vary', b'Accept-Encoding'))
+            if body is None:
+                body = message.get('body', b'')
+            else:
+                response_headers.append((b'content-encoding',
+                                         encoding.encode('latin-1')))
+            response_headers.append((b'content-length',
+                                     str(len(body)).encode('latin-1')))
+            await send(dict(start, headers=response_headers))
+            await send(dict(message, body=body))
+
+        await self.app(scope, receive, compressing_send)
@@ -1,19 +1,40 @@
-# import helper first: it monkey-patches I/O if needed
-from helper import APP_ID, do_db_json, do_memcache, log
-
+# import startup first: it times how long importing everything else takes
+# (it only imports builtin modules and os, so it may precede the monkey-patch)
+import startup
+# import helper next: it monkey-patches I/O if needed
+from helper import (
+    APP_ID, DATA_MODES, do_db_json, do_memcache, do_memcache_pipe,
+    get_big_json_response, get_fake_data, get_json_formats, get_log_stats,
+    iter_fake_data, log)
+
+import json
 import logging
 import os
 import time
 
 import falcon
 
+import clients
+# only the compression benchmarks' deployments set COMPRESS_ENCODINGS; the
+# others don't import compression.py at all (see CompressStatsAPI)
+if os.environ.get('COMPRESS_ENCODINGS'):
+    import compression
+else:
+    compression = None
+
 if 'ndb' in os.environ.get('GAE_VERSION', ''):
-    from helper_ndb import do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task
+    from helper_ndb import (
+        do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task, do_tx_task_async)
 else:
-    from helper_db import do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task
+    from helper_db import (
+        do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task, do_tx_task_async)
+    # cachedread is only served by the (non-ndb) memcache versions
+    from helper_db import do_cached_read, get_cache_stats
 
 
-app = falcon.API()
+app = falcon.API(middleware=(
+    [compression.FalconMiddleware()]
+    if compression and compression.ENABLED else []))
 
 
 def api(route):
@@ -26,7 +47,20 @@ def api(route):
 @api('/_ah/warmup')
 class WarmupAPI(object):
     def on_get(self, req, resp):
-        pass
+        resp.body = ' '.join(clients.prewarm())
+
+
+@api('/test/startup')
+class StartupAPI(object):
+    def on_get(self, req, resp):
+        resp.body = json.dumps(startup.get_timings())
+
+
+@api('/test/importprofile')
+class ImportProfileAPI(object):
+    def on_get(self, req, resp):
+        resp.body = json.dumps(startup.get_import_profile(
+            int(req.get_param('limit', default=50))))
 
 
 @api('/test/log')
@@ -35,6 +69,12 @@ class TestLogsAPI(object):
         log(logging.CRITICAL, 'hello world')
 
 
+@api('/test/logstats')
+class LogStatsAPI(object):
+    def on_get(self, req, resp):
+        resp.body = json.dumps(get_log_stats())
+
+
 @api('/test/noop')
 class NoOpAPI(object):
     def on_get(self, req, resp):
@@ -50,7 +90,33 @@ class SleepAPI(object):
 @api('/test/data')
 class GetFakeDataAPI(object):
     def on_get(self, req, resp):
-        resp.body = 'x' * int(req.get_param('sz', default=2**20))
+        sz = int(req.get_param('sz', default=2**20))
+        mode = req.get_param('mode', default='alloc')
+        if mode == 'alloc':
+            resp.body = 'x' * sz
+        elif mode == 'prealloc':
+            resp.data = get_fake_data(sz)
+        elif mode == 'stream':
+            resp.stream = iter_fake_data(
+                sz, int(req.get_param('chunk', default=64 * 1024)))
+        else:
+            raise falcon.HTTPBadRequest(
+                title='bad mode',
+                description='mode must be one of %s' % ', '.join(DATA_MODES))
+
+
+@api('/test/bigjson')
+class BigJsonAPI(object):
+    def on_get(self, req, resp):
+        resp.content_type = falcon.MEDIA_JSON
+        resp.data = get_big_json_response(int(req.get_param('n', default=10)))
+
+
+@api('/test/compressstats')
+class CompressStatsAPI(object):
+    def on_get(self, req, resp):
+        import compression  # not imported at startup unless it is configured
+        resp.body = json.dumps(compression.get_stats())
 
 
 @api('/test/memcache')
@@ -60,6 +126,30 @@ class MemcacheAPI(object):
                     int(req.get_param('sz', default=10240)))
 
 
+@api('/test/memcachepipe')
+class MemcachePipeAPI(object):
+    def on_get(self, req, resp):
+        do_memcache_pipe(int(req.get_param('n', default=10)),
+                         int(req.get_param('sz', default=10240)),
+                         int(req.get_param('k', default=1)),
+                         int(req.get_param('b', default=10)),
+                         req.get_param('mode', default='pipeline'))
+
+
+@api('/test/cachedread')
+class CachedReadAPI(object):
+    def on_get(self, req, resp):
+        resp.body = do_cached_read(int(req.get_param('n', default=10)),
+                                   float(req.get_param('s', default=1.1)),
+                                   int(req.get_param('k', default=10000)))
+
+
+@api('/test/cachestats')
+class CacheStatsAPI(object):
+    def on_get(self, req, resp):
+        resp.body = json.dumps(get_cache_stats())
+
+
 @api('/test/dbtx')
 class DbTxAPI(object):
     def on_get(self, req, resp):
@@ -72,10 +162,24 @@ class TxTaskAPI(object):
         do_tx_task(int(req.get_param('n', default=5)))
 
 
+@api('/test/txtaskasync')
+class TxTaskAsyncAPI(object):
+    def on_get(self, req, resp):
+        do_tx_task_async(int(req.get_param('n', default=5)))
+
+
 @api('/test/dbjson')
 class DbJsonAPI(object):
     def on_get(self, req, resp):
-        resp.body = str(do_db_json(bool(req.get_param('b', default=False))))
+        resp.body = str(do_db_json(bool(req.get_param('b', default=False)),
+                                   req.get_param('codec'),
+                                   req.get_param('compress')))
+
+
+@api('/test/jsonformats')
+class JsonFormatsAPI(object):
+    def on_get(self, req, resp):
+        resp.body = json.dumps(get_json_formats())
 
 
 @api('/test/dbindir')
@@ -88,3 +192,6 @@ class DbIndirAPI(object):
 class DbIndirbAPI(object):
     def on_get(self, req, resp):
         resp.body = do_db_indirb(int(req.get_param('n', default=3)))
+
+
+startup.mark_imported()
@@ -1,5 +1,11 @@
-# import helper first: it monkey-patches I/O if needed
-from helper import APP_ID, do_db_json, do_memcache, log
+# import startup first: it times how long importing everything else takes
+# (it only imports builtin modules and os, so it may precede the monkey-patch)
+import startup
+# import helper next: it monkey-patches I/O if needed
+from helper import (
+    APP_ID, DATA_MODES, do_db_json, do_memcache, do_memcache_pipe,
+    get_big_json_response, get_fake_data, get_json_formats, get_log_stats,
+    iter_fake_data, log)
 
 import functools
 import inspect
@@ -9,13 +15,30 @@ import time
 import traceback
 
 from fastapi import FastAPI
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
+
+import clients
+# only the compression benchmarks' deployments set COMPRESS_ENCODINGS; the
+# others don't import compression.py at all (see CompressStatsAPI)
+if os.environ.get('COMPRESS_ENCODINGS'):
+    import compression
+else:
+    compression = None
 
 
 if 'ndb' in os.environ.get('GAE_VERSION', ''):
-    from helper_ndb import do_db_indir_async, do_db_indirb, do_db_tx, do_tx_task
+    from helper_ndb import (
+        do_db_indir_async, do_db_indirb, do_db_tx, do_tx_task,
+        do_tx_task_async)
 else:
-    from helper_db import do_db_indir_async, do_db_indirb, do_db_tx, do_tx_task
+    from helper_db import (
+        do_db_indir_async, do_db_indirb, do_db_tx, do_tx_task,
+        do_tx_task_async)
+    # cachedread is only served by the (non-ndb) memcache versions
+    from helper_db import do_cached_read, get_cache_stats
+    # ndb has no native async API, so adbindir is only served by the non-ndb
+    # versions (importing it on the ndb ones would skew their import timings)
+    from helper_db import do_db_adbindir
 
 
 # set default executor to thread pool with # threads = # requests ...  plus
@@ -35,6 +58,8 @@ else:
     # documentation included when running on localhost
     cfg = {}
 app = FastAPI(**cfg)
+if compression and compression.ENABLED:
+    app.add_middleware(compression.ASGIMiddleware)
 
 
 class API:
@@ -102,7 +127,21 @@ del method_name
 
 @API.get('/_ah/warmup')
 def WarmupAPI():
-    pass
+    """Creates the clients this version's test uses."""
+    return Response(content=' '.join(clients.prewarm()),
+                    media_type='text/plain')
+
+
+@API.get('/test/startup')
+def StartupAPI():
+    """Reports how long each phase of this process's startup took."""
+    return startup.get_timings()
+
+
+@API.get('/test/importprofile')
+def ImportProfileAPI(limit: int = 50):
+    """Reports how long imports took (if IMPORT_PROFILE=1)."""
+    return startup.get_import_profile(limit)
 
 
 @API.get('/test/log')
@@ -110,6 +149,12 @@ def TestLogsAPI():
     log(logging.CRITICAL, 'hello world')
 
 
+@API.get('/test/logstats')
+def LogStatsAPI():
+    """Reports how many log entries were batched, sent and dropped."""
+    return get_log_stats()
+
+
 @API.get('/test/noop')
 def NoOpAPI():
     pass
@@ -122,9 +167,38 @@ def SleepAPI(s: float = 1):
 
 
 @API.get('/test/data')
-def GetFakeDataAPI(sz: int = 2**20):
-    """Returns `sz` bytes of junk data."""
-    return Response(content='x' * sz, media_type='text/plain')
+def GetFakeDataAPI(sz: int = 2**20, mode: str = 'alloc',
+                   chunk: int = 64 * 1024):
+    """Returns `sz` bytes of junk data.
+
+    `mode` is how it's made: alloc (a new str each time), prealloc (bytes
+    allocated once) or stream (chunks of `chunk` bytes from a generator).
+    """
+    if mode == 'alloc':
+        return Response(content='x' * sz, media_type='text/plain')
+    if mode == 'prealloc':
+        return Response(content=get_fake_data(sz), media_type='text/plain')
+    if mode == 'stream':
+        async def stream():
+            for data in iter_fake_data(sz, chunk):
+                yield data
+        return StreamingResponse(stream(), media_type='text/plain')
+    return Response(content='mode must be one of %s' % ', '.join(DATA_MODES),
+                    status_code=400, media_type='text/plain')
+
+
+@API.get('/test/bigjson')
+def BigJsonAPI(n: int = 10):
+    """Returns a JSON list of `n` copies of big.json (compressible data)."""
+    return Response(content=get_big_json_response(n),
+                    media_type='application/json')
+
+
+@API.get('/test/compressstats')
+def CompressStatsAPI():
+    """Reports how much was compressed and how much CPU it took."""
+    import compression  # not imported at startup unless it is configured
+    return compression.get_stats()
 
 
 @API.get('/test/memcache')
@@ -132,6 +206,29 @@ def MemcacheAPI(n: int = 10, sz: int = 10240):
     do_memcache(n, sz)
 
 
+@API.get('/test/memcachepipe')
+def MemcachePipeAPI(n: int = 10, sz: int = 10240, k: int = 1, b: int = 10,
+                    mode: str = 'pipeline'):
+    """Puts `k` values of `sz` bytes into memcache and gets them `n` times.
+
+    Commands are sent in batches of `b` (in a pipeline, or as MSET/MGET if
+    `mode` is mget).
+    """
+    do_memcache_pipe(n, sz, k, b, mode)
+
+
+@API.get('/test/cachedread')
+def CachedReadAPI(n: int = 10, s: float = 1.1, k: int = 10000):
+    """Reads `n` of the first `k` entities (Zipf(`s`) popular) via caches."""
+    return Response(content=do_cached_read(n, s, k), media_type='text/plain')
+
+
+@API.get('/test/cachestats')
+def CacheStatsAPI():
+    """Reports the in-process cache's hits, misses and evictions."""
+    return get_cache_stats()
+
+
 @API.get('/test/dbtx')
 def DbTxAPI(n: int = 5):
     """Does `n` sequential datastore transactions. No contention."""
@@ -144,9 +241,22 @@ def TxTaskAPI(n: int = 5):
     do_tx_task(n)
 
 
+@API.get('/test/txtaskasync')
+def TxTaskAsyncAPI(n: int = 5):
+    """Enqueues a tx task (concurrently with the tx)."""
+    do_tx_task_async(n)
+
+
 @API.get('/test/dbjson')
-def DbTxAPI(b: bool = False):
-    return Response(content=str(do_db_json(b)), media_type='text/plain')
+def DbTxAPI(b: bool = False, codec: str = None, compress: str = None):
+    return Response(content=str(do_db_json(b, codec, compress)),
+                    media_type='text/plain')
+
+
+@API.get('/test/jsonformats')
+def JsonFormatsAPI():
+    """Reports big.json's size and encode/decode times in each format."""
+    return get_json_formats()
 
 
 @app.get('/test/dbindir')
@@ -155,6 +265,16 @@ async def DbIndirAPI(n: int = 3):
     return Response(content=ret, media_type='text/plain')
 
 
+@app.get('/test/adbindir')
+async def ADbIndirAPI(n: int = 3):
+    """Like dbindir, but uses the datastore's async (grpc.aio) client."""
+    ret = await do_db_adbindir(n)
+    return Response(content=ret, media_type='text/plain')
+
+
 @API.get('/test/dbindirb')
 def DbIndirbAPI(n: int = 3):
     return Response(content=do_db_indirb(n), media_type='text/plain')
+
+
+startup.mark_imported()
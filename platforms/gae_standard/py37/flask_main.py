@@ -1,24 +1,48 @@
-# import helper first: it monkey-patches I/O if needed
-from helper import APP_ID, do_db_json, do_memcache, log
+# import startup first: it times how long importing everything else takes
+# (it only imports builtin modules and os, so it may precede the monkey-patch)
+import startup
+# import helper next: it monkey-patches I/O if needed
+from helper import (
+    APP_ID, DATA_MODES, do_db_json, do_memcache, do_memcache_pipe,
+    get_big_json_response, get_fake_data, get_json_formats, get_log_stats,
+    iter_fake_data, log)
 
 import logging
 import os
 import time
 import traceback
 
-from flask import Flask, request, Response
-from google.cloud import datastore as db
+from flask import Flask, jsonify, request, Response
 from werkzeug.exceptions import InternalServerError
 
+import clients
+# only the compression benchmarks' deployments set COMPRESS_ENCODINGS; the
+# others don't import compression.py at all (see CompressStatsAPI)
+if os.environ.get('COMPRESS_ENCODINGS'):
+    import compression
+else:
+    compression = None
+
 if 'ndb' in os.environ.get('GAE_VERSION', ''):
-    from helper_ndb import do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task
+    from helper_ndb import (
+        do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task, do_tx_task_async)
 else:
-    from helper_db import do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task
+    from helper_db import (
+        do_db_indir_sync, do_db_indirb, do_db_tx, do_tx_task, do_tx_task_async)
+    # cachedread is only served by the (non-ndb) memcache versions
+    from helper_db import do_cached_read, get_cache_stats
+from helper_db import db
 
 
 app = Flask(__name__)
 
 
+if compression and compression.ENABLED:
+    @app.after_request
+    def compress_response(response):
+        return compression.compress_flask_response(request, response)
+
+
 @app.errorhandler(InternalServerError)
 def handle_500(e):
     original = getattr(e, 'original_exception', None)
@@ -32,7 +56,21 @@ def handle_500(e):
 
 @app.route('/_ah/warmup')
 def WarmupAPI():
-    return ''
+    """Creates the clients this version's test uses."""
+    return ' '.join(clients.prewarm())
+
+
+@app.route('/test/startup')
+def StartupAPI():
+    """Reports how long each phase of this process's startup took."""
+    return jsonify(startup.get_timings())
+
+
+@app.route('/test/importprofile')
+def ImportProfileAPI():
+    """Reports how long imports took (if IMPORT_PROFILE=1)."""
+    return jsonify(startup.get_import_profile(
+        int(request.args.get('limit', 50))))
 
 
 @app.route('/test/log')
@@ -41,6 +79,12 @@ def TestLogsAPI():
     return ''
 
 
+@app.route('/test/logstats')
+def LogStatsAPI():
+    """Reports how many log entries were batched, sent and dropped."""
+    return jsonify(get_log_stats())
+
+
 @app.route('/test/noop')
 def NoOpAPI():
     return ''
@@ -55,8 +99,35 @@ def SleepAPI():
 
 @app.route('/test/data')
 def GetFakeDataAPI():
-    """Returns `sz` bytes of junk data."""
-    return 'x' * int(request.args.get('sz', 2**20))
+    """Returns `sz` bytes of junk data.
+
+    `mode` is how it's made: alloc (a new str each time), prealloc (bytes
+    allocated once) or stream (chunks of `chunk` bytes from a generator).
+    """
+    sz = int(request.args.get('sz', 2**20))
+    mode = request.args.get('mode', 'alloc')
+    if mode == 'alloc':
+        return 'x' * sz
+    if mode == 'prealloc':
+        return Response(get_fake_data(sz), mimetype='text/plain')
+    if mode == 'stream':
+        chunk_size = int(request.args.get('chunk', 64 * 1024))
+        return Response(iter_fake_data(sz, chunk_size), mimetype='text/plain')
+    return 'mode must be one of %s' % ', '.join(DATA_MODES), 400
+
+
+@app.route('/test/bigjson')
+def BigJsonAPI():
+    """Returns a JSON list of `n` copies of big.json (compressible data)."""
+    return Response(get_big_json_response(int(request.args.get('n', 10))),
+                    mimetype='application/json')
+
+
+@app.route('/test/compressstats')
+def CompressStatsAPI():
+    """Reports how much was compressed and how much CPU it took."""
+    import compression  # not imported at startup unless it is configured
+    return jsonify(compression.get_stats())
 
 
 @app.route('/test/cache')
@@ -76,6 +147,35 @@ def MemcacheAPI():
     return ''
 
 
+@app.route('/test/memcachepipe')
+def MemcachePipeAPI():
+    """Puts `k` values of `sz` bytes into memcache and gets them `n` times.
+
+    Commands are sent in batches of `b` (in a pipeline, or as MSET/MGET if
+    `mode` is mget).
+    """
+    do_memcache_pipe(int(request.args.get('n', 10)),
+                     int(request.args.get('sz', 10240)),
+                     int(request.args.get('k', 1)),
+                     int(request.args.get('b', 10)),
+                     request.args.get('mode', 'pipeline'))
+    return ''
+
+
+@app.route('/test/cachedread')
+def CachedReadAPI():
+    """Reads `n` of the first `k` entities (Zipf(`s`) popular) via caches."""
+    return do_cached_read(int(request.args.get('n', 10)),
+                          float(request.args.get('s', 1.1)),
+                          int(request.args.get('k', 10000)))
+
+
+@app.route('/test/cachestats')
+def CacheStatsAPI():
+    """Reports the in-process cache's hits, misses and evictions."""
+    return jsonify(get_cache_stats())
+
+
 @app.route('/test/dbtx')
 def DbTxAPI():
     """Does `n` sequential datastore transactions. No contention."""
@@ -90,6 +190,13 @@ def TxTaskAPI():
     return ''
 
 
+@app.route('/test/txtaskasync')
+def TxTaskAsyncAPI():
+    """Enqueues a tx task (concurrently with the tx)."""
+    do_tx_task_async(int(request.args.get('n', 5)))
+    return ''
+
+
 @app.route('/handleTxTask', methods=['POST'])
 def handle_tx_task():
     tx_id = request.headers['TXID']
@@ -114,7 +221,15 @@ def handle_tx_task():
 
 @app.route('/test/dbjson')
 def DbJsonAPI():
-    return str(do_db_json(bool(request.args.get('b', False))))
+    return str(do_db_json(bool(request.args.get('b', False)),
+                          request.args.get('codec'),
+                          request.args.get('compress')))
+
+
+@app.route('/test/jsonformats')
+def JsonFormatsAPI():
+    """Reports big.json's size and encode/decode times in each format."""
+    return jsonify(get_json_formats())
 
 
 @app.route('/test/dbindir')
@@ -127,5 +242,8 @@ def DbIndirbAPI():
     return do_db_indirb(int(request.args.get('n', 3)))
 
 
+startup.mark_imported()
+
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
@@ -1,11 +1,18 @@
-from aioify import aioify
 import asyncio
+import importlib
 import os
 import random
 import zlib
 
 
-APP_ID = os.environ.get('GAE_APPLICATION', '').replace('s~', '')
+# if set, Cloud Tasks and Cloud Logging are replaced by in-process stand-ins
+# (see localstubs.py); the datastore emulator and a local Redis stand in for
+# the others (see platforms/local)
+LOCAL_STUBS = os.environ.get('LOCAL_STUBS') == '1'
+APP_ID = os.environ.get('GAE_APPLICATION', '').replace('s~', '') or (
+    os.environ.get('DATASTORE_PROJECT_ID', 'local') if LOCAL_STUBS else '')
+# if set, heavyweight modules and clients aren't loaded until first used
+LAZY_IMPORTS = os.environ.get('LAZY_IMPORTS') == '1'
 # if running uwsgi+gevent (ONLY) then we need to monkeypatch because it doesn't
 # monkey-patch for us
 if 'gevent' in os.environ.get('GAE_VERSION', ''):
@@ -22,30 +29,105 @@ elif 'meinheld' in os.environ.get('GAE_VERSION', ''):
 # ensure the connection pool is big enough for each worker (max workers is 80,
 # since each instance can only handle at most 80 concurrent connections)
 MAX_CONCURRENT_REQUESTS = 80
-from urllib3 import connectionpool, poolmanager
-class MyHTTPConnectionPool(connectionpool.HTTPConnectionPool):
-    def __init__(self, *args, **kwargs):
-        kwargs['maxsize'] = MAX_CONCURRENT_REQUESTS
-        super(MyHTTPConnectionPool, self).__init__(*args, **kwargs)
-poolmanager.pool_classes_by_scheme['http'] = MyHTTPConnectionPool
-class MyHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
-    def __init__(self, *args, **kwargs):
-        kwargs['maxsize'] = MAX_CONCURRENT_REQUESTS
-        super(MyHTTPSConnectionPool, self).__init__(*args, **kwargs)
-poolmanager.pool_classes_by_scheme['https'] = MyHTTPSConnectionPool
+BIGGER_POOLS_USED = False
+
+
+def use_bigger_connection_pools():
+    """Makes urllib3 connection pools big enough. Must precede any clients."""
+    global BIGGER_POOLS_USED
+    if BIGGER_POOLS_USED:
+        return
+    BIGGER_POOLS_USED = True
+    from urllib3 import connectionpool, poolmanager
+    class MyHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+        def __init__(self, *args, **kwargs):
+            kwargs['maxsize'] = MAX_CONCURRENT_REQUESTS
+            super(MyHTTPConnectionPool, self).__init__(*args, **kwargs)
+    poolmanager.pool_classes_by_scheme['http'] = MyHTTPConnectionPool
+    class MyHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+        def __init__(self, *args, **kwargs):
+            kwargs['maxsize'] = MAX_CONCURRENT_REQUESTS
+            super(MyHTTPSConnectionPool, self).__init__(*args, **kwargs)
+    poolmanager.pool_classes_by_scheme['https'] = MyHTTPSConnectionPool
+
+
+import clients
+
+
+def register_client(name, factory):
+    """Registers a client (see clients.py). Returns a stand-in for it.
+
+    The client is created by factory() when it is first used.
+    """
+    def create():
+        use_bigger_connection_pools()
+        return factory()
+    clients.register(name, create)
+    return clients.LazyClient(name)
+
+
+def import_module(name):
+    """Imports a module (or, in lazy mode, returns a stand-in for it).
+
+    In lazy mode, the module is registered like a client (named like
+    "module:google.cloud.datastore") and imported when first used.
+    """
+    if LAZY_IMPORTS:
+        client_name = 'module:' + name
+        clients.register(client_name, lambda: importlib.import_module(name))
+        return clients.LazyClient(client_name)
+    return importlib.import_module(name)
+
+
+_aioify = import_module('aioify')
+
+
+def aioify(fn):
+    """Returns a coroutine function which runs fn on the default executor.
+
+    This is the aioify package's wrapper. In lazy mode, the package isn't
+    imported until the wrapper is first called.
+    """
+    if not LAZY_IMPORTS:
+        return _aioify.aioify(fn)
+    wrapped = []
+
+    async def call(*args, **kwargs):
+        if not wrapped:
+            wrapped.append(_aioify.aioify(fn))
+        return await wrapped[0](*args, **kwargs)
+    return call
+
+
+if not LAZY_IMPORTS:
+    use_bigger_connection_pools()
 
 
 import logging
 if APP_ID:  # running in the dev server
-    import google.cloud.logging
-    from google.cloud.logging.resource import Resource
-    log_client = google.cloud.logging.Client()
-    log_name = 'appengine.googleapis.com%2Fstdout'
-    res = Resource(type='gae_app',
-                   labels=dict(
-                       project_id=APP_ID,
-                       module_id=os.environ.get('GAE_SERVICE', '')))
-    logger = log_client.logger(log_name)
+    def _create_log_shipper():
+        import logshipper
+        if LOCAL_STUBS:
+            import localstubs
+            log_client = localstubs.LoggingClient()
+            res = None
+        else:
+            import google.cloud.logging
+            from google.cloud.logging.resource import Resource
+            log_client = google.cloud.logging.Client()
+            res = Resource(type='gae_app',
+                           labels=dict(
+                               project_id=APP_ID,
+                               module_id=os.environ.get('GAE_SERVICE', '')))
+        log_name = 'appengine.googleapis.com%2Fstdout'
+        logger = log_client.logger(log_name)
+        def send_batch(entries):
+            batch = logger.batch()
+            for entry in entries:
+                batch.log_struct(resource=res, **entry)
+            batch.commit()
+        return logshipper.create_from_env(send_batch)
+    log_shipper = register_client('logging', _create_log_shipper)
     def log(severity, msg, *args):
         msg = msg % args
         if severity == logging.DEBUG:
@@ -62,33 +144,96 @@ if APP_ID:  # running in the dev server
             raise RuntimeError('unknown severity for log: %s' % msg)
         if severity == 'WARN':
             severity = 'WARNING'
-        logger.log_struct({'message': msg}, resource=res, severity=severity)
+        # queued; it is sent to Cloud Logging in the background
+        log_shipper.log(info={'message': msg}, severity=severity)
+    def get_log_stats():
+        return log_shipper.get_stats()
 else:
     def log(severity, msg, *args):
         logging.log(severity, msg, *args)
+    def get_log_stats():
+        return dict(enabled=False)  # logs go straight to stderr
 
 
 import base64
+import functools
 import platform
 import uuid
 
-from google.cloud import tasks_v2
-import redis
+# in lazy mode, the startup message goes to stderr so that the Cloud Logging
+# client isn't created just to log it
+(logging.log if LAZY_IMPORTS else log)(
+    logging.CRITICAL, 'APP_ID=%s VER=%s python runtime = %s lazy=%s',
+    APP_ID, os.environ.get('GAE_VERSION'), platform.python_implementation(),
+    LAZY_IMPORTS)
+
+
+def _create_redis_client():
+    import redis
+    return redis.Redis(host=os.environ['REDIS_HOST'],
+                       port=int(os.environ['REDIS_PORT']))
+
+
+def _create_tasks_client():
+    if LOCAL_STUBS:
+        import localstubs
+        return localstubs.CloudTasksClient()
+    from google.cloud import tasks_v2
+    if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        return tasks_v2.CloudTasksClient()
+    return tasks_v2.CloudTasksClient.from_service_account_json(
+        'cloudtasksaccount.json')
 
-log(logging.CRITICAL, 'APP_ID=%s VER=%s python runtime = %s',
-    APP_ID, os.environ.get('GAE_VERSION'), platform.python_implementation())
 
 if 'REDIS_HOST' in os.environ:
-    rcache = redis.Redis(host=os.environ['REDIS_HOST'],
-                         port=int(os.environ['REDIS_PORT']))
+    rcache = register_client('redis', _create_redis_client)
 else:
     log(logging.WARN, 'missing redis creds')
     rcache = None
-if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
-    taskq = tasks_v2.CloudTasksClient()
-else:
-    taskq = tasks_v2.CloudTasksClient.from_service_account_json(
-        'cloudtasksaccount.json')
+taskq = register_client('tasks', _create_tasks_client)
+
+
+def _create_task_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS)
+
+
+clients.register('task_executor', _create_task_executor)
+
+
+def create_task_async(fq_queue_name, task):
+    """Starts creating a task. Returns a future for the created task."""
+    return clients.get('task_executor').submit(
+        taskq.create_task, fq_queue_name, task)
+
+
+def delete_created_task(new_task):
+    """Deletes the task new_task (a future) created, if it was created."""
+    try:
+        created = new_task.result()
+    except Exception:
+        return  # no task was created
+    taskq.delete_task(created.name)
+
+
+DATA_MODES = ('alloc', 'prealloc', 'stream')
+DATA_CHUNK_SIZE = 64 * 1024
+
+
+@functools.lru_cache(maxsize=8)
+def get_fake_data(sz):
+    """Returns sz bytes of junk data (allocated once per size per process)."""
+    return b'x' * sz
+
+
+def iter_fake_data(sz, chunk_size=DATA_CHUNK_SIZE):
+    """Yields sz bytes of junk data in chunks (without allocating them)."""
+    assert chunk_size > 0
+    chunk = get_fake_data(chunk_size)
+    for ignore in range(sz // chunk_size):
+        yield chunk
+    if sz % chunk_size:
+        yield get_fake_data(sz % chunk_size)
 
 
 def do_memcache(n, sz):
@@ -99,6 +244,60 @@ def do_memcache(n, sz):
         assert rcache.get(key) == val
 
 
-def do_db_json(json_only=False):
+MEMCACHE_BATCH_MODES = ('pipeline', 'mget')
+
+
+def _batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def do_memcache_pipe(n, sz, num_keys=1, batch_size=10, mode='pipeline'):
+    """Like do_memcache, but sends commands in batches (fewer round trips).
+
+    Puts num_keys values of sz bytes and then gets them n times in total
+    (cycling through the keys). Commands are sent batch_size at a time, in a
+    pipeline (mode=pipeline) or as one MSET / MGET (mode=mget). By default,
+    this does the same commands as do_memcache(n, sz) but in 2 round trips.
+    """
+    if mode not in MEMCACHE_BATCH_MODES:
+        raise ValueError('unknown mode: %s' % mode)
+    assert num_keys > 0 and batch_size > 0
+    val = b'x' * sz
+    keys = [uuid.uuid4().hex for ignore in range(num_keys)]
+    for batch in _batches(keys, batch_size):
+        pipe = rcache.pipeline(transaction=False)
+        if mode == 'mget':
+            # MSET can't set a TTL; the EXPIREs share its round trip
+            pipe.mset(dict.fromkeys(batch, val))
+            for key in batch:
+                pipe.expire(key, 60)
+        else:
+            for key in batch:
+                pipe.set(key, val, ex=60)
+        pipe.execute()
+    to_get = [keys[i % num_keys] for i in range(n)]
+    for batch in _batches(to_get, batch_size):
+        if mode == 'mget':
+            values = rcache.mget(batch)
+        else:
+            pipe = rcache.pipeline(transaction=False)
+            for key in batch:
+                pipe.get(key)
+            values = pipe.execute()
+        assert all(x == val for x in values)
+
+
+def do_db_json(json_only=False, codec=None, compressor=None):
+    import helper_db
+    return helper_db.do_db_json(json_only, codec, compressor)
+
+
+def get_json_formats():
+    import helper_db
+    return helper_db.get_json_formats()
+
+
+def get_big_json_response(n):
     import helper_db
-    return helper_db.do_db_json(json_only)
+    return helper_db.get_big_json_response(n)
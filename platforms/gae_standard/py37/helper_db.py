@@ -1,8 +1,12 @@
-from helper import APP_ID, log, taskq
+from helper import (
+    APP_ID, LAZY_IMPORTS, aioify, create_task_async, delete_created_task,
+    import_module, log, rcache, register_client, taskq)
 
-from aioify import aioify
 import asyncio
 import base64
+import bisect
+import functools
+import itertools
 import json
 import logging
 import os
@@ -10,7 +14,12 @@ import platform
 import random
 import uuid
 
-from google.cloud import datastore as db
+import clients
+import jsoncodecs
+import localcache
+
+db = import_module('google.cloud.datastore')
+db_helpers = import_module('google.cloud.datastore.helpers')
 try:
     import orjson as json
 except ModuleNotFoundError:
@@ -22,7 +31,26 @@ except ModuleNotFoundError:
         log(logging.INFO, 'using std lib json (not orjson)')
 
 
-dbc = db.Client()
+dbc = register_client('datastore', lambda: db.Client())
+
+
+def _create_async_datastore_client():
+    from google.cloud.datastore_v1.services.datastore import (
+        DatastoreAsyncClient)
+    emulator_host = os.environ.get('DATASTORE_EMULATOR_HOST')
+    if emulator_host:
+        # unlike db.Client(), this client doesn't look for the emulator
+        from google.cloud.datastore_v1.services.datastore.transports import (
+            DatastoreGrpcAsyncIOTransport)
+        from grpc import aio
+        return DatastoreAsyncClient(transport=DatastoreGrpcAsyncIOTransport(
+            channel=aio.insecure_channel(emulator_host)))
+    return DatastoreAsyncClient()
+
+
+# uses the grpc asyncio transport; its channel belongs to the event loop it
+# was created on, so it isn't prewarmed (warmup runs on a worker thread)
+adbc = register_client('datastore_async', _create_async_datastore_client)
 
 
 def do_db_tx(n):
@@ -32,30 +60,35 @@ def do_db_tx(n):
             dbc.put(incr_db_entry(random_id))
 
 
+def _new_tx_task(tx_id):
+    """Returns the queue path and the task to enqueue for transaction tx_id."""
+    fq_queue_name = taskq.queue_path(
+        APP_ID,
+        'us-central1',
+        'testpy3')  # this is the queue name
+    task = dict(
+        app_engine_http_request=dict(
+            http_method='POST',
+            relative_uri='/handleTxTask',
+            body=base64.b64encode(b'x' * 512),  # encode to bytes
+            app_engine_routing=dict(
+                service='py3',
+                version='txtaskhandler',
+            ),
+            headers=dict(
+                TXID=tx_id,
+            ),
+        ),
+    )
+    return fq_queue_name, task
+
+
 def do_tx_task(n):
     for ignore in range(n):
         tx_id = uuid.uuid4().hex
-        fq_queue_name = taskq.queue_path(
-            APP_ID,
-            'us-central1',
-            'testpy3')  # this is the queue name
-        task = dict(
-            app_engine_http_request=dict(
-                http_method='POST',
-                relative_uri='/handleTxTask',
-                body=base64.b64encode(b'x' * 512),  # encode to bytes
-                app_engine_routing=dict(
-                    service='py3',
-                    version='txtaskhandler',
-                ),
-                headers=dict(
-                    TXID=tx_id,
-                ),
-            ),
-        )
-        # TODO: create_task is a synchronous API call; better to NOT block on
-        #       it until we need to commit our tx ... and not a moment before!
-        new_task = taskq.create_task(fq_queue_name, task)
+        # create_task is a synchronous API call, so the transaction doesn't
+        # start until it returns (do_tx_task_async doesn't wait for it)
+        new_task = taskq.create_task(*_new_tx_task(tx_id))
         random_id = uuid.uuid4().hex
         try:
             with dbc.transaction():
@@ -68,6 +101,28 @@ def do_tx_task(n):
             raise
 
 
+def do_tx_task_async(n):
+    """Like do_tx_task, but the task is created while the tx runs.
+
+    The task must exist before the transaction commits, so we wait for it
+    just before the commit (the puts are only sent on commit).
+    """
+    for ignore in range(n):
+        tx_id = uuid.uuid4().hex
+        new_task = create_task_async(*_new_tx_task(tx_id))
+        random_id = uuid.uuid4().hex
+        try:
+            with dbc.transaction():
+                counter = incr_db_entry(random_id)
+                tx_done_sentinel = db.Entity(key=dbc.key('TxDoneSentinel',
+                                                         tx_id))
+                dbc.put_multi([counter, tx_done_sentinel])
+                new_task.result()  # the tx is rolled back if this fails
+        except:
+            delete_created_task(new_task)
+            raise
+
+
 def incr_db_entry(some_id):
     """tries to get a db entity which won't exist and then creates it"""
     key = dbc.key('Counter', some_id)
@@ -80,14 +135,33 @@ def incr_db_entry(some_id):
     return x
 
 
-with open('big.json', 'rb') as fin:
-    LARGE_JSON = json.loads(fin.read())
+def _load_large_json():
+    with open('big.json', 'rb') as fin:
+        return json.loads(fin.read())
+
+
+clients.register('big_json', _load_large_json)
+
+
+def get_large_json():
+    """Returns the parsed contents of big.json."""
+    return clients.get('big_json')
+
+
+if not LAZY_IMPORTS:
+    get_large_json()
 
 
-def do_db_json(json_only=False):
-    dump = json.dumps(LARGE_JSON)
+def do_db_json(json_only=False, codec=None, compressor=None):
+    """Round-trips big.json through the datastore (or just its codec).
+
+    codec and compressor pick the format it is stored in (see jsoncodecs.py).
+    Returns the size of the stored data.
+    """
+    fmt = jsoncodecs.get_format(codec, compressor)
+    dump = fmt.encode(get_large_json())
     if json_only:
-        json.loads(dump)
+        fmt.decode(dump)
         return 'did json only'
     random_id = uuid.uuid4().hex
     key = dbc.key('BigJsonHolder', random_id)
@@ -96,10 +170,22 @@ def do_db_json(json_only=False):
     dbc.put(x)
     x = dbc.get(key)
     data = x['data']
-    json.loads(data)
+    fmt.decode(data)
     return len(data)
 
 
+@functools.lru_cache(maxsize=4)
+def get_big_json_response(n):
+    """Returns a JSON list of n copies of big.json (encoded once per n)."""
+    return jsoncodecs.get_format(compressor='none').encode(
+        [get_large_json()] * n)
+
+
+def get_json_formats():
+    """Returns big.json's size (and encode/decode times) in each format."""
+    return jsoncodecs.measure_formats(get_large_json())
+
+
 def _get_key(i=None):
     return dbc.key('OneInt', random.randint(0, 9999) if i is None else i)
 
@@ -120,7 +206,7 @@ else:
         return asyncio.run(do_db_indir_async(n))
 
 
-async_dbc_get = aioify(dbc.get)
+async_dbc_get = aioify(lambda key: dbc.get(key))
 
 
 async def _get_and_then_get_dependency():
@@ -132,6 +218,30 @@ async def _get_and_then_get_dependency():
     return subx.id + x.id
 
 
+async def do_db_adbindir(n):
+    """Like do_db_indir_async, but gets run on the event loop (not threads)."""
+    futures = {_aget_and_then_get_dependency() for i in range(n)}
+    done = (await asyncio.wait(futures))[0]
+    return str(sum(x.result() for x in done))
+
+
+async def adbc_get(key):
+    """Returns the entity with key (or None) using the async client."""
+    resp = await adbc.lookup(project_id=key.project, keys=[key.to_protobuf()])
+    if not resp.found:
+        return None
+    return db_helpers.entity_from_protobuf(resp.found[0].entity)
+
+
+async def _aget_and_then_get_dependency():
+    x = await adbc_get(_get_key())
+    if x is None:
+        raise Exception('OneInt entity missing (not yet defined?)')
+    new_idx = (2 * x.key.id) % 10000
+    subx = await adbc_get(dbc.key('OneInt', new_idx))
+    return subx.key.id + x.key.id
+
+
 def do_db_indirb(n):
     keys = [_get_key() for i in range(n)]
     entities = dbc.get_multi(keys)
@@ -140,3 +250,49 @@ def do_db_indirb(n):
     new_keys = [_get_key((2 * x.id) % 10000) for x in entities]
     entities.extend(dbc.get_multi(keys))
     return str(sum(x.id for x in entities))
+
+
+def _create_read_cache():
+    local = localcache.LRUCache(
+        int(os.environ.get('LOCAL_CACHE_ITEMS', 1000)),
+        float(os.environ.get('LOCAL_CACHE_TTL_SECS', 60)))
+    return localcache.TwoTierCache(local, rcache)
+
+
+clients.register('read_cache', _create_read_cache)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_zipf_cdf(num_keys, s):
+    """Returns the cumulative probabilities of a Zipf(s) distribution."""
+    weights = [1.0 / (rank ** s) for rank in range(1, num_keys + 1)]
+    total = sum(weights)
+    return [x / total for x in itertools.accumulate(weights)]
+
+
+def _load_one_int(idx):
+    x = dbc.get(_get_key(idx))
+    if x is None:
+        raise Exception('OneInt entity missing (not yet defined?)')
+    return str(x.key.id).encode()
+
+
+def do_cached_read(n, s=1.1, num_keys=10000):
+    """Reads n OneInt entities through the in-process cache and Redis.
+
+    Which entities are read follows a Zipf(s) distribution over the first
+    num_keys entities (a larger s concentrates reads on fewer entities).
+    """
+    assert 0 < num_keys <= 10000  # there are only 10,000 OneInt entities
+    cdf = _get_zipf_cdf(num_keys, s)
+    cache = clients.get('read_cache')
+    total = 0
+    for ignore in range(n):
+        idx = min(bisect.bisect_left(cdf, random.random()), num_keys - 1)
+        total += int(cache.get('OneInt:%d' % idx,
+                               lambda ignore, idx=idx: _load_one_int(idx)))
+    return str(total)
+
+
+def get_cache_stats():
+    return clients.get('read_cache').get_stats()
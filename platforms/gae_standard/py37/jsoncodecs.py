@@ -0,0 +1,137 @@
+"""Codecs and compressors which the dbjson test can store big.json with.
+
+A format is a codec (json, orjson, ujson or msgpack) plus a compressor (none,
+zlib, zlib1 to zlib9, zstd or lz4). The default format comes from the
+JSON_CODEC and JSON_COMPRESSOR environment variables (set with deploy.py
+--env); requests may override it.
+"""
+from collections import namedtuple
+import functools
+import json
+import os
+import time
+import zlib
+
+Format = namedtuple('Format', ('codec', 'compressor', 'encode', 'decode'))
+
+
+def _load_json():
+    return (lambda obj: json.dumps(obj).encode('utf-8'),
+            lambda data: json.loads(data.decode('utf-8')))
+
+
+def _load_orjson():
+    import orjson
+    return orjson.dumps, orjson.loads
+
+
+def _load_ujson():
+    import ujson
+    return (lambda obj: ujson.dumps(obj).encode('utf-8'),
+            lambda data: ujson.loads(data.decode('utf-8')))
+
+
+def _load_msgpack():
+    import msgpack
+    return (lambda obj: msgpack.packb(obj, use_bin_type=True),
+            lambda data: msgpack.unpackb(data, raw=False))
+
+
+def _load_zlib(level=None):
+    if level is None:
+        return zlib.compress, zlib.decompress  # level 6
+    return lambda data: zlib.compress(data, level), zlib.decompress
+
+
+def _load_zstd():
+    import zstandard
+    return (lambda data: zstandard.ZstdCompressor().compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+def _load_lz4():
+    import lz4.frame
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+# each codec's and compressor's module is only imported when it is first used
+# (so that the apps which never use it don't import it while starting up)
+CODECS = dict(  # name -> function returning (dumps to bytes, loads from bytes)
+    json=_load_json,
+    orjson=_load_orjson,
+    ujson=_load_ujson,
+    msgpack=_load_msgpack,
+)
+COMPRESSORS = dict(  # name -> function returning (compress, decompress)
+    none=lambda: (lambda data: data, lambda data: data),
+    zlib=_load_zlib,
+    zstd=_load_zstd,
+    lz4=_load_lz4,
+)
+for level in range(1, 10):
+    COMPRESSORS['zlib%d' % level] = functools.partial(_load_zlib, level)
+LOADED = {}  # codec or compressor name -> its functions (None if missing)
+
+
+def load(name, available):
+    """Returns the functions of a codec or compressor in available.
+
+    Returns None if its module isn't installed.
+    """
+    if name not in LOADED:
+        try:
+            LOADED[name] = available[name]()
+        except ModuleNotFoundError:
+            LOADED[name] = None
+    return LOADED[name]
+
+
+def get_default_codec():
+    """Returns the default codec: JSON_CODEC, else the fastest installed."""
+    return os.environ.get('JSON_CODEC') or next(
+        x for x in ('orjson', 'ujson', 'json') if load(x, CODECS))
+
+
+def get_format(codec=None, compressor=None):
+    """Returns the Format for codec and compressor (or the defaults)."""
+    codec = codec or get_default_codec()
+    compressor = compressor or os.environ.get('JSON_COMPRESSOR') or 'none'
+    for name, available in ((codec, CODECS), (compressor, COMPRESSORS)):
+        if name not in available:
+            raise ValueError('unknown codec or compressor: %s' % name)
+        if load(name, available) is None:
+            raise ValueError('%s is not installed' % name)
+    dumps, loads = load(codec, CODECS)
+    compress, decompress = load(compressor, COMPRESSORS)
+    return Format(codec, compressor,
+                  lambda obj: compress(dumps(obj)),
+                  lambda data: loads(decompress(data)))
+
+
+def measure_formats(obj, times=10):
+    """Returns the size of obj in each format and how long it takes to use.
+
+    Times are the average of `times` encodes (or decodes), in milliseconds.
+    """
+    missing = sorted(x for available in (CODECS, COMPRESSORS)
+                     for x in available if load(x, available) is None)
+    out = []
+    for codec in sorted(set(CODECS) - set(missing)):
+        for compressor in sorted(set(COMPRESSORS) - set(missing)):
+            fmt = get_format(codec, compressor)
+            start = time.perf_counter()
+            for ignore in range(times):
+                data = fmt.encode(obj)
+            encoded_at = time.perf_counter()
+            for ignore in range(times):
+                fmt.decode(data)
+            decoded_at = time.perf_counter()
+            out.append(dict(
+                codec=codec,
+                compressor=compressor,
+                num_bytes=len(data),
+                encode_millis=round((encoded_at - start) * 1000 / times, 3),
+                decode_millis=round((decoded_at - encoded_at) * 1000 / times,
+                                    3),
+            ))
+    return dict(formats=out, missing=missing)
@@ -0,0 +1,103 @@
+"""An in-process cache which can sit in front of Redis (or any other store).
+
+LRUCache holds at most max_items values, each for at most ttl_secs. It is
+safe to use from threads and greenlets (gevent patches its lock), and from
+asyncio since nothing blocks while the lock is held.
+"""
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """A size-bounded cache which evicts the least recently used value."""
+    def __init__(self, max_items=1000, ttl_secs=60):
+        assert max_items > 0
+        self.max_items = max_items
+        self.ttl_secs = ttl_secs
+        self.items = collections.OrderedDict()  # key -> (expires at, value)
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0  # values removed to make room
+        self.num_expirations = 0  # values removed because they were too old
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self.items.move_to_end(key)
+                    self.num_hits += 1
+                    return item[1]
+                del self.items[key]
+                self.num_expirations += 1
+            self.num_misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl_secs
+        with self.lock:
+            self.items[key] = (expires_at, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+                self.num_evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.num_hits + self.num_misses
+            return dict(
+                max_items=self.max_items,
+                ttl_secs=self.ttl_secs,
+                size=len(self.items),
+                hits=self.num_hits,
+                misses=self.num_misses,
+                hit_rate=(round(self.num_hits / lookups, 4)
+                          if lookups else None),
+                evictions=self.num_evictions,
+                expirations=self.num_expirations,
+            )
+
+
+class TwoTierCache(object):
+    """Checks an LRUCache, then Redis and only then loads the value.
+
+    Values must be bytes (so that Redis can store them). A value loaded (or
+    found in Redis) is put in the tiers which didn't have it. If
+    redis_client is None (e.g., Redis isn't configured), only the LRUCache
+    is used.
+    """
+    def __init__(self, local, redis_client, redis_ttl_secs=60):
+        self.local = local
+        self.redis = redis_client
+        self.redis_ttl_secs = redis_ttl_secs
+        self.lock = threading.Lock()
+        self.num_redis_hits = 0
+        self.num_loads = 0
+
+    def get(self, key, load):
+        """Returns key's value; load(key) is called if no tier has it."""
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = self.redis.get(key) if self.redis is not None else None
+        if value is None:
+            value = load(key)
+            if self.redis is not None:
+                self.redis.set(key, value, ex=self.redis_ttl_secs)
+            with self.lock:
+                self.num_loads += 1
+        else:
+            with self.lock:
+                self.num_redis_hits += 1
+        self.local.set(key, value)
+        return value
+
+    def get_stats(self):
+        with self.lock:
+            return dict(local=self.local.get_stats(),
+                        redis=self.redis is not None,
+                        redis_hits=self.num_redis_hits,
+                        loads=self.num_loads)
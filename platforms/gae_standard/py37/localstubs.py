@@ -0,0 +1,85 @@
+"""In-process stand-ins for Cloud Tasks and Cloud Logging.
+
+These let the tests run on one machine without a GCP project (see
+platforms/local). They implement only the calls which helper.py,
+helper_db.py and helper_ndb.py make. Nothing leaves the process: tasks are
+remembered (but never dispatched, just like the testpy3 queue which allows
+no concurrent dispatches) and log entries go to the standard library's
+logging module.
+"""
+import collections
+import logging
+import threading
+
+
+class Task(object):
+    """A created task (only its name is used)."""
+    def __init__(self, name, request):
+        self.name = name
+        self.app_engine_http_request = request
+
+
+class CloudTasksClient(object):
+    """Stands in for tasks_v2.CloudTasksClient.
+
+    At most max_tasks tasks are remembered; the oldest are forgotten (as if
+    the queue had been purged) to bound how much memory a long benchmark
+    uses.
+    """
+    def __init__(self, max_tasks=100000):
+        assert max_tasks > 0
+        self.max_tasks = max_tasks
+        self.tasks = collections.OrderedDict()  # task name -> Task
+        self.lock = threading.Lock()
+        self.num_created = 0
+        self.num_deleted = 0
+
+    def queue_path(self, project, location, queue):
+        return 'projects/%s/locations/%s/queues/%s' % (
+            project, location, queue)
+
+    def create_task(self, parent, task):
+        with self.lock:
+            self.num_created += 1
+            name = '%s/tasks/%d' % (parent, self.num_created)
+            created = Task(name, task.get('app_engine_http_request'))
+            self.tasks[name] = created
+            while len(self.tasks) > self.max_tasks:
+                self.tasks.popitem(last=False)
+        return created
+
+    def delete_task(self, name):
+        with self.lock:
+            if self.tasks.pop(name, None) is None:
+                raise KeyError('no such task: %s' % name)
+            self.num_deleted += 1
+
+
+class LoggingBatch(object):
+    """Stands in for a google.cloud.logging Batch."""
+    def __init__(self, logger):
+        self.logger = logger
+        self.entries = []
+
+    def log_struct(self, info, severity='DEFAULT', resource=None):
+        self.entries.append((severity, info))
+
+    def commit(self):
+        for severity, info in self.entries:
+            self.logger.log(getattr(logging, severity, logging.INFO), '%s',
+                            info.get('message', info))
+        self.entries = []
+
+
+class LoggingClient(object):
+    """Stands in for google.cloud.logging.Client."""
+    def logger(self, name):
+        return _Logger(logging.getLogger('cloudlogging.' + name))
+
+
+class _Logger(object):
+    def __init__(self, logger):
+        self.logger = logger
+
+    def batch(self):
+        return LoggingBatch(self.logger)
@@ -0,0 +1,167 @@
+"""Sends log entries to Cloud Logging in batches from a background thread.
+
+log() only appends the entry to a bounded, in-memory queue, so requests don't
+wait on a network round trip for each entry. A background thread (a greenlet
+if gevent has monkey-patched threading) sends the queued entries in a batch
+once batch_size entries are queued or flush_secs have passed since the first
+was queued, whichever comes first.
+
+If the queue is full, new entries are dropped (when_full='drop') or log()
+waits until there is room for them (when_full='block'; this is backpressure,
+so don't use it with asyncio since it would block the event loop).
+"""
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+
+WHEN_FULL_POLICIES = ('drop', 'block')
+
+
+class LogShipper(object):
+    """Queues log entries and sends them in batches via send_batch(entries).
+
+    Each entry is a dict of keyword arguments for a log_struct() call.
+    """
+    def __init__(self, send_batch, max_queued=10000, batch_size=100,
+                 flush_secs=1.0, when_full='drop'):
+        assert max_queued >= batch_size > 0
+        assert when_full in WHEN_FULL_POLICIES, when_full
+        self.send_batch = send_batch
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.when_full = when_full
+        self.queue = collections.deque()
+        self.oldest_queued_at = None
+        self.cond = threading.Condition()
+        self.pid = None  # the process which started the shipping thread
+        self.num_sending = 0  # entries taken from the queue but not yet sent
+        self.num_queued = 0
+        self.num_dropped = 0
+        self.num_sent = 0
+        self.num_failed = 0  # entries which were in a batch we failed to send
+        self.num_batches = 0
+        self.num_blocked = 0  # times log() had to wait for room in the queue
+
+    def _ensure_started(self):
+        # the thread doesn't survive a fork; each process starts its own
+        pid = os.getpid()
+        if self.pid != pid:
+            self.pid = pid
+            thread = threading.Thread(target=self._run, name='logshipper')
+            thread.daemon = True
+            thread.start()
+
+    def log(self, **entry):
+        """Queues an entry. Returns False if it was dropped."""
+        with self.cond:
+            self._ensure_started()
+            if len(self.queue) >= self.max_queued:
+                if self.when_full == 'drop':
+                    self.num_dropped += 1
+                    return False
+                self.num_blocked += 1
+                while len(self.queue) >= self.max_queued:
+                    self.cond.wait()
+            if not self.queue:
+                self.oldest_queued_at = time.monotonic()
+            self.queue.append(entry)
+            self.num_queued += 1
+            if len(self.queue) >= self.batch_size:
+                self.cond.notify_all()
+        return True
+
+    def _take_batch(self):
+        """Waits until a batch is due, then removes it from the queue."""
+        with self.cond:
+            while True:
+                if len(self.queue) >= self.batch_size:
+                    break
+                if self.queue:
+                    wait_secs = (self.oldest_queued_at + self.flush_secs -
+                                 time.monotonic())
+                    if wait_secs <= 0:
+                        break
+                else:
+                    wait_secs = None
+                self.cond.wait(wait_secs)
+            n = min(self.batch_size, len(self.queue))
+            batch = [self.queue.popleft() for ignore in range(n)]
+            # the rest of the queue has waited for at least as long
+            self.oldest_queued_at = time.monotonic() - self.flush_secs
+            self.num_sending += n
+            self.cond.notify_all()  # there's room for blocked log() calls
+        return batch
+
+    def _send(self, batch):
+        try:
+            self.send_batch(batch)
+        except Exception:
+            logging.exception('failed to send %d log entries', len(batch))
+            ok = False
+        else:
+            ok = True
+        with self.cond:
+            self.num_sending -= len(batch)
+            if ok:
+                self.num_sent += len(batch)
+                self.num_batches += 1
+            else:
+                self.num_failed += len(batch)
+            self.cond.notify_all()  # wakes flush()
+
+    def _run(self):
+        while True:
+            self._send(self._take_batch())
+
+    def flush(self, timeout_secs=5):
+        """Waits until every queued entry has been sent (or timeout_secs)."""
+        deadline = time.monotonic() + timeout_secs
+        with self.cond:
+            if self.queue:
+                self.oldest_queued_at = time.monotonic() - self.flush_secs
+                self.cond.notify_all()
+            while self.queue or self.num_sending:
+                wait_secs = deadline - time.monotonic()
+                if wait_secs <= 0 or self.pid != os.getpid():
+                    return False
+                self.cond.wait(wait_secs)
+        return True
+
+    def get_stats(self):
+        with self.cond:
+            return dict(
+                enabled=True,
+                batch_size=self.batch_size,
+                flush_secs=self.flush_secs,
+                max_queued=self.max_queued,
+                when_full=self.when_full,
+                queue_len=len(self.queue),
+                queued=self.num_queued,
+                dropped=self.num_dropped,
+                blocked=self.num_blocked,
+                sent=self.num_sent,
+                failed=self.num_failed,
+                batches=self.num_batches,
+                avg_batch_size=(round(self.num_sent / self.num_batches, 1)
+                                if self.num_batches else None),
+            )
+
+
+def create_from_env(send_batch):
+    """Returns a LogShipper configured by the LOG_* environment variables.
+
+    The LogShipper tries to send any entries still queued when this process
+    exits.
+    """
+    shipper = LogShipper(
+        send_batch,
+        max_queued=int(os.environ.get('LOG_MAX_QUEUED', 10000)),
+        batch_size=int(os.environ.get('LOG_BATCH_SIZE', 100)),
+        flush_secs=float(os.environ.get('LOG_FLUSH_SECS', 1.0)),
+        when_full=os.environ.get('LOG_WHEN_FULL', 'drop'))
+    atexit.register(shipper.flush)
+    return shipper
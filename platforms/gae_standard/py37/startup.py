@@ -0,0 +1,190 @@
+"""Records how long each phase of this process's startup took.
+
+Import this module before any other so that it can time the imports. The
+main module calls mark_imported() once it has finished importing, and
+/test/startup reports get_timings().
+
+If the IMPORT_PROFILE environment variable is set to 1, how long each module
+took to import is recorded too (see get_import_profile()).
+
+This module is imported even before helper, which monkey-patches I/O for
+gevent and must otherwise precede every other import. That's safe because
+it only imports builtin modules and os (none of which must be imported
+after patching; gevent patches _thread in place); platform is imported when
+it is used.
+"""
+import _thread
+import os
+import sys
+import time
+
+IMPORT_STARTED_AT = time.time()
+IMPORTED_AT = None
+FIRST_REQUEST_AT = None
+
+
+def _get_process_started_at():
+    """Returns when this process started (or None if it is unknown).
+
+    The process's age is computed from /proc (10ms resolution); btime (when
+    the machine booted) only has 1sec resolution, so it isn't used.
+    """
+    try:
+        with open('/proc/self/stat', 'r') as fin:
+            stat = fin.read()
+        with open('/proc/uptime', 'r') as fin:
+            uptime_secs = float(fin.read().split()[0])
+        now = time.time()
+        # starttime is the 22nd field; the 2nd (the command) may have spaces
+        ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+        secs_since_boot = ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+    return now - (uptime_secs - secs_since_boot)
+
+
+PROCESS_STARTED_AT = _get_process_started_at()
+
+
+class ImportTimer(object):
+    """A meta path finder which times how long each module takes to import.
+
+    It doesn't find modules itself. It asks the finders after it for each
+    module's spec and wraps the spec's loader so that executing the module
+    is timed. A module's cumulative time includes the modules it imported;
+    its self time does not.
+    """
+    def __init__(self):
+        self.timings = {}  # module name -> (cumulative secs, self secs)
+        self.namespace_packages = set()
+        # thread (or greenlet) ID -> time spent importing the children of
+        # each module currently being imported
+        self.stacks = {}
+
+    def find_spec(self, name, path, target=None):
+        spec = None
+        for finder in sys.meta_path:
+            if finder is not self and hasattr(finder, 'find_spec'):
+                spec = finder.find_spec(name, path, target)
+                if spec is not None:
+                    break
+        if spec is None:
+            return None
+        if spec.submodule_search_locations is not None and (
+                spec.origin in (None, 'namespace')):
+            self.namespace_packages.add(name)
+        loader = spec.loader
+        # builtin and frozen modules are imported by classes (not instances)
+        # and are quick to import anyway
+        if loader is None or isinstance(loader, type):
+            return spec
+        exec_module = getattr(loader, 'exec_module', None)
+        if exec_module is None or hasattr(exec_module, 'import_timer'):
+            return spec  # not supported or already timed (loader is shared)
+        try:
+            loader.exec_module = self._wrap(exec_module)
+        except AttributeError:
+            pass  # loader has no instance dict; the module won't be timed
+        return spec
+
+    def _wrap(self, exec_module):
+        def timed_exec_module(module):
+            # _thread.get_ident is looked up each time so that each greenlet
+            # gets its own stack once gevent has patched it
+            stack = self.stacks.setdefault(_thread.get_ident(), [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                self.timings[module.__name__] = (elapsed, elapsed - children)
+        timed_exec_module.import_timer = self
+        return timed_exec_module
+
+    def get_package(self, name):
+        """Returns the package a module is attributed to.
+
+        This is its top-level package, or the first non-namespace package
+        (e.g., google.cloud.logging rather than google).
+        """
+        pieces = name.split('.')
+        package = pieces[0]
+        for piece in pieces[1:]:
+            if package not in self.namespace_packages:
+                break
+            package += '.' + piece
+        return package
+
+
+IMPORT_TIMER = None
+if os.environ.get('IMPORT_PROFILE') == '1':
+    IMPORT_TIMER = ImportTimer()
+    sys.meta_path.insert(0, IMPORT_TIMER)
+
+
+def get_import_profile(limit=50):
+    """Returns how long imports took (in milliseconds).
+
+    modules lists the limit slowest modules to import (by cumulative time).
+    packages lists the total (self) time spent importing each package.
+    """
+    if not IMPORT_TIMER:
+        return dict(enabled=False)
+    timings = dict(IMPORT_TIMER.timings)
+    packages = {}
+    for name, (ignore, self_secs) in timings.items():
+        package = IMPORT_TIMER.get_package(name)
+        packages[package] = packages.get(package, 0) + self_secs
+    modules = sorted(timings.items(), key=lambda item: -item[1][0])
+    if limit:
+        modules = modules[:limit]
+    return dict(
+        enabled=True,
+        num_modules=len(timings),
+        modules=[dict(module=name,
+                      cumulative_millis=round(cumulative * 1000, 1),
+                      self_millis=round(self_secs * 1000, 1))
+                 for name, (cumulative, self_secs) in modules],
+        packages=[dict(package=name, millis=round(secs * 1000, 1))
+                  for name, secs in sorted(packages.items(),
+                                           key=lambda item: -item[1])],
+    )
+
+
+def mark_imported():
+    global IMPORTED_AT
+    if IMPORTED_AT is None:
+        IMPORTED_AT = time.time()
+
+
+def _millis_between(start, end):
+    if start is None or end is None:
+        return None
+    return int(round((end - start) * 1000))
+
+
+def get_timings():
+    """Returns how long each phase of startup took (in milliseconds).
+
+    first_request is True if this is the first time this process has been
+    asked for its timings (i.e., it was started to serve this request).
+    """
+    global FIRST_REQUEST_AT
+    import platform
+    now = time.time()
+    first_request = FIRST_REQUEST_AT is None
+    if first_request:
+        FIRST_REQUEST_AT = now
+    return dict(
+        pid=os.getpid(),
+        runtime=platform.python_implementation(),
+        first_request=first_request,
+        boot_millis=_millis_between(PROCESS_STARTED_AT, IMPORT_STARTED_AT),
+        import_millis=_millis_between(IMPORT_STARTED_AT, IMPORTED_AT),
+        ready_millis=_millis_between(IMPORTED_AT, FIRST_REQUEST_AT),
+        uptime_millis=_millis_between(PROCESS_STARTED_AT, now),
+    )
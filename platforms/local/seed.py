@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""Creates the OneInt entities which the dbindir tests read.
+
+Run this against the datastore emulator (DATASTORE_EMULATOR_HOST and
+DATASTORE_PROJECT_ID must be set, as start.sh does). The ndb tests read the
+same entities.
+"""
+import argparse
+import os
+import sys
+
+from google.cloud import datastore
+
+BATCH_SIZE = 500  # the most entities one commit may write
+
+
+def seed(client, num_entities):
+    for start in range(0, num_entities, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, num_entities)
+        client.put_multi([datastore.Entity(key=client.key('OneInt', i))
+                          for i in range(start, stop)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10000,
+                        help='# of OneInt entities to create')
+    args = parser.parse_args()
+    if not os.environ.get('DATASTORE_EMULATOR_HOST'):
+        sys.exit('DATASTORE_EMULATOR_HOST is not set (refusing to seed a '
+                 'real datastore)')
+    client = datastore.Client()
+    seed(client, args.n)
+    print('created %d OneInt entities' % args.n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env bash
+# Runs the python 3 app and everything it needs on this machine (no GCP
+# project required): the datastore emulator, Redis, and two app servers. Cloud
+# Tasks and Cloud Logging are replaced by in-process stand-ins (LOCAL_STUBS=1).
+# The second server runs the ndb versions of the tests. Then benchmark them
+# with e.g.:
+#   ./benchmark/run.py local --local http://127.0.0.1:8080 \
+#       --local-ndb http://127.0.0.1:8090 --test all
+#
+# Requires gcloud (with the cloud-datastore-emulator component), redis-server
+# and platforms/gae_standard/py37/requirements.txt. Press Ctrl-C to stop.
+set -o errexit
+set -o nounset
+
+if [ $# -gt 1 ]; then
+    echo "usage: ./start.sh [falcon|flask|fastapi]"
+    exit 1
+fi
+FRAMEWORK=${1:-falcon}
+if [ $FRAMEWORK == 'fastapi' ]; then
+    worker='uvicorn.workers.UvicornWorker'
+else
+    worker='gthread --threads=10'
+fi
+scriptdir="$(cd "$(dirname "$0")" && pwd)"
+
+export DATASTORE_PROJECT_ID=${DATASTORE_PROJECT_ID:-local}
+export DATASTORE_DATASET=$DATASTORE_PROJECT_ID
+export GOOGLE_CLOUD_PROJECT=$DATASTORE_PROJECT_ID
+export DATASTORE_EMULATOR_HOST=${DATASTORE_EMULATOR_HOST:-127.0.0.1:8432}
+export REDIS_HOST=${REDIS_HOST:-127.0.0.1}
+export REDIS_PORT=${REDIS_PORT:-6379}
+export LOCAL_STUBS=1
+APP_PORT=${APP_PORT:-8080}
+NDB_APP_PORT=${NDB_APP_PORT:-8090}
+
+trap 'kill $(jobs -p) 2>/dev/null' EXIT
+set -o xtrace
+gcloud beta emulators datastore start --no-store-on-disk --consistency=1.0 \
+    --host-port=$DATASTORE_EMULATOR_HOST --project=$DATASTORE_PROJECT_ID &
+redis-server --port $REDIS_PORT --save '' --appendonly no &
+until curl -s http://$DATASTORE_EMULATOR_HOST > /dev/null; do
+    sleep 1
+done
+python3 "$scriptdir/seed.py"
+
+cd "$scriptdir/../gae_standard/py37"
+# the last part of GAE_VERSION is the test (none in particular here)
+GAE_VERSION=local-$FRAMEWORK-all gunicorn --workers 2 \
+    --worker-class $worker --bind 127.0.0.1:$APP_PORT \
+    ${FRAMEWORK}_main:app --error-logfile=- --log-level warning &
+GAE_VERSION=local-$FRAMEWORK-ndb gunicorn --workers 2 \
+    --worker-class $worker --bind 127.0.0.1:$NDB_APP_PORT \
+    ${FRAMEWORK}_main:app --error-logfile=- --log-level warning &
+wait
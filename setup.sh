@@ -26,7 +26,8 @@ if [ $pnamesz -gt 13 ]; then
     exit 1
 fi
 
-pip install --upgrade google-auth-oauthlib requests boto3
+pip install --upgrade google-auth-oauthlib requests
+pip3 install --upgrade aiohttp boto3
 gcloud components install beta
 gcloud components update
 